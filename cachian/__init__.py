@@ -1,55 +1,142 @@
 
-from pickle import dumps, HIGHEST_PROTOCOL
 import os
-import gc
-from threading import Lock
-from time import time
-# Fastest hash as per Python 3.9, next best is blake2b
-from hashlib import sha3_256 as hashfunc
-from functools import lru_cache, partial
+import atexit
+import pickle
+import asyncio
+import inspect
+import weakref
+from heapq import heappush, heappop, heapify
+from threading import Lock, Event, Thread
+from contextlib import contextmanager, ExitStack, nullcontext
+from collections.abc import Mapping
+from time import time, sleep, perf_counter_ns
+from functools import partial
+from itertools import count
 from dataclasses import dataclass
 from .memory_store import MemoryStore
+from .metrics import CacheStats, render_prometheus, CACHIAN_METRICS
+from .admission import FrequencySketch, ADMISSION_TINYLFU, FREQUENCY_MAX
+from . import refresh
+from .snapshot import Snapshot, write_snapshot
+from .sizing import get_size, register_sizer, unregister_sizer, set_global_maxbytes, global_budget
+from .keys import get_param_hash, get_fast_key, get_compact_key, build_param_hash, build_fast_key, build_compact_key, canonicalize, register_key_function, unregister_key_function, key_partition, MISS, NUM_PARAM_HASH_CACHED, KEY_MODE_HASH, KEY_MODE_FAST, KEY_SEPARATOR, DEFAULT_PARTITION_VALUE, COMPACT_KEY_BITS
 
 
-DEFAULT_PARTITION_VALUE = '$$'
-NUM_PARAM_HASH_CACHED: int = 10000
 CACHIAN_ENABLE: bool = int(os.environ.get('CACHIAN_ENABLE', 1)) == 1
 CACHIAN_STORE_CLASS = os.environ.get('CACHIAN_STORE_CLASS', 'memory')
-KEY_SEPARATOR = '~'
+EVICTION_LRU = 'lru'
+EVICTION_FIFO = 'fifo'
+FLIGHT_POLL_INTERVAL = 0.05  # Seconds between checks while another process computes a key
+SWEEP_BATCH_SIZE = 16  # Expired entries reclaimed per add()
+EXPIRY_INDEX_MIN_SIZE = 1024  # Expiry index entries kept before entries of removed keys are dropped
+REFRESH_AHEAD_SKETCH_SIZE = 4096  # Keys the refresh_ahead sketch is sized for when there's no maxsize
+REFRESH_AHEAD_MAX_AGINGS = 4  # Halvings that clear a saturated counter, hits older than that are gone
+CACHIAN_SNAPSHOT_PATH = os.environ.get('CACHIAN_SNAPSHOT_PATH', '')  # Restored at import and written at exit when set
+CACHIAN_SNAPSHOT_INTERVAL = int(os.environ.get('CACHIAN_SNAPSHOT_INTERVAL', '-1'))  # Seconds between snapshots, -1 only writes at exit
 
 if not CACHIAN_ENABLE:
     print('---Cachian DISABLED---')
 
 
-@lru_cache(NUM_PARAM_HASH_CACHED)
-def get_param_hash(*args, **kwargs):
-
-    key1 = dumps(args, HIGHEST_PROTOCOL)
-    key2 = dumps(kwargs, HIGHEST_PROTOCOL)
-
-    m = hashfunc()
-    m.update(key1+key2)
-
-    return m.hexdigest()
-
-
 @dataclass
 class Cachian():
 
     ttl: int = -1  # Seconds
     cache_lib = None #Possible to overwrite to use other backends
     maxsize: int = -1
-    lock: Lock = Lock()
+    maxbytes: int = -1  # Estimated bytes of cached results, see sizing.py
+    lock: Lock = None  # Per instance, so unrelated cached functions don't block each other
+    lock_stripes: int = 1
     obj_self = None  # Used for holding self for cached class methods
     partition_attr: str|int = ''
     cache_class = None
+    eviction: str = EVICTION_LRU
+    admission: str = None  # 'tinylfu' only admits entries more popular than the eviction victim
+    key_mode: str = KEY_MODE_HASH
+    compact: bool = False  # Int keys and fewer objects per entry for in-process stores
+    single_flight: bool = False
+    flight_timeout: int = 30  # Seconds
+    negative_ttl: int = -1  # Seconds for None results, -1 uses ttl, 0 doesn't cache None
+    stale_ttl: int = 0  # Seconds an expired entry is still served while it's refreshed in the background
+    refresh_ahead: float = 0  # Fraction of the TTL at its end where hits on hot keys refresh them early
+    refresh_ahead_hits: int = 3  # Recent hits that make a key hot, at most 15
+    sweep_interval: int = -1  # Seconds, runs a background sweeper for expired entries when > 0
+    batch: bool = False
+    metrics: bool = False  # Records hit and miss latency histograms
 
     def __init__(self, *args, **kwargs) -> None:
 
         self.ttl = kwargs.get('ttl', -1)
+        self.negative_ttl = kwargs.get('negative_ttl', -1)
+        self.stale_ttl = kwargs.get('stale_ttl', 0)
         self.maxsize = kwargs.get('maxsize', -1)
+        self.maxbytes = kwargs.get('maxbytes', -1)
+        self.sizer = kwargs.get('sizer', get_size)
         self.test_mode = kwargs.get('test_mode', False)
         self.cache_class = kwargs.get('cache_class')
+        self.eviction = kwargs.get('eviction', EVICTION_LRU)
+
+        # Optionally shard locking by key hash so concurrent calls to the same function
+        # with different arguments don't serialize on a single lock
+        self.lock_stripes = max(1, kwargs.get('lock_stripes', 1))
+        self._locks = [Lock() for _ in range(self.lock_stripes)]
+        self.lock = self._locks[0]
+
+        # Adds to different stripes share one lock for the size check and eviction,
+        # so a bounded cache doesn't overshoot maxsize
+        self._evict_lock = nullcontext()
+        if self.lock_stripes > 1 and (self.maxsize > 0 or self.maxbytes > 0):
+            self._evict_lock = Lock()
+
+        # Concurrent misses on the same key wait for the first caller's result
+        self.single_flight = kwargs.get('single_flight', False)
+        self.flight_timeout = kwargs.get('flight_timeout', 30)
+        self._flights = {}
+        self._flights_lock = Lock()
+        self._async_flights = {}
+
+        # Keys with a background refresh in flight, and the asyncio tasks running them
+        self._refreshing = set()
+        self._refresh_tasks = set()
+
+        if self.stale_ttl > 0 and self.ttl <= 0 and self.negative_ttl <= 0:
+            raise ValueError('stale_ttl needs ttl or negative_ttl')
+
+        self.refresh_ahead = kwargs.get('refresh_ahead', 0)
+        self.refresh_ahead_hits = kwargs.get('refresh_ahead_hits', 3)
+        if self.refresh_ahead > 0:
+            if self.refresh_ahead >= 1:
+                raise ValueError('refresh_ahead is a fraction of the TTL, between 0 and 1')
+            if self.ttl <= 0 and self.negative_ttl <= 0:
+                raise ValueError('refresh_ahead needs ttl or negative_ttl')
+            if not 1 <= self.refresh_ahead_hits <= FREQUENCY_MAX:
+                raise ValueError(f'refresh_ahead_hits must be between 1 and {FREQUENCY_MAX}')
+
+        # The first argument is a collection of ids, cached per id and looked up in bulk
+        self.batch = kwargs.get('batch', False)
+
+        # Counters are always kept, latency histograms cost two clock reads per call
+        self.metrics = kwargs.get('metrics', CACHIAN_METRICS)
+        self.stats = CacheStats()
+
+        if self.eviction not in (EVICTION_LRU, EVICTION_FIFO):
+            raise ValueError(f'Unknown eviction policy: {self.eviction}')
+
+        self.admission = kwargs.get('admission')
+        if self.admission not in (None, ADMISSION_TINYLFU):
+            raise ValueError(f'Unknown admission policy: {self.admission}')
+
+        # 'fast' uses tuple keys for in-process stores, remote stores still need hashed keys
+        self.key_mode = kwargs.get('key_mode', KEY_MODE_HASH)
+
+        if self.key_mode not in (KEY_MODE_HASH, KEY_MODE_FAST):
+            raise ValueError(f'Unknown key mode: {self.key_mode}')
+
+        # Partition values get a small id in compact mode, stored once instead of in every key
+        self.compact = kwargs.get('compact', False)
+        self._partition_ids = {}
+        self._partition_ids_lock = Lock()
+        self._last_partition_id = 0
 
         if self.cache_class is None:
             self.cache_class = MemoryStore
@@ -60,27 +147,238 @@ class Cachian():
             elif CACHIAN_STORE_CLASS == 'shared_memory':
                 from .shared_memory_store import SharedMemoryStore
                 self.cache_class = SharedMemoryStore
+            elif CACHIAN_STORE_CLASS == 'mmap':
+                from .mmap_store import MmapStore
+                self.cache_class = MmapStore
+            elif CACHIAN_STORE_CLASS == 'tiered':
+                from .tiered_store import TieredStore
+                self.cache_class = TieredStore
+            elif CACHIAN_STORE_CLASS == 'sqlite':
+                from .sqlite_store import SqliteStore
+                self.cache_class = SqliteStore
             
             # You can add other store classes here
             
     
-        self.cache_lib = self.cache_class()
+        self.partition_attr = kwargs.get('partition_attr', '')
 
+        # Min-heap of (expire_at, seq, full_key) so expired entries can be reclaimed without
+        # waiting for the same key to be looked up again. seq breaks ties between entries
+        # expiring together, so keys of different types are never compared
+        self._expiry = []
+        self._expiry_seq = count()
+        self._expiry_lock = Lock()
+        self._expiry_limit = EXPIRY_INDEX_MIN_SIZE
 
-        self.partition_attr = kwargs.get('partition_attr', '')
+        self._set_store(self.cache_class())
 
-        self.clear_all()
+        self.sweep_interval = kwargs.get('sweep_interval', -1)
+        self._sweeper_stop = None
+        if self.sweep_interval > 0 and self.ttl > 0:
+            self.start_sweeper()
 
     def __call__(self, func, *args, **kwargs):
         parent = self
+
+        # Shared stores keep each function's entries apart, named after the function
+        set_namespace = getattr(self.cache_lib, 'set_namespace', None)
+        if set_namespace is not None:
+            set_namespace(f'{func.__module__}.{func.__qualname__}')
+
         if self.obj_self is None:
-            return _CachianWrapper(func, parent)
+            if self.batch:
+                if inspect.iscoroutinefunction(func):
+                    return _AsyncBatchCachianWrapper(func, parent)
+                return _BatchCachianWrapper(func, parent)
+            if inspect.iscoroutinefunction(func):
+                return _AsyncCachianWrapper(func, parent)
+            # Hits skip the checks of features that are off
+            if self.metrics or self.stale_ttl > 0 or self.refresh_ahead > 0 or self.single_flight:
+                return _CachianWrapper(func, parent)
+            return _PlainCachianWrapper(func, parent)
         else:
             return _CachianWrapper(self.obj_self, func, parent)
 
+    @property
+    def swept(self):
+        return self.stats.snapshot().swept
+
+    def _lock_for(self, full_key):
+        if self.lock_stripes == 1:
+            return self.lock
+        return self._locks[hash(full_key) % self.lock_stripes]
+
+    @contextmanager
+    def _all_locks(self):
+        with ExitStack() as stack:
+            for lock in self._locks:
+                stack.enter_context(lock)
+            yield
+
+    def _set_store(self, cache_lib):
+        self.cache_lib = cache_lib
+
+        # Backends that enforce maxsize and TTL themselves are told the settings once and
+        # provide lookup()/insert() compound operations used instead of the generic path
+        configure = getattr(self.cache_lib, 'configure', None)
+        if configure is not None:
+            configure(maxsize=self.maxsize, ttl=self._retained(self.ttl), eviction=self.eviction)
+        self._store_lookup = getattr(self.cache_lib, 'lookup', None)
+        self._store_insert = getattr(self.cache_lib, 'insert', None)
+
+        # Compact mode needs an in-process store, entries only keep a timestamp when a TTL
+        # needs it and caches that never evict use a plain dict
+        self._bare_values = False
+        if self.compact:
+            store_compact = getattr(self.cache_lib, 'compact', None)
+            if store_compact is None or not getattr(self.cache_lib, 'in_process', False):
+                raise ValueError(f'compact needs an in-process store, {type(self.cache_lib).__name__} is not')
+
+            store_compact(ordered=self.maxsize > 0 or self.maxbytes > 0 or global_budget.maxbytes > 0)
+            self._bare_values = self.ttl <= 0 and self.negative_ttl <= 0
+            self.has2 = self._has2_compact
+
+        # Backends without touch() can't track recency, they fall back to iteration order
+        self._touch = None
+        if self.eviction == EVICTION_LRU:
+            self._touch = getattr(self.cache_lib, 'touch', None)
+
+        # Stores that track entry sizes enforce maxbytes and count towards the global budget
+        self._sized = False
+        track_size = getattr(self.cache_lib, 'track_size', None)
+        if self.maxbytes > 0 or global_budget.maxbytes > 0:
+            if track_size is not None:
+                track_size()
+                global_budget.register(self)
+                self._sized = True
+            elif self.maxbytes > 0:
+                raise ValueError(f'maxbytes needs a store that tracks entry sizes, {type(self.cache_lib).__name__} does not')
+
+        # Lookups are counted in a frequency sketch, a full cache only admits a new entry
+        # when it's more popular than the entry it would evict
+        self.sketch = None
+        if self.admission == ADMISSION_TINYLFU:
+            if self.maxsize <= 0 or self._store_insert is not None:
+                raise ValueError('admission needs maxsize and a store Cachian evicts from')
+            self.sketch = FrequencySketch(self.maxsize)
+            self._has2_unrecorded = self.has2
+            self.has2 = self._has2_recorded
+
+        # Hits counted for refresh_ahead, halved once per TTL so a hot key is one hit
+        # recently rather than since the cache was created
+        self._hits_sketch = None
+        if self.refresh_ahead > 0:
+            self._hits_sketch = FrequencySketch(self.maxsize if self.maxsize > 0 else REFRESH_AHEAD_SKETCH_SIZE)
+            self._hits_window = self.ttl if self.ttl > 0 else self.negative_ttl
+            self._hits_aged_at = time()
+
+        # In-process stores use (partition_value, key) tuples, others need string keys
+        self._tuple_keys = getattr(self.cache_lib, 'in_process', False)
+        self.key_func = build_fast_key if self._tuple_keys and self.key_mode == KEY_MODE_FAST else build_param_hash
+        if self.compact:
+            self.key_func = build_compact_key
+
     def clear_all(self):
-        with self.lock:
-            self.cache_lib = self.cache_class()
+        with self._all_locks():
+            self.cache_lib.clear()
+
+            with self._partition_ids_lock:
+                self._partition_ids = {}
+
+            with self._expiry_lock:
+                self._expiry = []
+                self._expiry_limit = EXPIRY_INDEX_MIN_SIZE
+
+    # Kind of keys key_func builds, snapshots only restore keys of the same kind
+    def key_kind(self):
+        if self.compact:
+            return 'compact'
+        return 'fast' if self.key_func is build_fast_key else 'hash'
+
+    def _split_key(self, full_key, partition_values):
+        if type(full_key) is int:
+            partition_id = full_key >> COMPACT_KEY_BITS
+            if not partition_id:
+                return DEFAULT_PARTITION_VALUE, full_key
+            return partition_values.get(partition_id, MISS), full_key & ((1 << COMPACT_KEY_BITS) - 1)
+        if type(full_key) is tuple:
+            return full_key
+        partition_value, _, key = full_key.rpartition(KEY_SEPARATOR)
+        return partition_value, key
+
+    def snapshot_entries(self):
+        """(partition_value, key, result, ts) of every entry of an in-process store, ts is None
+        for compact entries without a timestamp. Other stores keep their entries themselves."""
+
+        if not getattr(self.cache_lib, 'in_process', False):
+            return []
+
+        with self._all_locks():
+            items = list(self.cache_lib.items())
+
+        partition_values = {partition_id: value for value, partition_id in self._partition_ids.items()}
+        entries = []
+        for full_key, r in items:
+            partition_value, key = self._split_key(full_key, partition_values)
+            if partition_value is MISS:
+                continue  # Added while its partition was cleared, the id was released
+            if self._bare_values:
+                entries.append((partition_value, key, r, None))
+            else:
+                entries.append((partition_value, key, r[0], r[1]))
+        return entries
+
+    def restore_entries(self, entries):
+        """Add entries from snapshot_entries() that haven't expired. Returns the number added."""
+
+        if not getattr(self.cache_lib, 'in_process', False):
+            return 0
+
+        now = time()
+        ttl = self._retained(self._entry_ttl(0))
+        none_ttl = self._retained(self._entry_ttl(None))
+
+        restored = []
+        for partition_value, key, result, ts in entries:
+            if ts is None:
+                ts = now
+            entry_ttl = none_ttl if result is None else ttl
+            if entry_ttl == 0 or (entry_ttl > 0 and now - ts > entry_ttl):
+                continue
+            restored.append((key, (result, ts), partition_value))
+
+        self.add_many(restored)
+        return len(restored)
+
+    def full_key(self, key, partition_value=DEFAULT_PARTITION_VALUE):
+        if self.compact:
+            return self._compact_key(key, partition_value)
+        if self._tuple_keys:
+            return (partition_value, key)
+        return f'{partition_value}{KEY_SEPARATOR}{key}'
+
+    def _partition_id(self, partition_value):
+        partition_id = self._partition_ids.get(partition_value)
+        if partition_id is None:
+            with self._partition_ids_lock:
+                partition_id = self._partition_ids.get(partition_value)
+                if partition_id is None:
+                    # Ids of cleared partitions aren't reused, an entry added while its partition
+                    # was cleared keeps the old id and must not match another partition's keys
+                    self._last_partition_id += 1
+                    partition_id = self._partition_ids[partition_value] = self._last_partition_id
+        return partition_id
+
+    # Ids are released once a partition is cleared, so the table only holds partitions in use
+    def _release_partition_id(self, partition_value, partition_id):
+        with self._partition_ids_lock:
+            if self._partition_ids.get(partition_value) == partition_id:
+                del self._partition_ids[partition_value]
+
+    def _compact_key(self, key, partition_value):
+        if partition_value == DEFAULT_PARTITION_VALUE:
+            return key
+        return (self._partition_id(partition_value) << COMPACT_KEY_BITS) | key
 
     def _length(self):
         return len(self.cache_lib)
@@ -91,68 +389,765 @@ class Cachian():
 
         return len(self.cache_lib) >= self.maxsize
 
-    # Remove item by FIFO
+    # Next entry _pop() would remove, None when the store is empty
+    def _victim(self):
+        victim = getattr(self.cache_lib, 'victim', None)
+        if victim is not None:
+            return victim()
+
+        for key in iter(self.cache_lib):
+            return key
+        return None
+
+    def _admit(self, full_key):
+        victim = self._victim()
+        if victim is None or victim == full_key:
+            return True
+        return self.sketch.estimate(full_key) > self.sketch.estimate(victim)
+
+    # Remove item by LRU/FIFO depending on the eviction policy
     def _pop(self):
+        evict = getattr(self.cache_lib, 'evict', None)
+        if evict is not None:
+            try:
+                evicted = evict()
+            except KeyError:
+                return None  # Emptied by a concurrent stripe
+            self.stats.add('evictions')
+            return evicted
+
+        # Generic backends, remove by iteration order
         first_key = None
         for i in iter(self.cache_lib):
             first_key=i
             break
 
+        self.stats.add('evictions')
         return self.cache_lib.pop(first_key)
 
+    # Remove count entries, in one operation for backends with evict_many()
+    def _pop_many(self, count):
+        if count <= 0:
+            return
+
+        evict_many = getattr(self.cache_lib, 'evict_many', None)
+        if evict_many is None:
+            for _ in range(count):
+                self._pop()
+            return
+
+        self.stats.add('evictions', evict_many(count))
+
+    @property
+    def nbytes(self):
+        return self.cache_lib.nbytes if self._sized else 0
+
+    # Entries larger than the budget aren't cached, they would evict everything else
+    def _fits(self, size):
+        return (self.maxbytes <= 0 or size <= self.maxbytes) and (global_budget.maxbytes <= 0 or size <= global_budget.maxbytes)
+
+    # Evict entries until maxbytes is met, the entry just added is the last candidate
+    def _trim_bytes(self):
+        while self.maxbytes > 0 and self.cache_lib.nbytes > self.maxbytes:
+            if self._pop() is None:
+                break
+
+    # Evict one entry for the global budget, None when there is nothing to evict
+    def shrink(self):
+        with self._all_locks():
+            if len(self.cache_lib) == 0:
+                return None
+            return self._pop()
+
+    # TTL of an entry, None results (negative results) can use a separate TTL
+    def _entry_ttl(self, result):
+        if result is None and self.negative_ttl >= 0:
+            return self.negative_ttl
+        return self.ttl
+
+    # Seconds an entry is kept, entries with a TTL are kept for another stale_ttl
+    # so they can be served while they are refreshed
+    def _retained(self, ttl):
+        if ttl > 0:
+            return ttl + self.stale_ttl
+        return ttl
+
+    def is_stale(self, result, ts):
+        ttl = self._entry_ttl(result)
+        return ttl > 0 and time() - ts > ttl
+
+    # Counts a hit and tells whether the entry is in the last refresh_ahead of its TTL
+    # and its key was hit at least refresh_ahead_hits times recently
+    def refresh_due(self, key, result, ts, partition_value=DEFAULT_PARTITION_VALUE):
+        sketch = self._hits_sketch
+        full_key = self.full_key(key, partition_value)
+        sketch.increment(full_key)
+
+        # Hits lose half their weight per TTL, once for each TTL since the last aging
+        now = time()
+        windows = int((now - self._hits_aged_at) // self._hits_window)
+        if windows > 0:
+            self._hits_aged_at = now
+            for _ in range(min(windows, REFRESH_AHEAD_MAX_AGINGS)):
+                sketch.age()
+
+        ttl = self._entry_ttl(result)
+        if ttl <= 0:
+            return False
+
+        age = now - ts
+        return ttl * (1 - self.refresh_ahead) < age <= ttl and sketch.estimate(full_key) >= self.refresh_ahead_hits
+
     def add(self, key, item, partition_value=DEFAULT_PARTITION_VALUE):
         if not CACHIAN_ENABLE:
             return
 
-        with self.lock:
-            if self._full():
+        ttl = self._entry_ttl(item[0])
+        if ttl == 0:
+            return  # Negative results aren't cached
+        ttl = self._retained(ttl)
+
+        full_key = self.full_key(key, partition_value)
+
+        if self._store_insert is not None:
+            self._store_insert(full_key, item, ttl)
+            return
+
+        size = None
+        if self._sized:
+            size = self.sizer(item[0])
+            if not self._fits(size):
+                return
+
+        with self._lock_for(full_key), self._evict_lock:
+            # Refreshing an entry replaces it, nothing needs to be evicted
+            if self._full() and full_key not in self.cache_lib:
+                if self.sketch is not None and not self._admit(full_key):
+                    self.stats.add('rejections')
+                    return
                 self._pop()
 
-            self.cache_lib[f'{partition_value}{KEY_SEPARATOR}{key}'] = item
+            self.cache_lib[full_key] = item[0] if self._bare_values else item
 
-            pass
+            if size is not None:
+                self.cache_lib.set_size(full_key, size)
+                self._trim_bytes()
+
+        if ttl > 0:
+            self._track_expiry(full_key, ttl)
+
+        if size is not None and global_budget.maxbytes > 0:
+            global_budget.enforce()
+
+    # Bulk add(), entries are (key, item, partition_value). Backends with set_many() take
+    # all entries in one operation, maxsize is made room for once.
+    def add_many(self, entries):
+        if not CACHIAN_ENABLE:
+            return
+
+        items = {}
+        ttls = {}
+        for key, item, partition_value in entries:
+            ttl = self._entry_ttl(item[0])
+            if ttl == 0:
+                continue  # Negative results aren't cached
+
+            full_key = self.full_key(key, partition_value)
+            items[full_key] = item
+            ttls[full_key] = self._retained(ttl)
+
+        sizes = {}
+        if self._sized and self._store_insert is None:
+            for full_key, item in list(items.items()):
+                sizes[full_key] = self.sizer(item[0])
+                if not self._fits(sizes[full_key]):
+                    del items[full_key]
+
+        if self._store_insert is not None:
+            insert_many = getattr(self.cache_lib, 'insert_many', None)
+            if insert_many is not None:
+                insert_many([(full_key, item, ttls[full_key]) for full_key, item in items.items()])
+            else:
+                for full_key, item in items.items():
+                    self._store_insert(full_key, item, ttls[full_key])
+            return
+
+        if self.maxsize > 0 and len(items) > self.maxsize:
+            items = dict(list(items.items())[-self.maxsize:])
+
+        stored = {full_key: item[0] for full_key, item in items.items()} if self._bare_values else items
+
+        set_many = getattr(self.cache_lib, 'set_many', None)
+        with self._all_locks():
+            if self.maxsize > 0:
+                length = len(self.cache_lib)
+                self._pop_many(min(length + len(items) - self.maxsize, length))
+
+            if set_many is not None:
+                set_many(stored)
+            else:
+                for full_key, item in stored.items():
+                    self.cache_lib[full_key] = item
+
+            if sizes:
+                for full_key in items:
+                    self.cache_lib.set_size(full_key, sizes[full_key])
+                self._trim_bytes()
+
+        # Entries expire from their timestamp, restored entries can be older than now
+        self._track_expiries([(item[1] + ttls[full_key], full_key) for full_key, item in items.items() if ttls[full_key] > 0])
+
+        if sizes and global_budget.maxbytes > 0:
+            global_budget.enforce()
+
+    def _track_expiry(self, full_key, ttl):
+        now = time()
+        with self._expiry_lock:
+            heappush(self._expiry, (now + ttl, next(self._expiry_seq), full_key))
+            due = self._expiry[0][0] <= now
+            if len(self._expiry) > self._expiry_limit:
+                self._compact_expiry()
+
+        # Amortized sweep, reclaim a few expired entries on each add
+        if due:
+            self.sweep(SWEEP_BATCH_SIZE)
+
+    def _track_expiries(self, expiries):
+        if not expiries:
+            return
+
+        now = time()
+        with self._expiry_lock:
+            for expire_at, full_key in expiries:
+                heappush(self._expiry, (expire_at, next(self._expiry_seq), full_key))
+            due = self._expiry[0][0] <= now
+            if len(self._expiry) > self._expiry_limit:
+                self._compact_expiry()
+
+        if due:
+            self.sweep(SWEEP_BATCH_SIZE)
+
+    # Evicted, removed and re-added keys leave entries in the index until they are due.
+    # Once it holds twice the entries left after the last compaction, keep only the latest
+    # entry of keys still in the store. Called with _expiry_lock held.
+    def _compact_expiry(self):
+        latest = {}
+        for expire_at, _, full_key in self._expiry:
+            if latest.get(full_key, 0) < expire_at:
+                latest[full_key] = expire_at
+
+        full_keys = list(latest)
+        get_many = getattr(self.cache_lib, 'get_many', None)
+        if get_many is not None:
+            present = [r is not MISS for r in get_many(full_keys)]
+        else:
+            present = [full_key in self.cache_lib for full_key in full_keys]
+
+        self._expiry = [(latest[full_key], next(self._expiry_seq), full_key) for full_key, p in zip(full_keys, present) if p]
+        heapify(self._expiry)
+        self._expiry_limit = max(EXPIRY_INDEX_MIN_SIZE, 2 * len(self._expiry))
+
+    def sweep(self, limit=None):
+        """Remove expired entries using the expiry index. Returns the number of entries removed."""
+
+        swept = 0
+        checked = 0
+        now = time()
+
+        while limit is None or checked < limit:
+            with self._expiry_lock:
+                if not self._expiry or self._expiry[0][0] > now:
+                    break
+                expire_at, _, full_key = heappop(self._expiry)
+
+            checked += 1
+
+            with self._lock_for(full_key):
+                r = self.cache_lib.get(full_key, MISS)
+                # Skip entries that were removed or re-added since
+                if r is not MISS and now - r[1] > self._retained(self._entry_ttl(r[0])):
+                    self.cache_lib.pop(full_key, None)
+                    swept += 1
+
+        if swept:
+            self.stats.add('swept', swept)
+            self.stats.add('expirations', swept)
+        return swept
+
+    def start_sweeper(self, interval=None):
+        if interval is not None:
+            self.sweep_interval = interval
+
+        self.stop_sweeper()
+        self._sweeper_stop = Event()
+
+        # Only hold a weak reference so the sweeper doesn't keep the cache alive
+        Thread(target=_sweeper, args=(weakref.ref(self), self.sweep_interval, self._sweeper_stop), daemon=True, name='cachian-sweeper').start()
+
+    def stop_sweeper(self):
+        if self._sweeper_stop is not None:
+            self._sweeper_stop.set()
+            self._sweeper_stop = None
 
     # Must be called after checking with has().
     # get() doesn't check for TTL
     def get(self, key, partition_value=DEFAULT_PARTITION_VALUE):
-        with self.lock:
-            return self.cache_lib[f'{partition_value}{KEY_SEPARATOR}{key}']
+        full_key = self.full_key(key, partition_value)
+
+        with self._lock_for(full_key):
+            if self._bare_values:
+                return self.cache_lib[full_key], None
+            return self.cache_lib[full_key]
 
     # Must be called after checking with has().
     # remove() doesn't check for TTL
     def remove_partition(self, partition_value=DEFAULT_PARTITION_VALUE):
 
+        # Backends with a partition index only touch the partition's own entries
+        store_remove_partition = getattr(self.cache_lib, 'remove_partition', None)
+
+        if self.compact and partition_value != DEFAULT_PARTITION_VALUE:
+            partition_id = self._partition_ids.get(partition_value)
+            if partition_id is None:
+                return 0  # Nothing was cached in this partition since it was last cleared
+
+            removed = self._remove_partition(store_remove_partition, partition_id)
+            self._release_partition_id(partition_value, partition_id)
+            return removed
+
+        return self._remove_partition(store_remove_partition, partition_value)
+
+    def _remove_partition(self, store_remove_partition, partition):
         removed = 0
-        with self.lock:
+        with self._all_locks():
+            if store_remove_partition is not None:
+                return store_remove_partition(partition)
+
             for key in list(self.cache_lib.keys()):
-                if partition_value in key:
+                if key_partition(key) == partition:
                     del self.cache_lib[key]
                     removed+=1
         
         return removed
 
+    # Refreshes a key in the background unless a refresh is already in flight for it.
+    # compute() stores the new result. Returns False when the refresh wasn't scheduled.
+    def refresh(self, key, compute, partition_value=DEFAULT_PARTITION_VALUE):
+
+        full_key = self._begin_refresh(key, partition_value)
+        if full_key is None:
+            return False
+
+        def run():
+            try:
+                compute()
+                self.stats.add('refreshes')
+            except Exception:
+                self.stats.add('refresh_errors')  # The stale entry is kept
+            finally:
+                self._end_refresh(full_key)
+
+        if not refresh.submit(run):
+            self._end_refresh(full_key)
+            return False
+        return True
+
+    # Async counterpart of refresh(), runs as a task on the running event loop.
+    # compute is a coroutine function.
+    def arefresh(self, key, compute, partition_value=DEFAULT_PARTITION_VALUE):
+
+        if len(self._refresh_tasks) >= refresh.CACHIAN_REFRESH_QUEUE:
+            return False
+
+        full_key = self._begin_refresh(key, partition_value)
+        if full_key is None:
+            return False
+
+        async def run():
+            try:
+                await compute()
+                self.stats.add('refreshes')
+            except Exception:
+                self.stats.add('refresh_errors')
+            finally:
+                self._end_refresh(full_key)
+
+        # The loop only keeps weak references to tasks
+        task = asyncio.get_running_loop().create_task(run())
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+        return True
+
+    def _begin_refresh(self, key, partition_value):
+        full_key = self.full_key(key, partition_value)
+        with self._flights_lock:
+            if full_key in self._refreshing:
+                return None
+            self._refreshing.add(full_key)
+        return full_key
+
+    def _end_refresh(self, full_key):
+        with self._flights_lock:
+            self._refreshing.discard(full_key)
+
+    # Runs compute() once per key across concurrent callers. Returns (result, computed)
+    # where computed is False for callers that received another caller's result.
+    def call_once(self, key, compute, partition_value=DEFAULT_PARTITION_VALUE):
+
+        full_key = self.full_key(key, partition_value)
+
+        with self._flights_lock:
+            flight = self._flights.get(full_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[full_key] = _Flight()
+
+        if not leader:
+            if not flight.event.wait(self.flight_timeout):
+                return compute(), True  # Leader is stuck, don't wait forever
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+
+        try:
+            flight.result, computed = self._call_once_across_processes(key, full_key, compute, partition_value)
+            return flight.result, computed
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[full_key]
+            flight.event.set()
+
+    # Backends shared by several processes can provide acquire_flight() and release_flight()
+    # so only one process computes a key, the others poll the store for its result
+    def _call_once_across_processes(self, key, full_key, compute, partition_value):
+
+        acquire_flight = getattr(self.cache_lib, 'acquire_flight', None)
+        if acquire_flight is None:
+            return compute(), True
+
+        deadline = time() + self.flight_timeout
+        while not acquire_flight(full_key, self.flight_timeout):
+            sleep(FLIGHT_POLL_INTERVAL)
+            result, ts = self.has2(key, partition_value)
+            if result is not MISS:
+                return result, False
+            if time() > deadline:
+                return compute(), True
+
+        try:
+            # Another process may have finished between our miss and acquiring the flight
+            result, ts = self.has2(key, partition_value)
+            if result is not MISS:
+                return result, False
+            return compute(), True
+        finally:
+            self.cache_lib.release_flight(full_key)
+
+    # Async counterpart of call_once(), concurrent awaiters on the same event loop
+    # join a single computation. compute is a coroutine function.
+    async def acall_once(self, key, compute, partition_value=DEFAULT_PARTITION_VALUE):
+
+        full_key = self.full_key(key, partition_value)
+        loop = asyncio.get_running_loop()
+
+        future = self._async_flights.get(full_key)
+        if future is not None and future.get_loop() is loop:
+            try:
+                return await asyncio.shield(future), False
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # This awaiter was cancelled
+                # The computing task was cancelled, take over the computation
+                return await self.acall_once(key, compute, partition_value)
+
+        future = loop.create_future()
+        self._async_flights[full_key] = future
+
+        try:
+            result = await compute()
+            future.set_result(result)
+            return result, True
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved in case nobody else is waiting
+            raise
+        finally:
+            if self._async_flights.get(full_key) is future:
+                del self._async_flights[full_key]
+
+    # Async backends provide aget()/aset() etc. so lookups don't block the event loop,
+    # other backends fall back to the synchronous path
+    async def ahas2(self, key, partition_value=DEFAULT_PARTITION_VALUE):
+
+        alookup = getattr(self.cache_lib, 'alookup', None)
+        if alookup is not None:
+            r = await alookup(self.full_key(key, partition_value))
+            if r is MISS:
+                return MISS, None
+            return r
+
+        aget = getattr(self.cache_lib, 'aget', None)
+        if aget is None:
+            return self.has2(key, partition_value)
+
+        full_key = self.full_key(key, partition_value)
+
+        r = await aget(full_key)
+        if r is MISS:
+            return MISS, None  # Key doesn't exist
+
+        result, ts = r
+        ttl = self._retained(self._entry_ttl(result))
+        if ttl > 0 and time() - ts > ttl:
+            await self.cache_lib.adelete(full_key)
+            self.stats.add('expirations')
+            return MISS, None  # Key expired based on TTL
+
+        return result, ts
+
+    async def aadd(self, key, item, partition_value=DEFAULT_PARTITION_VALUE):
+        if not CACHIAN_ENABLE:
+            return
+
+        ainsert = getattr(self.cache_lib, 'ainsert', None)
+        aset = getattr(self.cache_lib, 'aset', None)
+        if ainsert is None and aset is None:
+            return self.add(key, item, partition_value)
+
+        ttl = self._entry_ttl(item[0])
+        if ttl == 0:
+            return  # Negative results aren't cached
+        ttl = self._retained(ttl)
+
+        if ainsert is not None:
+            return await ainsert(self.full_key(key, partition_value), item, ttl)
+
+        if self.maxsize > 0 and await self.cache_lib.alen() >= self.maxsize:
+            await self.cache_lib.aevict()
+            self.stats.add('evictions')
+
+        await aset(self.full_key(key, partition_value), item)
+
+    # Async counterpart of has_many(). Backends with aget_many() are read in one operation,
+    # other async backends with one lookup per key run concurrently.
+    async def ahas_many(self, keys, partition_values):
+
+        aget_many = getattr(self.cache_lib, 'aget_many', None)
+        if aget_many is None:
+            if getattr(self.cache_lib, 'alookup', None) is None and getattr(self.cache_lib, 'aget', None) is None:
+                return self.has_many(keys, partition_values)
+            return await asyncio.gather(*[self.ahas2(key, partition_value) for key, partition_value in zip(keys, partition_values)])
+
+        full_keys = [self.full_key(key, partition_value) for key, partition_value in zip(keys, partition_values)]
+
+        now = time()
+        results = []
+        expired = []
+        for full_key, r in zip(full_keys, await aget_many(full_keys)):
+            if r is MISS:
+                results.append((MISS, None))
+                continue
+
+            result, ts = r
+            ttl = self._retained(self._entry_ttl(result))
+            if ttl > 0 and now - ts > ttl:
+                expired.append(full_key)
+                results.append((MISS, None))
+            else:
+                results.append((result, ts))
+
+        if expired:
+            await asyncio.gather(*[self.cache_lib.adelete(full_key) for full_key in expired])
+            self.stats.add('expirations', len(expired))
+
+        return results
+
+    # Async counterpart of add_many(). Backends with aset_many() take all entries in one
+    # operation, maxsize is made room for once.
+    async def aadd_many(self, entries):
+        if not CACHIAN_ENABLE:
+            return
+
+        aset_many = getattr(self.cache_lib, 'aset_many', None)
+        if aset_many is None:
+            if getattr(self.cache_lib, 'ainsert', None) is None and getattr(self.cache_lib, 'aset', None) is None:
+                return self.add_many(entries)
+            await asyncio.gather(*[self.aadd(*entry) for entry in entries])
+            return
+
+        items = {}
+        for key, item, partition_value in entries:
+            if self._entry_ttl(item[0]) == 0:
+                continue  # Negative results aren't cached
+            items[self.full_key(key, partition_value)] = item
+
+        if self.maxsize > 0:
+            if len(items) > self.maxsize:
+                items = dict(list(items.items())[-self.maxsize:])
+
+            length = await self.cache_lib.alen()
+            excess = min(length + len(items) - self.maxsize, length)
+            if excess > 0:
+                aevict_many = getattr(self.cache_lib, 'aevict_many', None)
+                if aevict_many is not None:
+                    self.stats.add('evictions', await aevict_many(excess))
+                else:
+                    for _ in range(excess):
+                        await self.cache_lib.aevict()
+                        self.stats.add('evictions')
+
+        if items:
+            await aset_many(items)
+
+    # Bulk has2(), returns a (result, ts) pair per key with MISS for missing or expired keys.
+    # Backends with get_many() are read in one operation, for backends with lookup() it
+    # must apply the same checks.
+    def has_many(self, keys, partition_values):
+
+        full_keys = [self.full_key(key, partition_value) for key, partition_value in zip(keys, partition_values)]
+        get_many = getattr(self.cache_lib, 'get_many', None)
+
+        if self._store_lookup is not None:
+            rs = get_many(full_keys) if get_many is not None else map(self._store_lookup, full_keys)
+            return [(MISS, None) if r is MISS else r for r in rs]
+
+        now = time()
+        results = []
+        with self._all_locks():
+            if get_many is not None:
+                rs = get_many(full_keys)
+            else:
+                rs = [self.cache_lib.get(full_key, MISS) for full_key in full_keys]
+
+            for full_key, r in zip(full_keys, rs):
+                if r is MISS:
+                    results.append((MISS, None))
+                    continue
+
+                if self._bare_values:
+                    self._promote(full_key)
+                    results.append((r, None))
+                    continue
+
+                result, ts = r
+                ttl = self._retained(self._entry_ttl(result))
+                if ttl > 0 and now - ts > ttl:
+                    self.cache_lib.pop(full_key, None)
+                    self.stats.add('expirations')
+                    results.append((MISS, None))
+                else:
+                    self._promote(full_key)
+                    results.append((result, ts))
+
+        return results
+
+    def _promote(self, full_key):
+        if self._touch is not None:
+            try:
+                self._touch(full_key)
+            except KeyError:
+                pass  # Evicted by a concurrent stripe
+
     def set_object_self(self, obj_self):
         self.obj_self = obj_self
 
     def has2(self, key, partition_value=DEFAULT_PARTITION_VALUE):
 
-        full_key = f'{partition_value}{KEY_SEPARATOR}{key}'
+        # Inlined full_key() and _lock_for(), this is the hot path for every call
+        if self._tuple_keys:
+            full_key = (partition_value, key)
+        else:
+            full_key = f'{partition_value}{KEY_SEPARATOR}{key}'
+
+        if self._store_lookup is not None:
+            r = self._store_lookup(full_key)
+            if r is MISS:
+                return MISS, None
+            return r  # TTL and recency are handled by the store
+
+        if self.lock_stripes == 1:
+            lock = self.lock
+        else:
+            lock = self._locks[hash(full_key) % self.lock_stripes]
 
-        with self.lock:
-            r = self.cache_lib.get(full_key)
-            if r is not None:
-                if self.ttl > 0:
+        with lock:
+            r = self.cache_lib.get(full_key, MISS)
+            if r is not MISS:
+                if self.ttl > 0 or self.negative_ttl > 0:
                     result, ts = r
-                    if time() - ts > self.ttl:
+                    ttl = self.negative_ttl if result is None and self.negative_ttl > 0 else self.ttl
+                    if ttl > 0 and time() - ts > ttl + self.stale_ttl:
                         # Remove so future checks are faster
-                        del self.cache_lib[full_key]
-                        return None, None  # Key expired based on TTL
-                    else:
-                        return result, ts  # Key is within TTL
-                else:
-                    return r  # TTL is not used
+                        self.cache_lib.pop(full_key, None)
+                        self.stats.add('expirations')
+                        return MISS, None  # Key expired based on TTL
+
+                # Inlined _promote()
+                touch = self._touch
+                if touch is not None:
+                    try:
+                        touch(full_key)
+                    except KeyError:
+                        pass  # Evicted by a concurrent stripe
+                return r  # Key is within TTL or TTL is not used
             else:
-                return None, None  # Key doesn't exist
+                return MISS, None  # Key doesn't exist
+
+
+    # has2() with admission, every lookup counts towards the key's popularity
+    def _has2_recorded(self, key, partition_value=DEFAULT_PARTITION_VALUE):
+        self.sketch.increment(self.full_key(key, partition_value))
+        return self._has2_unrecorded(key, partition_value)
+
+    # has2() for compact mode, bound in _set_store()
+    def _has2_compact(self, key, partition_value=DEFAULT_PARTITION_VALUE):
+
+        if partition_value == DEFAULT_PARTITION_VALUE:
+            full_key = key
+        else:
+            full_key = self._compact_key(key, partition_value)
+
+        with self._lock_for(full_key):
+            r = self.cache_lib.get(full_key, MISS)
+            if r is MISS:
+                return MISS, None
+
+            if self._bare_values:
+                self._promote(full_key)
+                return r, None  # Stored without a timestamp
+
+            result, ts = r
+            ttl = self.negative_ttl if result is None and self.negative_ttl > 0 else self.ttl
+            if ttl > 0 and time() - ts > ttl + self.stale_ttl:
+                self.cache_lib.pop(full_key, None)
+                self.stats.add('expirations')
+                return MISS, None
+
+            self._promote(full_key)
+            return result, ts
+
+
+def _sweeper(cachian_ref, interval, stop):
+    while not stop.wait(interval):
+        cachian = cachian_ref()
+        if cachian is None:
+            return
+        cachian.sweep()
+        del cachian
+
+
+class _Flight():
+
+    def __init__(self) -> None:
+        self.event = Event()
+        self.result = None
+        self.error = None
 
 
 # Uses InnerClass so both Cachian() and Cachian(ttl=1) format is supported
@@ -160,18 +1155,21 @@ class _CachianWrapper():
 
     func = None
     parent: Cachian = None
-    hit: int = 0
-    miss: int = 0
-    lifetime_hit: int = 0
-    lifetime_miss: int = 0
 
     def __init__(self, func, parent) -> None:
         self.func = func
         self.parent = parent
+        _register_wrapper(self)
+
+    # Called when the wrapper is assigned in a class body, registers the owning class
+    def __set_name__(self, owner, name):
+        _register_owner(self, owner)
 
     def _get_partition_value(self, *args, **kwargs):
 
-        if isinstance(self.parent.partition_attr,int):
+        if self.parent.partition_attr == '':
+            partition_value = DEFAULT_PARTITION_VALUE
+        elif isinstance(self.parent.partition_attr,int):
             partition_value = str(args[self.parent.partition_attr])
         elif isinstance(self.parent.partition_attr,str):
             partition_value = str(kwargs.get(self.parent.partition_attr,DEFAULT_PARTITION_VALUE))
@@ -180,30 +1178,94 @@ class _CachianWrapper():
 
         return partition_value
 
-    def __call__(self, *args, **kwargs):
+    # Counts since the last reset() and since the cache was created
+    @property
+    def hit(self):
+        return self.parent.stats.since_reset(self.parent.stats.snapshot(), 'hits')
 
-        key = get_param_hash(*args, **kwargs)
-        partition_value = self._get_partition_value(*args, **kwargs)
+    @property
+    def miss(self):
+        return self.parent.stats.since_reset(self.parent.stats.snapshot(), 'misses')
 
-        result, ts = self.parent.has2(key, partition_value)
+    @property
+    def lifetime_hit(self):
+        return self.parent.stats.snapshot().hits
 
-        if result is not None:
-            self.hit += 1
-            self.lifetime_hit += 1
+    @property
+    def lifetime_miss(self):
+        return self.parent.stats.snapshot().misses
 
-            if self.parent.test_mode:
+    def __call__(self, *args, **kwargs):
+
+        parent = self.parent
+        if parent.metrics:
+            start = perf_counter_ns()
+
+        key = parent.key_func(*args, **kwargs)
+        if parent.partition_attr == '':
+            partition_value = DEFAULT_PARTITION_VALUE
+        else:
+            partition_value = self._get_partition_value(*args, **kwargs)
+
+        try:
+            result, ts = parent.has2(key, partition_value)
+        except Exception:
+            parent.stats.add('errors')
+            raise
+
+        # This thread's counters, see CacheStats
+        shard = getattr(parent.stats.local, 'shard', None) or parent.stats.shard()
+
+        if result is not MISS:
+            shard.hits += 1
+            if parent.metrics:
+                shard.hit_latency.record(perf_counter_ns() - start)
+
+            # Past its TTL but within stale_ttl, served while it's recomputed in the background
+            if parent.stale_ttl > 0 and parent.is_stale(result, ts):
+                parent.refresh(key, lambda: self._compute(key, partition_value, args, kwargs), partition_value)
+                if parent.test_mode:
+                    return 'stale'
+            elif parent.refresh_ahead > 0 and parent.refresh_due(key, result, ts, partition_value):
+                parent.refresh(key, lambda: self._compute(key, partition_value, args, kwargs), partition_value)
+
+            if parent.test_mode:
                 return 'hit'
+        elif parent.single_flight:
+            result, computed = parent.call_once(key, lambda: self._compute(key, partition_value, args, kwargs), partition_value)
+
+            # Callers that joined another caller's computation count as hits
+            if computed:
+                shard.misses += 1
+            else:
+                shard.hits += 1
+
+            if parent.test_mode:
+                return 'miss' if computed else 'hit'
         else:
-            result = self.func(*args, **kwargs)
-            self._add(key, result, partition_value)
-            self.miss += 1
-            self.lifetime_miss += 1
+            result = self._compute(key, partition_value, args, kwargs)
+            shard.misses += 1
 
-            if self.parent.test_mode:
+            if parent.test_mode:
                 return 'miss'
 
         return result
 
+    def _compute(self, key, partition_value, args, kwargs):
+        if self.parent.metrics:
+            start = perf_counter_ns()
+            result = self.func(*args, **kwargs)
+            self.parent.stats.shard().miss_latency.record(perf_counter_ns() - start)
+        else:
+            result = self.func(*args, **kwargs)
+
+        try:
+            self._add(key, result, partition_value)
+        except Exception:
+            self.parent.stats.add('errors')
+            raise
+        return result
+
     @property
     def __name__(self):
         return self.func.__name__
@@ -232,13 +1294,13 @@ class _CachianWrapper():
     def clear_all(self):
         self.parent.clear_all()
         get_param_hash.cache_clear()
+        get_compact_key.cache_clear()
 
         if self.parent.test_mode:
             return 'cleared'
 
     def reset(self):
-        self.hit = 0
-        self.miss = 0
+        self.parent.stats.reset()
         self.clear_all()
 
     def clear(self, partition_value):
@@ -249,55 +1311,355 @@ class _CachianWrapper():
             return 'cleared',removed
 
     def cache_info(self):
-        return {'lifetime_hit': self.lifetime_hit, 'hit': self.hit, 'lifetime_miss': self.lifetime_miss, 'miss': self.miss, 'size': len(self), 'ttl_seconds': self.parent.ttl, 'partition_attr': self.parent.partition_attr}
+        stats = self.parent.stats
+        snapshot = stats.snapshot()
+
+        info = {'lifetime_hit': snapshot.hits, 'hit': stats.since_reset(snapshot, 'hits'), 'lifetime_miss': snapshot.misses, 'miss': stats.since_reset(snapshot, 'misses'), 'size': len(self), 'ttl_seconds': self.parent.ttl, 'partition_attr': self.parent.partition_attr, 'swept': snapshot.swept,
+                'evictions': snapshot.evictions, 'expirations': snapshot.expirations, 'errors': snapshot.errors}
+
+        if self.parent.sketch is not None:
+            info['rejections'] = snapshot.rejections
+
+        if self.parent.stale_ttl > 0 or self.parent.refresh_ahead > 0:
+            info['refreshes'] = snapshot.refreshes
+            info['refresh_errors'] = snapshot.refresh_errors
+
+        if self.parent._sized:
+            info['bytes'] = self.parent.nbytes
+            info['maxbytes'] = self.parent.maxbytes
+
+        if self.parent.metrics:
+            info['hit_latency'] = snapshot.hit_latency.summary()
+            info['miss_latency'] = snapshot.miss_latency.summary()
+
+        return info
 
     def function_name(self):
         return self.func.__name__
 
+    def qualified_name(self):
+        return f'{self.func.__module__}.{getattr(self.func, "__qualname__", self.func.__name__)}'
+
+    def snapshot(self, path):
+        """Write this function's entries to a snapshot file. Returns the number of entries written."""
+
+        return write_snapshot(path, [(self.qualified_name(), self.parent.key_kind(), self.parent.snapshot_entries())])
+
+    def restore(self, path):
+        """Add this function's unexpired entries from a snapshot file. Returns the number restored."""
+
+        snapshot = Snapshot(path)
+        try:
+            return _restore_wrapper(snapshot, self)
+        finally:
+            snapshot.close()
+
+
+# Used without metrics, stale_ttl, refresh_ahead and single_flight, a hit only looks up
+# the key and counts itself
+class _PlainCachianWrapper(_CachianWrapper):
+
+    def __call__(self, *args, **kwargs):
+
+        parent = self.parent
+        key = parent.key_func(*args, **kwargs)
+        if parent.partition_attr == '':
+            partition_value = DEFAULT_PARTITION_VALUE
+        else:
+            partition_value = self._get_partition_value(*args, **kwargs)
+
+        try:
+            result, ts = parent.has2(key, partition_value)
+        except Exception:
+            parent.stats.add('errors')
+            raise
+
+        if result is not MISS:
+            (getattr(parent.stats.local, 'shard', None) or parent.stats.shard()).hits += 1
+            if parent.test_mode:
+                return 'hit'
+            return result
+
+        result = self._compute(key, partition_value, args, kwargs)
+        parent.stats.shard().misses += 1
+
+        if parent.test_mode:
+            return 'miss'
+        return result
+
+
+# Used for async def functions, caches the awaited result instead of the coroutine
+class _AsyncCachianWrapper(_CachianWrapper):
+
+    async def __call__(self, *args, **kwargs):
+
+        parent = self.parent
+        if parent.metrics:
+            start = perf_counter_ns()
+
+        key = parent.key_func(*args, **kwargs)
+        partition_value = self._get_partition_value(*args, **kwargs)
+
+        try:
+            result, ts = await parent.ahas2(key, partition_value)
+        except Exception:
+            parent.stats.add('errors')
+            raise
+
+        if result is not MISS:
+            shard = parent.stats.shard()
+            shard.hits += 1
+            if parent.metrics:
+                shard.hit_latency.record(perf_counter_ns() - start)
+
+            if parent.stale_ttl > 0 and parent.is_stale(result, ts):
+                parent.arefresh(key, lambda: self._acompute(key, partition_value, args, kwargs), partition_value)
+                if parent.test_mode:
+                    return 'stale'
+            elif parent.refresh_ahead > 0 and parent.refresh_due(key, result, ts, partition_value):
+                parent.arefresh(key, lambda: self._acompute(key, partition_value, args, kwargs), partition_value)
+
+            if parent.test_mode:
+                return 'hit'
+        else:
+            result, computed = await parent.acall_once(key, lambda: self._acompute(key, partition_value, args, kwargs), partition_value)
+
+            # Awaiters that joined another caller's computation count as hits
+            parent.stats.add('misses' if computed else 'hits')
+
+            if parent.test_mode:
+                return 'miss' if computed else 'hit'
+
+        return result
+
+    async def _acompute(self, key, partition_value, args, kwargs):
+        if self.parent.metrics:
+            start = perf_counter_ns()
+            result = await self.func(*args, **kwargs)
+            self.parent.stats.shard().miss_latency.record(perf_counter_ns() - start)
+        else:
+            result = await self.func(*args, **kwargs)
+
+        try:
+            await self.parent.aadd(key, (result, time()), partition_value)
+        except Exception:
+            self.parent.stats.add('errors')
+            raise
+        return result
+
+
+# Used with batch=True. The first argument is a collection of ids, each id is cached as if
+# the function was called with that id alone. The function is called once with the list of
+# missing ids and returns a mapping of id to result, ids it leaves out are cached as None,
+# or a sequence of results in the same order. Returns a dict of id to result.
+class _BatchCachianWrapper(_CachianWrapper):
+
+    def __call__(self, *args, **kwargs):
+        return self._call_batch(0, args, kwargs)
+
+    def __get__(self, instance, owner):
+        return partial(self._call_bound, instance)
+
+    def _call_bound(self, instance, *args, **kwargs):
+        return self._call_batch(1, (instance,) + args, kwargs)
+
+    def _batch_keys(self, position, args, kwargs):
+        ids = list(dict.fromkeys(args[position]))  # Drops duplicates, keeps order
+
+        keys = []
+        partition_values = []
+        for id in ids:
+            item_args = args[:position] + (id,) + args[position + 1:]
+            keys.append(self.parent.key_func(*item_args, **kwargs))
+            partition_values.append(self._get_partition_value(*item_args, **kwargs))
+
+        return ids, keys, partition_values
+
+    def _split(self, ids, found):
+        results = {}
+        missing = []
+        stale_ttl = self.parent.stale_ttl
+        for id, (result, ts) in zip(ids, found):
+            # Stale entries are recomputed with the missing ones rather than in the background
+            if result is MISS or (stale_ttl > 0 and self.parent.is_stale(result, ts)):
+                missing.append(id)
+            else:
+                results[id] = result
+
+        shard = self.parent.stats.shard()
+        shard.hits += len(results)
+        shard.misses += len(missing)
+
+        return results, missing
+
+    def _computed(self, missing, returned):
+        if isinstance(returned, Mapping):
+            return {id: returned.get(id) for id in missing}
+
+        returned = list(returned)
+        if len(returned) != len(missing):
+            raise ValueError(f'Batch function returned {len(returned)} results for {len(missing)} ids')
+        return dict(zip(missing, returned))
+
+    def _entries(self, ids, keys, partition_values, computed):
+        now = time()
+        return [(key, (computed[id], now), partition_value) for id, key, partition_value in zip(ids, keys, partition_values) if id in computed]
+
+    def _finish(self, ids, results, missing):
+        if self.parent.test_mode:
+            missing = set(missing)
+            return {id: 'miss' if id in missing else 'hit' for id in ids}
+
+        return {id: results[id] for id in ids}
+
+    def _call_batch(self, position, args, kwargs):
+
+        ids, keys, partition_values = self._batch_keys(position, args, kwargs)
+        try:
+            found = self.parent.has_many(keys, partition_values)
+        except Exception:
+            self.parent.stats.add('errors')
+            raise
+        results, missing = self._split(ids, found)
+
+        if missing:
+            if self.parent.metrics:
+                start = perf_counter_ns()
+                returned = self.func(*args[:position], missing, *args[position + 1:], **kwargs)
+                self.parent.stats.shard().miss_latency.record(perf_counter_ns() - start)
+            else:
+                returned = self.func(*args[:position], missing, *args[position + 1:], **kwargs)
+            computed = self._computed(missing, returned)
+
+            try:
+                self.parent.add_many(self._entries(ids, keys, partition_values, computed))
+            except Exception:
+                self.parent.stats.add('errors')
+                raise
+            results.update(computed)
+
+        return self._finish(ids, results, missing)
+
+
+# Batch mode for async def functions, lookups and writes are bulk operations where the backend has them
+class _AsyncBatchCachianWrapper(_BatchCachianWrapper):
+
+    async def _call_batch(self, position, args, kwargs):
+
+        ids, keys, partition_values = self._batch_keys(position, args, kwargs)
+        try:
+            found = await self.parent.ahas_many(keys, partition_values)
+        except Exception:
+            self.parent.stats.add('errors')
+            raise
+        results, missing = self._split(ids, found)
+
+        if missing:
+            computed = self._computed(missing, await self.func(*args[:position], missing, *args[position + 1:], **kwargs))
+            try:
+                await self.parent.aadd_many(self._entries(ids, keys, partition_values, computed))
+            except Exception:
+                self.parent.stats.add('errors')
+                raise
+            results.update(computed)
+
+        return self._finish(ids, results, missing)
+
+
+# Registry of live wrappers so the utilities below don't scan the GC heap. Wrappers are held
+# weakly and indexed by qualified name, with and without the module ('PatientDB.get_by_id',
+# 'app.db.PatientDB.get_by_id'), and by owning class, known once the class is created.
+_wrappers = weakref.WeakSet()
+_wrappers_by_name = {}
+_wrappers_by_class = {}
+_registry_lock = Lock()
+
+# Snapshot from global_restore(), functions decorated afterwards are restored from it when created
+_snapshot = None
+
+
+def _register_wrapper(wrapper):
+    names = (getattr(wrapper.func, '__qualname__', wrapper.function_name()), wrapper.qualified_name())
+
+    with _registry_lock:
+        _wrappers.add(wrapper)
+        for name in names:
+            _wrappers_by_name.setdefault(name, weakref.WeakSet()).add(wrapper)
+
+    snapshot = _snapshot
+    if snapshot is not None:
+        _restore_wrapper(snapshot, wrapper)
+
+
+def _restore_wrapper(snapshot, wrapper):
+    entries = snapshot.take(wrapper.qualified_name(), wrapper.parent.key_kind())
+    return wrapper.parent.restore_entries(entries) if entries else 0
+
+
+def _register_owner(wrapper, owner):
+    names = {owner.__name__, owner.__qualname__, f'{owner.__module__}.{owner.__qualname__}'}
+
+    with _registry_lock:
+        for name in names:
+            _wrappers_by_class.setdefault(name, weakref.WeakSet()).add(wrapper)
+
+
+def _find_wrappers(index, name):
+    with _registry_lock:
+        return list(index.get(name, ()))
+
 
 def get_all_wrappers():
 
-    wrappers = [
-        a for a in gc.get_objects()
-        if isinstance(a, _CachianWrapper)]
+    with _registry_lock:
+        return list(_wrappers)
+
+
+def get_wrappers_by_name(wrapper_name):
+
+    return _find_wrappers(_wrappers_by_name, wrapper_name)
 
-    return wrappers
+
+def get_wrappers_by_class(cls):
+
+    return _find_wrappers(_wrappers_by_class, cls if isinstance(cls, str) else f'{cls.__module__}.{cls.__qualname__}')
 
 
 def function_cache_clear_by_partition(wrapper_name, partition_value):
 
-    for wrapper in get_all_wrappers():
-        func_name = str(wrapper.func)
-        if wrapper_name in func_name:
-            wrapper.clear(partition_value)
+    for wrapper in get_wrappers_by_name(wrapper_name):
+        wrapper.clear(partition_value)
 
 
 def function_cache_reset_by_classname(clsname):
 
-    class_search_str = f'<function {clsname}.'
-
     func_names = []
 
-    for wrapper in get_all_wrappers():
-        func_name = str(wrapper.func)
-        if class_search_str in func_name:
-            wrapper.clear_all()
-            func_names.append(func_name)
+    for wrapper in get_wrappers_by_class(clsname):
+        wrapper.clear_all()
+        func_names.append(str(wrapper.func))
     
     return func_names
 
 
 def function_cache_reset_by_class(cls):
 
-    function_cache_reset_by_classname(cls.__name__)
+    func_names = []
+
+    for wrapper in get_wrappers_by_class(cls):
+        wrapper.clear_all()
+        func_names.append(str(wrapper.func))
+
+    return func_names
 
 
 def function_cache_reset(wrapper_name):
 
-    for wrapper in get_all_wrappers():
-        func_name = str(wrapper.func)
-        if wrapper_name in func_name:
-            return wrapper.clear_all()
+    result = None
+    for wrapper in get_wrappers_by_name(wrapper_name):
+        result = wrapper.clear_all()
+
+    return result
 
 
 def global_cache_reset():
@@ -323,3 +1685,84 @@ def global_cache_info():
         cache_infos[str(wrapper.func)].append(ci)
 
     return cache_infos
+
+
+def global_prometheus_metrics():
+    """Counters, entries and latency histograms of all cached functions in the Prometheus text format."""
+
+    return render_prometheus((wrapper.qualified_name(), wrapper.parent.stats.snapshot(), len(wrapper), wrapper.parent.metrics) for wrapper in get_all_wrappers())
+
+
+def global_snapshot(path):
+    """Write the entries of every cached function with an in-process store to a snapshot file.
+    Returns the number of entries written."""
+
+    return write_snapshot(path, ((wrapper.qualified_name(), wrapper.parent.key_kind(), wrapper.parent.snapshot_entries()) for wrapper in get_all_wrappers()))
+
+
+def global_restore(path):
+    """Restore a snapshot into the cached functions it was taken from, matched by qualified name.
+
+    Only the index is read here. Functions that exist are restored now, functions decorated
+    later when they are created. Returns the number of entries restored now, 0 when there's
+    no snapshot at path.
+    """
+
+    global _snapshot
+
+    try:
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        return 0
+
+    with _registry_lock:
+        previous, _snapshot = _snapshot, snapshot
+    if previous is not None:
+        previous.close()
+
+    return sum(_restore_wrapper(snapshot, wrapper) for wrapper in get_all_wrappers())
+
+
+_snapshot_stop = None
+_snapshot_at_exit = None
+
+
+def _snapshotter(path, interval, stop):
+    while not stop.wait(interval):
+        try:
+            global_snapshot(path)
+        except OSError:
+            pass  # Retried at the next interval
+
+
+def start_snapshots(path, interval=-1, at_exit=True):
+    """Write global snapshots to path every interval seconds when > 0, and at interpreter exit."""
+
+    global _snapshot_stop, _snapshot_at_exit
+
+    stop_snapshots()
+    if interval > 0:
+        _snapshot_stop = Event()
+        Thread(target=_snapshotter, args=(path, interval, _snapshot_stop), daemon=True, name='cachian-snapshot').start()
+    if at_exit:
+        _snapshot_at_exit = partial(global_snapshot, path)
+        atexit.register(_snapshot_at_exit)
+
+
+def stop_snapshots():
+    global _snapshot_stop, _snapshot_at_exit
+
+    if _snapshot_stop is not None:
+        _snapshot_stop.set()
+        _snapshot_stop = None
+    if _snapshot_at_exit is not None:
+        atexit.unregister(_snapshot_at_exit)
+        _snapshot_at_exit = None
+
+
+if CACHIAN_SNAPSHOT_PATH:
+    try:
+        global_restore(CACHIAN_SNAPSHOT_PATH)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        pass  # An unreadable snapshot means a cold start, it's replaced at the next snapshot
+    start_snapshots(CACHIAN_SNAPSHOT_PATH, CACHIAN_SNAPSHOT_INTERVAL)
@@ -0,0 +1,69 @@
+"""TinyLFU admission for bounded caches.
+
+A count-min sketch estimates how often each key was requested recently. When a
+full cache would evict an entry to make room for a new one, the new entry is
+only admitted if it was requested more often than the entry that would be
+evicted, so a burst of one-off keys such as a scan can't flush the working set.
+
+The sketch has 4 rows of 4-bit counters (stored a byte each), each row 4 times
+the cache's maxsize rounded up to a power of two (at least 256), so about 16
+bytes per entry of maxsize. After 10 * width recorded requests every counter is halved, so
+popularity fades and keys that stopped being requested can be replaced.
+
+Counters are updated without a lock. Concurrent updates can lose an increment,
+which only makes the estimate slightly lower.
+"""
+
+FREQUENCY_MAX = 15  # Counters saturate here
+_DEPTH = 4
+_MIN_WIDTH = 256  # Small caches would see hot keys collide with one-off keys in every row
+_MASK64 = (1 << 64) - 1
+# Odd 64-bit multipliers, one per row, to spread Python's hash() which is the value itself for ints
+_SEED0, _SEED1, _SEED2, _SEED3 = 0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93
+_HALVE = bytes(i >> 1 for i in range(256))
+
+ADMISSION_TINYLFU = 'tinylfu'
+
+
+class FrequencySketch():
+    """Count-min sketch of recent request frequency with periodic aging."""
+
+    def __init__(self, capacity):
+        width = _MIN_WIDTH
+        while width < 4 * capacity:
+            width <<= 1
+
+        self.width = width
+        self.shift = 64 - (width.bit_length() - 1)
+        self.table = bytearray(_DEPTH * width)
+        self.additions = 0
+        self.sample_size = 10 * width
+
+    # One counter per row, unrolled as this runs on every lookup
+    def _indexes(self, key):
+        h = hash(key)
+        shift = self.shift
+        width = self.width
+        return (((h * _SEED0) & _MASK64) >> shift,
+                width + (((h * _SEED1) & _MASK64) >> shift),
+                2 * width + (((h * _SEED2) & _MASK64) >> shift),
+                3 * width + (((h * _SEED3) & _MASK64) >> shift))
+
+    def increment(self, key):
+        table = self.table
+        for i in self._indexes(key):
+            if table[i] < FREQUENCY_MAX:
+                table[i] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key):
+        table = self.table
+        i0, i1, i2, i3 = self._indexes(key)
+        return min(table[i0], table[i1], table[i2], table[i3])
+
+    def age(self):
+        self.table = self.table.translate(_HALVE)
+        self.additions //= 2
@@ -0,0 +1,229 @@
+from pickle import dumps, HIGHEST_PROTOCOL
+# Fastest hash as per Python 3.9, next best is blake2b
+from hashlib import sha3_256 as hashfunc
+from functools import lru_cache
+from collections.abc import Mapping
+
+
+NUM_PARAM_HASH_CACHED: int = 10000
+DEFAULT_PARTITION_VALUE = '$$'
+KEY_SEPARATOR = '~'
+KEY_MODE_HASH = 'hash'
+KEY_MODE_FAST = 'fast'
+BUFFER_KEY_MIN_BYTES = 4096  # bytes arguments from this size are hashed from their buffer instead of pickled
+
+# Compact keys are the first 128 bits of the digest as an int, the partition id is
+# stored in the bits above so a partitioned key is still a single int
+COMPACT_KEY_BITS = 128
+
+# Separates positional from keyword arguments in fast keys, same as functools.lru_cache
+_KWARGS_MARK = (object(),)
+_FAST_KEY_TYPES = {int, str}
+
+# Canonical forms of unhashable containers are tagged so [1, 2] and (1, 2) get different keys
+_LIST_TAG = '__cachian_list__'
+_DICT_TAG = '__cachian_dict__'
+_SET_TAG = '__cachian_set__'
+_BUFFER_TAG = '__cachian_buffer__'
+_CANONICAL_TAG = '__cachian_canonical__'
+_PICKLE_TAG = '__cachian_pickle__'
+_ATOMIC_TYPES = {int, str, float, bool, type(None)}
+
+_key_functions = {}
+
+
+# Miss signal for stores and Cachian.has2() so None results can be cached.
+# Pickled by reference so it keeps its identity across processes.
+class _Miss():
+
+    def __repr__(self):
+        return 'MISS'
+
+    def __reduce__(self):
+        return 'MISS'
+
+
+MISS = _Miss()
+
+
+# Pickled arguments, large bytes are replaced by their buffer key so they aren't copied into the pickle
+def _dumps_args(args, kwargs):
+    if any(type(a) is bytes and len(a) >= BUFFER_KEY_MIN_BYTES for a in args):
+        args = tuple(_bytes_key(a) for a in args)
+    if any(type(a) is bytes and len(a) >= BUFFER_KEY_MIN_BYTES for a in kwargs.values()):
+        kwargs = {k: _bytes_key(a) for k, a in kwargs.items()}
+
+    return dumps(args, HIGHEST_PROTOCOL) + dumps(kwargs, HIGHEST_PROTOCOL)
+
+
+def _bytes_key(obj):
+    if type(obj) is bytes and len(obj) >= BUFFER_KEY_MIN_BYTES:
+        return _buffer_key(obj, memoryview(obj))
+    return obj
+
+
+@lru_cache(NUM_PARAM_HASH_CACHED)
+def get_param_hash(*args, **kwargs):
+
+    m = hashfunc()
+    m.update(_dumps_args(args, kwargs))
+
+    return m.hexdigest()
+
+
+# Compact key for in-process stores, an int instead of a 64 character hex string
+@lru_cache(NUM_PARAM_HASH_CACHED)
+def get_compact_key(*args, **kwargs):
+
+    m = hashfunc()
+    m.update(_dumps_args(args, kwargs))
+
+    return int.from_bytes(m.digest()[:COMPACT_KEY_BITS // 8], 'little')
+
+
+# Tuple based key for in-process stores, avoids pickling and hashing to a digest.
+# Like functools.lru_cache, 1 and 1.0 map to the same key.
+def get_fast_key(*args, **kwargs):
+
+    if kwargs:
+        return args + _KWARGS_MARK + tuple(kwargs.items())
+
+    if len(args) == 1 and type(args[0]) in _FAST_KEY_TYPES:
+        return args[0]
+
+    return args
+
+
+# Partition of a full key, either a (partition_value, key) tuple, a 'partition_value~hash' string
+# or a compact int key, whose partition is the id the cache assigned to the partition value
+def key_partition(full_key):
+    if type(full_key) is tuple:
+        return full_key[0]
+    if type(full_key) is int:
+        partition_id = full_key >> COMPACT_KEY_BITS
+        return partition_id if partition_id else DEFAULT_PARTITION_VALUE
+    return full_key.rpartition(KEY_SEPARATOR)[0]
+
+
+def register_key_function(cls, func):
+    """Use func(obj) to build the key for arguments of type cls.
+
+    The result is canonicalized again, so it can be any value supported as an argument,
+    eg. a numpy array of row hashes for a DataFrame.
+    """
+    _key_functions[cls] = func
+
+
+def unregister_key_function(cls):
+    _key_functions.pop(cls, None)
+
+
+def _has_registered_type(args, kwargs):
+    for a in args:
+        if type(a) in _key_functions:
+            return True
+    for a in kwargs.values():
+        if type(a) in _key_functions:
+            return True
+    return False
+
+
+def _sorted(items):
+    try:
+        return sorted(items)
+    except TypeError:
+        return sorted(items, key=repr)  # Mixed types that can't be compared
+
+
+# Hash buffers such as bytearray or numpy arrays straight from their memory without pickling a copy
+def _buffer_key(obj, view):
+
+    m = hashfunc()
+    if view.c_contiguous:
+        m.update(view)
+    else:
+        m.update(view.tobytes())  # Strided buffers have to be copied to be hashed
+
+    return (_BUFFER_TAG, type(obj).__qualname__, view.format, view.shape, m.hexdigest())
+
+
+def canonicalize(obj):
+    """Convert obj into a hashable, picklable value that is equal for equal arguments."""
+
+    t = type(obj)
+
+    if t in _ATOMIC_TYPES:
+        return obj
+
+    key_function = _key_functions.get(t)
+    if key_function is not None:
+        return (f'{t.__module__}.{t.__qualname__}', canonicalize(key_function(obj)))
+
+    if t is tuple:
+        return tuple(canonicalize(o) for o in obj)
+    if isinstance(obj, list):
+        return (_LIST_TAG,) + tuple(canonicalize(o) for o in obj)
+    if isinstance(obj, Mapping):
+        return (_DICT_TAG,) + tuple(_sorted((canonicalize(k), canonicalize(v)) for k, v in obj.items()))
+    if isinstance(obj, (set, frozenset)):
+        return (_SET_TAG,) + tuple(_sorted(canonicalize(o) for o in obj))
+
+    try:
+        view = memoryview(obj)
+    except (TypeError, ValueError):  # ValueError for dtypes without a buffer format, eg. datetime64
+        pass
+    else:
+        if view.format != 'O':  # Object arrays hold pointers, not values
+            return _buffer_key(obj, view)
+
+    # Subclasses of registered types
+    for cls in t.__mro__[1:]:
+        key_function = _key_functions.get(cls)
+        if key_function is not None:
+            return (f'{cls.__module__}.{cls.__qualname__}', canonicalize(key_function(obj)))
+
+    try:
+        hash(obj)
+        return obj  # Left as is for hashing/pickling
+    except TypeError:
+        pass
+
+    # Unhashable without a canonical form, eg. numpy object arrays, keyed by the digest of its pickle
+    return (_PICKLE_TAG, f'{t.__module__}.{t.__qualname__}', hashfunc(dumps(obj, HIGHEST_PROTOCOL)).hexdigest())
+
+
+# Key pipelines used by Cachian. Hashable arguments take the cached fast path,
+# unhashable ones and registered types are canonicalized first.
+def build_param_hash(*args, **kwargs):
+
+    if not _key_functions or not _has_registered_type(args, kwargs):
+        try:
+            return get_param_hash(*args, **kwargs)
+        except TypeError:
+            pass
+
+    return get_param_hash(*canonicalize(args), **{k: canonicalize(v) for k, v in kwargs.items()})
+
+
+def build_compact_key(*args, **kwargs):
+
+    if not _key_functions or not _has_registered_type(args, kwargs):
+        try:
+            return get_compact_key(*args, **kwargs)
+        except TypeError:
+            pass
+
+    return get_compact_key(*canonicalize(args), **{k: canonicalize(v) for k, v in kwargs.items()})
+
+
+def build_fast_key(*args, **kwargs):
+
+    if not _key_functions or not _has_registered_type(args, kwargs):
+        key = get_fast_key(*args, **kwargs)
+        try:
+            hash(key)
+            return key
+        except TypeError:
+            pass
+
+    return (_CANONICAL_TAG, canonicalize(args), canonicalize(kwargs))
@@ -1,19 +1,51 @@
+from collections import OrderedDict
+from threading import Lock
 from collections.abc import MutableMapping
+from .keys import key_partition, MISS, DEFAULT_PARTITION_VALUE
 
 
 class MemoryStore(MutableMapping):
 
+    in_process = True  # Keys don't need to be serializable
+
     def __init__(self) -> None:
-        self.cache_lib = {}
+        # OrderedDict keeps entries in recency order with O(1) promote/evict
+        self.cache_lib = OrderedDict()
+
+        # Partition value -> keys, so clearing a partition doesn't scan every entry.
+        # The default partition isn't indexed as it usually holds everything. Shared by
+        # all lock stripes, so it has its own lock.
+        self.partitions = {}
+        self._partitions_lock = Lock()
+
+        # Bind hot path lookups directly to the OrderedDict to skip a Python level call
+        self.get = self.cache_lib.get
+        self.touch = self.cache_lib.move_to_end
+
+        # Entry sizes for maxbytes, only kept once track_size() is called
+        self.sizes = None
+        self.nbytes = 0
+        self._size_lock = Lock()
 
     def __getitem__(self, key):
-        return self.cache_lib.get(key)
+        return self.cache_lib[key]
 
     def __setitem__(self, key, value):
         self.cache_lib[key] = value
 
+        partition = key[0] if type(key) is tuple else key_partition(key)
+        if partition != DEFAULT_PARTITION_VALUE:
+            with self._partitions_lock:
+                keys = self.partitions.get(partition)
+                if keys is None:
+                    keys = self.partitions[partition] = set()
+                keys.add(key)
+
     def __delitem__(self, key):
         del self.cache_lib[key]
+        self._unindex(key)
+        if self.sizes is not None:
+            self._release(key)
     
     def __contains__(self, key):
         return key in self.cache_lib
@@ -22,4 +54,109 @@ class MemoryStore(MutableMapping):
         return len(self.cache_lib)
     
     def __iter__(self):
-        return iter(self.cache_lib)
\ No newline at end of file
+        return iter(self.cache_lib)
+
+    def items(self):
+        return self.cache_lib.items()
+
+    def _unindex(self, key):
+        partition = key[0] if type(key) is tuple else key_partition(key)
+        if partition == DEFAULT_PARTITION_VALUE:
+            return
+
+        with self._partitions_lock:
+            keys = self.partitions.get(partition)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.partitions[partition]
+
+    def get_many(self, keys):
+        get = self.cache_lib.get
+        return [get(key, MISS) for key in keys]
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self[key] = value
+
+    def pop(self, key, *args):
+        value = self.cache_lib.pop(key, *args)
+        self._unindex(key)
+        if self.sizes is not None:
+            self._release(key)
+        return value
+
+    # Key evict() would remove next
+    def victim(self):
+        return next(iter(self.cache_lib), None)
+
+    # Remove the oldest entry, ie. least recently used when touch() is used on hits
+    # or first inserted otherwise
+    def evict(self):
+        if type(self.cache_lib) is dict:
+            key = next(iter(self.cache_lib))
+            value = self.cache_lib.pop(key)
+        else:
+            key, value = self.cache_lib.popitem(last=False)
+        self._unindex(key)
+        if self.sizes is not None:
+            self._release(key)
+        return key, value
+
+    # Remove up to count entries in evict() order, returns the number removed
+    def evict_many(self, count):
+        evicted = 0
+        while evicted < count and self.cache_lib:
+            self.evict()
+            evicted += 1
+        return evicted
+
+    def remove_partition(self, partition_value):
+        if partition_value == DEFAULT_PARTITION_VALUE:
+            keys = [key for key in self.cache_lib if key_partition(key) == partition_value]
+        else:
+            with self._partitions_lock:
+                keys = self.partitions.pop(partition_value, ())
+
+        removed = 0
+        for key in keys:
+            if self.cache_lib.pop(key, MISS) is not MISS:
+                removed += 1
+                if self.sizes is not None:
+                    self._release(key)
+
+        return removed
+
+    def clear(self):
+        self.cache_lib.clear()
+        with self._partitions_lock:
+            self.partitions.clear()
+
+        if self.sizes is not None:
+            with self._size_lock:
+                self.sizes.clear()
+                self.nbytes = 0
+
+    def compact(self, ordered=True):
+        """Use a plain dict when entries are never evicted, it needs about half the memory per
+        entry of an OrderedDict but can't track recency. Only switches while empty."""
+
+        if not ordered and not self.cache_lib:
+            self.cache_lib = {}
+            self.get = self.cache_lib.get
+            self.touch = None
+
+    def track_size(self):
+        """Keep the total of entry sizes reported with set_size() in nbytes."""
+
+        if self.sizes is None:
+            self.sizes = {}
+
+    def set_size(self, key, size):
+        with self._size_lock:
+            self.nbytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+
+    def _release(self, key):
+        with self._size_lock:
+            self.nbytes -= self.sizes.pop(key, 0)
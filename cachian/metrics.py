@@ -0,0 +1,248 @@
+"""Thread-safe counters and latency histograms for cached functions.
+
+Every thread writes to its own shard, so counting a hit is a plain attribute
+increment without a lock and no increments are lost between threads. Reads sum
+the shards. Shards of finished threads are folded into a retired total when a
+new thread starts counting, so thread churn doesn't grow the shard list.
+
+Latencies are kept in HDR-style histograms of nanoseconds: values below 32ns are
+exact, above that each power of two is split into 16 buckets, so quantiles are
+within ~6% of the recorded values whatever their magnitude.
+
+Counters:
+    hits, misses    Calls served from the cache and calls that ran the function
+    evictions       Entries removed to stay within maxsize
+    expirations     Entries found expired on lookup or reclaimed by the sweeper
+    swept           Entries reclaimed by the sweeper, also counted as expirations
+    errors          Exceptions raised by the store
+    rejections      New entries not cached by the admission policy
+    refreshes       Entries recomputed in the background
+    refresh_errors  Background recomputations that raised, the old entry is kept
+
+Latencies, recorded when Cachian(metrics=True) or CACHIAN_METRICS=1:
+    hit_latency     Whole call for hits, including building the key
+    miss_latency    Time spent in the cached function on misses
+"""
+
+from threading import Lock, current_thread, local
+import os
+
+
+CACHIAN_METRICS = int(os.getenv('CACHIAN_METRICS', '0')) == 1
+
+COUNTERS = ('hits', 'misses', 'evictions', 'expirations', 'swept', 'errors', 'rejections', 'refreshes', 'refresh_errors')
+LATENCIES = ('hit_latency', 'miss_latency')
+
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_EXACT_LIMIT = _SUB_BUCKETS * 2
+
+# Upper bounds of the exported Prometheus histogram buckets, in seconds
+PROMETHEUS_BUCKETS = (1e-06, 5e-06, 1e-05, 5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+def _bucket_bounds(index):
+    if index < _EXACT_LIMIT:
+        return index, index
+
+    exponent = (index >> _SUB_BUCKET_BITS) - 1
+    lower = (index - (exponent << _SUB_BUCKET_BITS)) << exponent
+    return lower, lower + (1 << exponent) - 1
+
+
+class Histogram():
+    """Log-linear histogram of durations in nanoseconds."""
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+
+    def record(self, ns):
+        if ns < _EXACT_LIMIT:
+            index = ns if ns > 0 else 0
+        else:
+            exponent = ns.bit_length() - _SUB_BUCKET_BITS - 1
+            index = (exponent << _SUB_BUCKET_BITS) + (ns >> exponent)
+
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.total += ns
+
+    def merge(self, other):
+        # copy() is a single C call, safe while the owning thread keeps recording
+        for index, count in other.counts.copy().items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+
+    # Value at quantile q (0-1) in nanoseconds, the middle of the bucket it falls in
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+
+        rank = max(1, q * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                lower, upper = _bucket_bounds(index)
+                return (lower + upper) // 2
+
+        return _bucket_bounds(max(self.counts))[1]
+
+    def max(self):
+        if not self.counts:
+            return 0
+        return _bucket_bounds(max(self.counts))[1]
+
+    # Number of values at or below each bound in nanoseconds, to bucket precision
+    def cumulative(self, bounds):
+        indexes = sorted(self.counts)
+        results = []
+        seen = 0
+        i = 0
+        for bound in bounds:
+            while i < len(indexes) and _bucket_bounds(indexes[i])[0] <= bound:
+                seen += self.counts[indexes[i]]
+                i += 1
+            results.append(seen)
+        return results
+
+    def summary(self):
+        """Count, mean and quantiles in seconds."""
+
+        mean = self.total / self.count if self.count else 0
+        return {'count': self.count, 'mean': mean / 1e9, 'p50': self.quantile(0.5) / 1e9, 'p90': self.quantile(0.9) / 1e9, 'p99': self.quantile(0.99) / 1e9, 'p999': self.quantile(0.999) / 1e9, 'max': self.max() / 1e9}
+
+
+class _Shard():
+
+    __slots__ = COUNTERS + LATENCIES
+
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        for name in LATENCIES:
+            setattr(self, name, Histogram())
+
+    def merge(self, other):
+        for name in COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in LATENCIES:
+            getattr(self, name).merge(getattr(other, name))
+
+
+class CacheStats():
+    """Per-thread sharded counters and latency histograms of one cache.
+
+    The hot path gets its shard with `getattr(stats.local, 'shard', None) or stats.shard()`
+    and increments it directly, other code uses add().
+    """
+
+    def __init__(self):
+        self.local = local()
+        self._shards = []  # (thread, shard)
+        self._retired = _Shard()
+        self._baseline = {'hits': 0, 'misses': 0}
+        self._lock = Lock()
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is not None:
+            return shard
+
+        shard = self.local.shard = _Shard()
+        thread = current_thread()
+
+        with self._lock:
+            # A finished thread won't write to its shard again, fold it into the retired total
+            shards = []
+            for owner, owned in self._shards:
+                if owner.is_alive():
+                    shards.append((owner, owned))
+                else:
+                    self._retired.merge(owned)
+            shards.append((thread, shard))
+            self._shards = shards
+
+        return shard
+
+    def add(self, name, n=1):
+        shard = self.shard()
+        setattr(shard, name, getattr(shard, name) + n)
+
+    def snapshot(self):
+        """Totals of all shards since the cache was created, as a single shard."""
+
+        total = _Shard()
+        with self._lock:
+            total.merge(self._retired)
+            for owner, shard in self._shards:
+                total.merge(shard)
+        return total
+
+    # hits and misses can be reset, the lifetime totals are kept
+    def reset(self):
+        snapshot = self.snapshot()
+        self._baseline = {'hits': snapshot.hits, 'misses': snapshot.misses}
+
+    def since_reset(self, snapshot, name):
+        return getattr(snapshot, name) - self._baseline[name]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_prometheus(samples):
+    """Prometheus text exposition of (function name, snapshot, size, latency enabled) samples.
+
+    Samples with the same function name, eg. a function decorated again, are summed.
+    """
+
+    functions = {}
+    for name, snapshot, size, latency in samples:
+        entry = functions.get(name)
+        if entry is None:
+            functions[name] = [snapshot, size, latency]
+        else:
+            entry[0].merge(snapshot)
+            entry[1] += size
+            entry[2] = entry[2] or latency
+
+    lines = []
+
+    def header(metric, kind, help):
+        lines.append(f'# HELP {metric} {help}')
+        lines.append(f'# TYPE {metric} {kind}')
+
+    for counter, help in (('hits', 'Calls served from the cache.'), ('misses', 'Calls that ran the cached function.'), ('evictions', 'Entries evicted to stay within maxsize.'), ('expirations', 'Entries removed after their TTL.'), ('errors', 'Exceptions raised by the cache store.')):
+        metric = f'cachian_{counter}_total'
+        header(metric, 'counter', help)
+        for name, (snapshot, size, latency) in functions.items():
+            lines.append(f'{metric}{{function="{_escape(name)}"}} {getattr(snapshot, counter)}')
+
+    header('cachian_entries', 'gauge', 'Entries currently cached.')
+    for name, (snapshot, size, latency) in functions.items():
+        lines.append(f'cachian_entries{{function="{_escape(name)}"}} {size}')
+
+    bounds = [int(bound * 1e9) for bound in PROMETHEUS_BUCKETS]
+    for histogram_name, metric, help in (('hit_latency', 'cachian_hit_duration_seconds', 'Duration of calls served from the cache.'), ('miss_latency', 'cachian_miss_duration_seconds', 'Time spent in the cached function on misses.')):
+        header(metric, 'histogram', help)
+        for name, (snapshot, size, latency) in functions.items():
+            if not latency:
+                continue
+
+            histogram = getattr(snapshot, histogram_name)
+            label = f'function="{_escape(name)}"'
+            for bound, count in zip(PROMETHEUS_BUCKETS, histogram.cumulative(bounds)):
+                lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{{label}}} {histogram.total / 1e9}')
+            lines.append(f'{metric}_count{{{label}}} {histogram.count}')
+
+    return '\n'.join(lines) + '\n'
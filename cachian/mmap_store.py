@@ -0,0 +1,511 @@
+"""Shared memory hash table store, cache hits are local memory reads.
+
+Entries live in a memory mapped file, by default under /dev/shm, that every
+process maps. Unlike SharedMemoryStore there is no server process, a hit is a
+hash table probe and an unpickle in the calling process.
+
+Usage:
+    from cachian import Cachian
+    from cachian.mmap_store import MmapStore
+
+    @Cachian(cache_class=MmapStore, ttl=60, maxsize=10000)
+    def my_function(x):
+        return expensive_computation(x)
+
+Layout:
+    header  Magic, slot count, arena size, arena top, entry count, evictions and
+            the free list head of each block size class
+    slots   Open addressing index with linear probing, one 64 byte slot per entry
+            holding a sequence counter, key hash, partition hash, expiry time, last
+            access time and the entry's block in the arena
+    arena   Key and pickled value of each entry in a block of 64 << n bytes, freed
+            blocks go on the free list of their size class
+
+Readers don't lock. They read a slot and its block, then check the slot's
+sequence counter is unchanged, retrying otherwise (a seqlock). Writers hold an
+fcntl lock on the file and keep the counter odd while a slot changes. Deletes
+shift the following entries back instead of leaving tombstones, so a reader
+racing a delete can see a false miss but never a wrong value.
+
+When the entry count reaches maxsize (or 3/4 of the slots), or no block of the
+needed size is free, the inserting process evicts from a sample of entries,
+expired entries first, then the least recently used (or oldest with FIFO).
+
+Each cached function has its own file named after its qualified name. The first
+process to create it sizes it from maxsize, later ones use the size in the
+header. Files are kept across restarts, unlink() removes one.
+
+Environment variables:
+    CACHIAN_MMAP_DIR:   Directory for table files (default: /dev/shm, or the temp dir)
+    CACHIAN_MMAP_SLOTS: Slots per table when maxsize isn't set (default: 65536)
+    CACHIAN_MMAP_ARENA: Arena bytes per table (default: 64MB)
+
+Note: Unix only (fcntl). Values must be picklable, len() counts expired entries
+until they are evicted.
+"""
+
+import fcntl
+import mmap
+import os
+import pickle
+import random
+import re
+import struct
+import tempfile
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from threading import Lock
+from time import time, sleep
+from .keys import key_partition, MISS
+
+
+CACHIAN_MMAP_DIR = os.getenv('CACHIAN_MMAP_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+CACHIAN_MMAP_SLOTS = int(os.getenv('CACHIAN_MMAP_SLOTS', '65536'))
+CACHIAN_MMAP_ARENA = int(os.getenv('CACHIAN_MMAP_ARENA', str(64 * 1024 * 1024)))
+
+_MAGIC = b'CACHIAN1'
+_HEADER = struct.Struct('<8sQQQQQ')  # Magic, slots, arena size, arena top, count, evictions
+_HEADER_SIZE = 4096
+_TOP_OFFSET = 24
+_COUNT_OFFSET = 32
+_EVICTIONS_OFFSET = 40
+_FREE_OFFSET = 48  # Free list heads, block offset + 1 so 0 is an empty list
+_NUM_CLASSES = 24
+_MIN_BLOCK_BITS = 6  # 64 byte blocks
+
+# Sequence, last access, block offset, hash, partition hash, state, size class, key length, value length, expire at
+_SLOT = struct.Struct('<QdQIIHHIId12x')
+_SLOT_SIZE = _SLOT.size
+_U64 = struct.Struct('<Q')
+_F64 = struct.Struct('<d')
+
+_EMPTY = 0
+_USED = 1
+_EMPTY_FIELDS = (0.0, 0, 0, 0, _EMPTY, 0, 0, 0, 0.0)
+
+_MAX_LOAD = 0.75
+_MAX_READ_RETRIES = 10000  # A writer that died mid-write leaves its slot odd, give up eventually
+_EVICTION_SAMPLE = 8
+_MAX_ALLOC_EVICTIONS = 64
+_FLIGHT_LOCK_BASE = 1 << 32  # Flight locks are fcntl locks on bytes past the end of the file
+
+
+class MmapStore(MutableMapping):
+    """Hash table in a memory mapped file shared by every process on the host.
+
+    Cachian passes its maxsize, ttl and eviction settings through configure() and
+    uses lookup()/insert(), which enforce them in the table.
+    """
+
+    def __init__(self, name=None, path=None, slots=None, arena_size=None):
+        self.name = name or 'default'
+        self._fixed_name = name is not None or path is not None
+        self._path = path
+        self._slots = slots
+        self._arena_size = arena_size or CACHIAN_MMAP_ARENA
+
+        self.maxsize = -1
+        self.ttl = -1
+        self.track_recency = True
+
+        self._mm = None
+        self._fd = None
+        self._lock = Lock()
+
+    def set_namespace(self, namespace):
+        if not self._fixed_name:
+            self.name = namespace
+
+    def configure(self, maxsize=-1, ttl=-1, eviction='lru'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.track_recency = eviction == 'lru'
+
+    @property
+    def path(self):
+        if self._path is not None:
+            return self._path
+        safe_name = re.sub(r'[^A-Za-z0-9._-]', '_', self.name)[:100]
+        return os.path.join(CACHIAN_MMAP_DIR, f'cachian-{safe_name}-{zlib.crc32(self.name.encode()):08x}.table')
+
+    # The table is opened on first use, after Cachian has set the namespace
+    def _open(self):
+        with self._lock:
+            if self._mm is not None:
+                return self._mm
+
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                header = os.pread(fd, _HEADER.size, 0)
+                if len(header) == _HEADER.size and header[:8] == _MAGIC:
+                    _, slots, arena_size, _, _, _ = _HEADER.unpack(header)
+                else:
+                    slots = self._initial_slots()
+                    arena_size = self._arena_size
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, _HEADER_SIZE + slots * _SLOT_SIZE + arena_size)
+                    os.pwrite(fd, _HEADER.pack(_MAGIC, slots, arena_size, 0, 0, 0), 0)
+
+                mm = mmap.mmap(fd, _HEADER_SIZE + slots * _SLOT_SIZE + arena_size)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+
+            self._fd = fd
+            self._mask = slots - 1
+            self._slots_offset = _HEADER_SIZE
+            self._arena_offset = _HEADER_SIZE + slots * _SLOT_SIZE
+            self._arena_size = arena_size
+            self._mm = mm
+            return mm
+
+    def _initial_slots(self):
+        slots = self._slots or CACHIAN_MMAP_SLOTS
+        if self._slots is None and self.maxsize > 0:
+            slots = int(self.maxsize / _MAX_LOAD) + 1
+        return 1 << max(6, (slots - 1).bit_length())  # Power of two so the mask works
+
+    def _limit(self):
+        limit = int((self._mask + 1) * _MAX_LOAD)
+        if self.maxsize > 0:
+            return min(limit, self.maxsize)
+        return limit
+
+    @contextmanager
+    def _write_lock(self):
+        mm = self._mm or self._open()
+        # fcntl locks are per process, the thread lock covers threads of this process
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                yield mm
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    # Lock free read, MISS when the key doesn't exist or has expired
+    def lookup(self, key):
+        mm = self._mm or self._open()
+
+        key_bytes = key.encode()
+        key_length = len(key_bytes)
+        key_hash = zlib.crc32(key_bytes)
+        mask = self._mask
+        slots_offset = self._slots_offset
+        arena_offset = self._arena_offset
+        unpack_slot = _SLOT.unpack_from
+        unpack_seq = _U64.unpack_from
+
+        index = key_hash & mask
+        probes = 0
+        retries = 0
+        while probes <= mask:
+            offset = slots_offset + index * _SLOT_SIZE
+            slot = unpack_slot(mm, offset)
+            seq = slot[0]
+            if retries > _MAX_READ_RETRIES:
+                return MISS
+            if seq & 1:
+                retries += 1
+                sleep(0)  # A writer is changing the slot
+                continue
+
+            if slot[5] == _EMPTY:
+                if unpack_seq(mm, offset)[0] != seq:
+                    retries += 1
+                    continue
+                return MISS
+
+            if slot[3] == key_hash and slot[7] == key_length:
+                start = arena_offset + slot[2]
+                data = mm[start:start + key_length + slot[8]]
+                if unpack_seq(mm, offset)[0] != seq:
+                    retries += 1
+                    continue
+
+                if data[:key_length] == key_bytes:
+                    now = time()
+                    expire_at = slot[9]
+                    if expire_at and now > expire_at:
+                        return MISS
+                    if self.track_recency:
+                        _F64.pack_into(mm, offset + 8, now)
+                    return pickle.loads(memoryview(data)[key_length:])
+
+            index = (index + 1) & mask
+            probes += 1
+
+        return MISS
+
+    # Set with TTL, evicting for maxsize or arena space first
+    def insert(self, key, value, ttl=None):
+        key_bytes = key.encode()
+        value_bytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        key_hash = zlib.crc32(key_bytes)
+        partition_hash = zlib.crc32(key_partition(key).encode())
+
+        ttl = self.ttl if ttl is None else ttl
+        now = time()
+        expire_at = now + ttl if ttl > 0 else 0.0
+
+        with self._write_lock() as mm:
+            index, found = self._find(mm, key_bytes, key_hash)
+            if not found:
+                limit = self._limit()
+                while _U64.unpack_from(mm, _COUNT_OFFSET)[0] >= limit and self._evict(mm):
+                    pass
+
+            block, size_class = self._alloc(mm, len(key_bytes) + len(value_bytes))
+
+            # Evictions may have moved entries
+            index, found = self._find(mm, key_bytes, key_hash)
+            if block is None:
+                # Too large for the arena, don't leave an older value behind
+                if found:
+                    self._delete_index(mm, index)
+                return
+
+            start = self._arena_offset + block
+            mm[start:start + len(key_bytes)] = key_bytes
+            mm[start + len(key_bytes):start + len(key_bytes) + len(value_bytes)] = value_bytes
+
+            old = self._slot(mm, index) if found else None
+            self._write_slot(mm, index, now, block, key_hash, partition_hash, _USED, size_class, len(key_bytes), len(value_bytes), expire_at)
+
+            if found:
+                self._free(mm, old[2], old[6])
+            else:
+                self._add_count(mm, 1)
+
+    def _slot(self, mm, index):
+        return _SLOT.unpack_from(mm, self._slots_offset + index * _SLOT_SIZE)
+
+    # Sequence goes odd while the slot changes, then even again. Also recovers slots
+    # left odd by a writer that died.
+    def _write_slot(self, mm, index, *fields):
+        offset = self._slots_offset + index * _SLOT_SIZE
+        seq = (_U64.unpack_from(mm, offset)[0] + 1) | 1
+        _U64.pack_into(mm, offset, seq)
+        _SLOT.pack_into(mm, offset, seq, *fields)
+        _U64.pack_into(mm, offset, seq + 1)
+
+    def _add_count(self, mm, delta):
+        _U64.pack_into(mm, _COUNT_OFFSET, _U64.unpack_from(mm, _COUNT_OFFSET)[0] + delta)
+
+    def _key_at(self, mm, slot):
+        start = self._arena_offset + slot[2]
+        return mm[start:start + slot[7]]
+
+    # Writers only. Returns the key's slot, or the empty slot it would go in
+    def _find(self, mm, key_bytes, key_hash):
+        mask = self._mask
+        index = key_hash & mask
+        for _ in range(mask + 1):
+            slot = self._slot(mm, index)
+            if slot[5] == _EMPTY:
+                return index, False
+            if slot[3] == key_hash and slot[7] == len(key_bytes) and self._key_at(mm, slot) == key_bytes:
+                return index, True
+            index = (index + 1) & mask
+        return index, False
+
+    def _alloc(self, mm, size):
+        size_class = max(0, (size - 1).bit_length() - _MIN_BLOCK_BITS)
+        block_size = 1 << (size_class + _MIN_BLOCK_BITS)
+        if size_class >= _NUM_CLASSES or block_size > self._arena_size:
+            return None, size_class
+
+        head_offset = _FREE_OFFSET + size_class * 8
+        for _ in range(_MAX_ALLOC_EVICTIONS):
+            head = _U64.unpack_from(mm, head_offset)[0]
+            if head:
+                block = head - 1
+                _U64.pack_into(mm, head_offset, _U64.unpack_from(mm, self._arena_offset + block)[0])
+                return block, size_class
+
+            top = _U64.unpack_from(mm, _TOP_OFFSET)[0]
+            if top + block_size <= self._arena_size:
+                _U64.pack_into(mm, _TOP_OFFSET, top + block_size)
+                return top, size_class
+
+            if not self._evict(mm):
+                break
+
+        return None, size_class
+
+    def _free(self, mm, block, size_class):
+        head_offset = _FREE_OFFSET + size_class * 8
+        _U64.pack_into(mm, self._arena_offset + block, _U64.unpack_from(mm, head_offset)[0])
+        _U64.pack_into(mm, head_offset, block + 1)
+
+    # Sampled eviction from a random position, expired entries go first
+    def _evict(self, mm):
+        mask = self._mask
+        index = random.getrandbits(32) & mask
+        now = time()
+        victim = None
+        oldest = None
+        sampled = 0
+
+        for _ in range(mask + 1):
+            slot = self._slot(mm, index)
+            if slot[5] == _USED:
+                if slot[9] and now > slot[9]:
+                    victim = index
+                    break
+                if oldest is None or slot[1] < oldest:
+                    oldest = slot[1]
+                    victim = index
+                sampled += 1
+                if sampled >= _EVICTION_SAMPLE:
+                    break
+            index = (index + 1) & mask
+
+        if victim is None:
+            return False
+
+        self._delete_index(mm, victim)
+        _U64.pack_into(mm, _EVICTIONS_OFFSET, _U64.unpack_from(mm, _EVICTIONS_OFFSET)[0] + 1)
+        return True
+
+    # Backward shift delete, later entries of the probe run move into the gap
+    def _delete_index(self, mm, index):
+        slot = self._slot(mm, index)
+        self._free(mm, slot[2], slot[6])
+
+        mask = self._mask
+        following = index
+        while True:
+            following = (following + 1) & mask
+            moving = self._slot(mm, following)
+            if moving[5] != _USED:
+                break
+
+            # Entries whose home slot is cyclically within (index, following] stay
+            home = moving[3] & mask
+            if (index < home <= following) if index <= following else (home > index or home <= following):
+                continue
+
+            self._write_slot(mm, index, *moving[1:10])
+            index = following
+
+        self._write_slot(mm, index, *_EMPTY_FIELDS)
+        self._add_count(mm, -1)
+
+    def _used_slots(self, mm):
+        return [(index, slot) for index, slot in enumerate(_SLOT.iter_unpack(mm[self._slots_offset:self._arena_offset])) if slot[5] == _USED]
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return default if value is MISS else value
+
+    def __getitem__(self, key):
+        value = self.lookup(key)
+        if value is MISS:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.insert(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, MISS) is MISS:
+            raise KeyError(key)
+
+    def pop(self, key, *args):
+        key_bytes = key.encode()
+        with self._write_lock() as mm:
+            index, found = self._find(mm, key_bytes, zlib.crc32(key_bytes))
+            if found:
+                slot = self._slot(mm, index)
+                start = self._arena_offset + slot[2] + slot[7]
+                value = pickle.loads(mm[start:start + slot[8]])
+                self._delete_index(mm, index)
+                return value
+
+        if args:
+            return args[0]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.lookup(key) is not MISS
+
+    def __len__(self):
+        mm = self._mm or self._open()
+        return _U64.unpack_from(mm, _COUNT_OFFSET)[0]
+
+    def __iter__(self):
+        with self._write_lock() as mm:
+            keys = [self._key_at(mm, slot).decode() for index, slot in self._used_slots(mm)]
+        return iter(keys)
+
+    def get_many(self, keys):
+        return [self.lookup(key) for key in keys]
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self.insert(key, value)
+
+    def insert_many(self, entries):
+        for key, value, ttl in entries:
+            self.insert(key, value, ttl)
+
+    def remove_partition(self, partition_value):
+        partition_hash = zlib.crc32(partition_value.encode())
+
+        with self._write_lock() as mm:
+            keys = [self._key_at(mm, slot) for index, slot in self._used_slots(mm) if slot[4] == partition_hash]
+
+            removed = 0
+            for key_bytes in keys:
+                if key_partition(key_bytes.decode()) != partition_value:
+                    continue  # Partition hash collision
+                index, found = self._find(mm, key_bytes, zlib.crc32(key_bytes))
+                if found:
+                    self._delete_index(mm, index)
+                    removed += 1
+
+        return removed
+
+    def clear(self):
+        with self._write_lock() as mm:
+            for index, slot in self._used_slots(mm):
+                self._write_slot(mm, index, *_EMPTY_FIELDS)
+
+            _U64.pack_into(mm, _TOP_OFFSET, 0)
+            _U64.pack_into(mm, _COUNT_OFFSET, 0)
+            mm[_FREE_OFFSET:_FREE_OFFSET + _NUM_CLASSES * 8] = bytes(_NUM_CLASSES * 8)
+
+    def stats(self):
+        mm = self._mm or self._open()
+        _, slots, arena_size, arena_top, count, evictions = _HEADER.unpack_from(mm, 0)
+        return {'slots': slots, 'arena_size': arena_size, 'arena_used': arena_top, 'count': count, 'evictions': evictions}
+
+    # Cross-process single-flight with an fcntl lock on a byte derived from the key.
+    # The lock is released if the process dies, so timeout isn't needed.
+    def acquire_flight(self, key, timeout):
+        if self._fd is None:
+            self._open()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, _FLIGHT_LOCK_BASE + zlib.crc32(key.encode()))
+            return True
+        except OSError:
+            return False
+
+    def release_flight(self, key):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _FLIGHT_LOCK_BASE + zlib.crc32(key.encode()))
+
+    def close(self):
+        with self._lock:
+            if self._mm is not None:
+                self._mm.close()
+                os.close(self._fd)
+                self._mm = None
+                self._fd = None
+
+    def unlink(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
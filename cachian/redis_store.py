@@ -1,7 +1,14 @@
 import redis
-import json
+import redis.asyncio
+import asyncio
+import weakref
 from collections.abc import MutableMapping
 import os
+from math import ceil
+from threading import Lock
+from uuid import uuid4
+from .keys import key_partition, MISS, DEFAULT_PARTITION_VALUE
+from .serializers import get_serializer
 
 CACHIAN_REDIS_HOST = os.getenv('CACHIAN_REDIS_HOST', 'localhost')
 CACHIAN_REDIS_PORT = os.getenv('CACHIAN_REDIS_PORT', '6379')
@@ -9,29 +16,240 @@ CACHIAN_REDIS_DB = int(os.getenv('CACHIAN_REDIS_DB', '0'))
 CACHIAN_REDIS_PASSWORD = os.getenv('CACHIAN_REDIS_PASSWORD', '')
 CACHIAN_REDIS_SSL = os.getenv('CACHIAN_REDIS_SSL', 'true') == 'true'
 CACHIAN_REDIS_NAME = os.getenv('CACHIAN_REDIS_NAME', 'cachian')
+CACHIAN_REDIS_MAX_CONNECTIONS = int(os.getenv('CACHIAN_REDIS_MAX_CONNECTIONS', '0')) or None
 
-class RedisStore(MutableMapping):
+_client = None
+_client_lock = Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_derived_async_clients = weakref.WeakKeyDictionary()
 
-    def __init__(self):
-        self.name = CACHIAN_REDIS_NAME
-        self.redis = redis.StrictRedis(host=CACHIAN_REDIS_HOST, port=CACHIAN_REDIS_PORT, db=CACHIAN_REDIS_DB, password=CACHIAN_REDIS_PASSWORD, ssl=CACHIAN_REDIS_SSL, decode_responses=True)
+# Connection settings copied from an injected sync client to its async counterpart
+_ASYNC_CONNECTION_KWARGS = ('host', 'port', 'db', 'username', 'password', 'socket_timeout', 'socket_connect_timeout', 'socket_keepalive',
+                            'decode_responses', 'encoding', 'encoding_errors', 'health_check_interval', 'client_name', 'credential_provider', 'protocol')
 
-        if len(self)>0:
-            self.clear()
+
+# One pooled client per process shared by every store. redis-py's pool is thread-safe
+# and recreates its connections after a fork.
+# Values are bytes from the serializer, keys are decoded where they are returned
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.StrictRedis(host=CACHIAN_REDIS_HOST, port=CACHIAN_REDIS_PORT, db=CACHIAN_REDIS_DB, password=CACHIAN_REDIS_PASSWORD, ssl=CACHIAN_REDIS_SSL, max_connections=CACHIAN_REDIS_MAX_CONNECTIONS)
+    return _client
+
+
+# asyncio connections are bound to the event loop that opened them, so the shared
+# async client is per running loop
+def get_async_client(client=None):
+    loop = asyncio.get_running_loop()
+    if client is not None:
+        return _derived_async_client(client, loop)
+
+    aclient = _async_clients.get(loop)
+    if aclient is None:
+        aclient = _async_clients[loop] = redis.asyncio.StrictRedis(host=CACHIAN_REDIS_HOST, port=CACHIAN_REDIS_PORT, db=CACHIAN_REDIS_DB, password=CACHIAN_REDIS_PASSWORD, ssl=CACHIAN_REDIS_SSL, max_connections=CACHIAN_REDIS_MAX_CONNECTIONS)
+    return aclient
+
+
+# Async client connecting like an injected sync client, built once per running loop.
+# Only clients of redis-py's own connection classes can be copied, others such as
+# fakeredis need their async client passed in.
+def _derived_async_client(client, loop):
+    aclients = _derived_async_clients.setdefault(client, weakref.WeakKeyDictionary())
+    aclient = aclients.get(loop)
+    if aclient is None:
+        pool = client.connection_pool
+        connection_kwargs = pool.connection_kwargs
+        if pool.connection_class is redis.UnixDomainSocketConnection:
+            kwargs = {'unix_socket_path': connection_kwargs['path']}
+        elif pool.connection_class in (redis.Connection, redis.SSLConnection):
+            kwargs = {'ssl': pool.connection_class is redis.SSLConnection}
+            kwargs.update((name, value) for name, value in connection_kwargs.items() if name.startswith('ssl_'))
+        else:
+            raise ValueError(f'Cannot derive an async client from a {pool.connection_class.__name__} connection, pass aclient= as well')
+
+        kwargs.update((name, connection_kwargs[name]) for name in _ASYNC_CONNECTION_KWARGS if name in connection_kwargs)
+        aclient = aclients[loop] = redis.asyncio.StrictRedis(max_connections=pool.max_connections, **kwargs)
+    return aclient
+
+
+# KEYS: flight lock. ARGV: token
+_RELEASE_FLIGHT_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisFlightMixin():
+    """Cross-process single-flight for Redis stores with `redis` and `name` attributes,
+    which call _init_flights() once their client is set.
+
+    The lock key expires so a crashed worker can't block others. It holds a random
+    token and is only deleted by the worker that set it, so a worker whose lock
+    expired can't release the lock another worker acquired since.
+    """
+
+    def _init_flights(self):
+        self._flight_tokens = {}
+        self._release_flight_script = self.redis.register_script(_RELEASE_FLIGHT_LUA)
+
+    def _flight_name(self, key):
+        return f'{self.name}:flight:{key}'
+
+    def acquire_flight(self, key, timeout):
+        token = uuid4().hex
+        if not self.redis.set(self._flight_name(key), token, nx=True, ex=max(1, ceil(timeout))):
+            return False
+        self._flight_tokens[key] = token
+        return True
+
+    def release_flight(self, key):
+        token = self._flight_tokens.pop(key, None)
+        if token is not None:
+            self._release_flight_script(keys=[self._flight_name(key)], args=[token])
+
+
+class RedisStore(RedisFlightMixin, MutableMapping):
+
+    def __init__(self, serializer=None, name=None):
+        # Cachian calls set_namespace() with the function's qualified name, an explicit
+        # name is kept as is. Existing entries are kept so restarts start warm.
+        self.name = name or CACHIAN_REDIS_NAME
+        self._fixed_name = name is not None
+        self.redis = get_client()
+        self.serializer = serializer or get_serializer()
+        self._init_flights()
+
+    def set_namespace(self, namespace):
+        if not self._fixed_name:
+            self.name = f'{CACHIAN_REDIS_NAME}:{namespace}'
 
     def __getitem__(self, key):
         value = self.redis.hget(self.name, key)
         if value is not None:
-            return json.loads(value)
+            return self.serializer.loads(value)
         raise KeyError(key)
 
     def __setitem__(self, key, value):
-        self.redis.hset(self.name, key, json.dumps(value))
+        partition = key_partition(key)
+        if partition == DEFAULT_PARTITION_VALUE:
+            self.redis.hset(self.name, key, self.serializer.dumps(value))
+            return
+
+        # Keys of each partition are kept in a set, written in the same round trip
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.name, key, self.serializer.dumps(value))
+        pipe.sadd(self._partition_name(partition), key)
+        pipe.sadd(self._partitions_name(), partition)
+        pipe.execute()
+
+    # One HMGET, MISS for missing keys
+    def get_many(self, keys):
+        if not keys:
+            return []
+        loads = self.serializer.loads
+        return [MISS if value is None else loads(value) for value in self.redis.hmget(self.name, keys)]
+
+    # One HSET for all entries plus the partition index, in a single round trip
+    def set_many(self, items):
+        if not items:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_set_many(pipe, items)
+        pipe.execute()
+
+    def _queue_set_many(self, pipe, items):
+        dumps = self.serializer.dumps
+        pipe.hset(self.name, mapping={key: dumps(value) for key, value in items.items()})
+
+        partitions = {}
+        for key in items:
+            partition = key_partition(key)
+            if partition != DEFAULT_PARTITION_VALUE:
+                partitions.setdefault(partition, []).append(key)
+        for partition, keys in partitions.items():
+            pipe.sadd(self._partition_name(partition), *keys)
+        if partitions:
+            pipe.sadd(self._partitions_name(), *partitions)
+
+    # HDEL of keys plus SREM from their partition sets, queued on a pipeline
+    def _queue_delete_many(self, pipe, keys):
+        pipe.hdel(self.name, *keys)
+
+        partitions = {}
+        for key in keys:
+            partition = key_partition(key)
+            if partition != DEFAULT_PARTITION_VALUE:
+                partitions.setdefault(partition, []).append(key)
+        for partition, partition_keys in partitions.items():
+            pipe.srem(self._partition_name(partition), *partition_keys)
+
+    def _partition_name(self, partition_value):
+        return f'{self.name}:partition:{partition_value}'
+
+    def _partitions_name(self):
+        return f'{self.name}:partitions'
+
+    def remove_partition(self, partition_value):
+        if partition_value == DEFAULT_PARTITION_VALUE:
+            keys = [key for key in self.keys() if key_partition(key) == partition_value]
+            return self.redis.hdel(self.name, *keys) if keys else 0
+
+        partition_name = self._partition_name(partition_value)
+        keys = self.redis.smembers(partition_name)
+
+        pipe = self.redis.pipeline(transaction=False)
+        if keys:
+            pipe.hdel(self.name, *keys)
+        pipe.delete(partition_name)
+        pipe.srem(self._partitions_name(), partition_value)
+        results = pipe.execute()
+
+        return results[0] if keys else 0
 
     def __delitem__(self, key):
-        if self.redis.hdel(self.name, key) == 0:
+        partition = key_partition(key)
+        if partition == DEFAULT_PARTITION_VALUE:
+            deleted = self.redis.hdel(self.name, key)
+        else:
+            # The key leaves its partition set in the same round trip
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hdel(self.name, key)
+            pipe.srem(self._partition_name(partition), key)
+            deleted = pipe.execute()[0]
+
+        if deleted == 0:
             raise KeyError(key)
 
+    # Hashes have no order, evicts the first keys HSCAN returns instead of listing all keys
+    def evict(self):
+        keys = self._first_keys(1)
+        if not keys or self._delete_many(keys) == 0:
+            raise KeyError('evict(): store is empty')
+        return keys[0]
+
+    def evict_many(self, count):
+        keys = self._first_keys(count)
+        return self._delete_many(keys) if keys else 0
+
+    def _first_keys(self, count):
+        keys = []
+        for key, _ in self.redis.hscan_iter(self.name, count=count):
+            keys.append(key.decode())
+            if len(keys) >= count:
+                break
+        return keys
+
+    def _delete_many(self, keys):
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_delete_many(pipe, keys)
+        return pipe.execute()[0]
+
     def __contains__(self, key):
         return self.redis.hexists(self.name, key)
 
@@ -39,16 +257,86 @@ class RedisStore(MutableMapping):
         return self.redis.hlen(self.name)
     
     def __iter__(self):
-        return iter(self.redis.hkeys(self.name))
+        return iter(self.keys())
 
     def keys(self):
-        return self.redis.hkeys(self.name)
+        return [key.decode() for key in self.redis.hkeys(self.name)]
 
     def values(self):
-        return [json.loads(value) for value in self.redis.hvals(self.name)]
+        return [self.serializer.loads(value) for value in self.redis.hvals(self.name)]
 
     def items(self):
-        return [(key, json.loads(value)) for key, value in self.redis.hgetall(self.name).items()]
+        return [(key.decode(), self.serializer.loads(value)) for key, value in self.redis.hgetall(self.name).items()]
 
     def clear(self):
-        self.redis.delete(self.name)
\ No newline at end of file
+        partitions = self.redis.smembers(self._partitions_name())
+        self.redis.delete(self.name, self._partitions_name(), *[self._partition_name(p.decode()) for p in partitions])
+
+    @property
+    def aredis(self):
+        return get_async_client()
+
+    async def aget(self, key):
+        value = await self.aredis.hget(self.name, key)
+        if value is not None:
+            return self.serializer.loads(value)
+        return MISS
+
+    async def aset(self, key, value):
+        partition = key_partition(key)
+        if partition == DEFAULT_PARTITION_VALUE:
+            await self.aredis.hset(self.name, key, self.serializer.dumps(value))
+            return
+
+        pipe = self.aredis.pipeline(transaction=False)
+        pipe.hset(self.name, key, self.serializer.dumps(value))
+        pipe.sadd(self._partition_name(partition), key)
+        pipe.sadd(self._partitions_name(), partition)
+        await pipe.execute()
+
+    async def aget_many(self, keys):
+        if not keys:
+            return []
+        loads = self.serializer.loads
+        return [MISS if value is None else loads(value) for value in await self.aredis.hmget(self.name, keys)]
+
+    async def aset_many(self, items):
+        if not items:
+            return
+
+        pipe = self.aredis.pipeline(transaction=False)
+        self._queue_set_many(pipe, items)
+        await pipe.execute()
+
+    async def adelete(self, key):
+        partition = key_partition(key)
+        if partition == DEFAULT_PARTITION_VALUE:
+            await self.aredis.hdel(self.name, key)
+            return
+
+        pipe = self.aredis.pipeline(transaction=False)
+        pipe.hdel(self.name, key)
+        pipe.srem(self._partition_name(partition), key)
+        await pipe.execute()
+
+    async def alen(self):
+        return await self.aredis.hlen(self.name)
+
+    async def aevict(self):
+        # Hashes have no order, remove the first key returned
+        async for key, _ in self.aredis.hscan_iter(self.name, count=1):
+            await self.adelete(key.decode())
+            return
+
+    async def aevict_many(self, count):
+        keys = []
+        async for key, _ in self.aredis.hscan_iter(self.name, count=count):
+            keys.append(key.decode())
+            if len(keys) >= count:
+                break
+        if not keys:
+            return 0
+
+        pipe = self.aredis.pipeline(transaction=False)
+        self._queue_delete_many(pipe, keys)
+        return (await pipe.execute())[0]
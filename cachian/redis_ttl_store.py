@@ -0,0 +1,280 @@
+"""Redis backend with native key TTLs and single round trip operations.
+
+Each entry is stored in its own Redis key with `SET ... PX` so Redis expires it,
+instead of one hash with client side timestamp checks. Lookup, insert with
+maxsize eviction and partition removal each run as one Lua script call.
+
+Usage:
+    from cachian import Cachian
+    from cachian.redis_ttl_store import RedisTTLStore
+
+    @Cachian(cache_class=RedisTTLStore, ttl=60, maxsize=10000)
+    def my_function(x):
+        return expensive_computation(x)
+
+Key layout, where name defaults to '<CACHIAN_REDIS_NAME>:ttl:<module>.<qualname>':
+    <name>:e:<key>          Entry value
+    <name>:index            Sorted set of entries by last access (LRU with maxsize)
+                            or insert time, for eviction and len()
+    <name>:p:<partition>    Set of entry keys in a partition, expires with its
+                            longest lived entry
+    <name>:flight:<key>     Cross-process single-flight lock
+
+Scripts touch keys derived from their arguments, so the store expects a
+standalone Redis server rather than a cluster.
+
+Connection and serializer settings are shared with RedisStore (CACHIAN_REDIS_HOST,
+CACHIAN_REDIS_SERIALIZER etc.), as is its pooled client unless one is passed in.
+An injected client must not decode responses. Async calls use a client with the
+injected client's connection settings per event loop, clients that redis-py can't
+copy such as fakeredis need their async counterpart passed as aclient=.
+"""
+
+import weakref
+from collections.abc import MutableMapping
+from time import time
+from .keys import key_partition, MISS, DEFAULT_PARTITION_VALUE, KEY_SEPARATOR
+from .serializers import get_serializer
+from .redis_store import get_client, get_async_client, RedisFlightMixin, CACHIAN_REDIS_NAME
+
+
+# KEYS: entry, index. ARGV: now, track recency (1/0)
+_LOOKUP_LUA = """
+local value = redis.call('GET', KEYS[1])
+if value and ARGV[2] == '1' then
+    redis.call('ZADD', KEYS[2], 'XX', ARGV[1], KEYS[1])
+end
+return value
+"""
+
+# KEYS: entry, index. ARGV: value, ttl ms, maxsize, now ms, index max age ms, partition set name,
+# entry name prefix, partition set name prefix, default partition value, key separator
+_INSERT_LUA = """
+-- Entries that expired or were evicted leave the index and their partition sets
+local function unindex(entries)
+    for _, entry in ipairs(entries) do
+        local partition = string.match(string.sub(entry, #ARGV[7] + 1), '^(.*)' .. ARGV[10])
+        if partition and partition ~= ARGV[9] and redis.call('EXISTS', entry) == 0 then
+            redis.call('SREM', ARGV[8] .. partition, entry)
+            redis.call('ZREM', KEYS[2], entry)
+        end
+    end
+end
+
+local ttl = tonumber(ARGV[2])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ttl)
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+
+local partition_set = ARGV[6]
+if partition_set ~= '' then
+    -- The set expires with its longest lived entry, -2 when it doesn't exist yet
+    local set_ttl = redis.call('PTTL', partition_set)
+    redis.call('SADD', partition_set, KEYS[1])
+    if ttl > 0 then
+        if set_ttl == -2 or (set_ttl >= 0 and set_ttl < ttl) then
+            redis.call('PEXPIRE', partition_set, ttl)
+        end
+    elseif set_ttl >= 0 then
+        redis.call('PERSIST', partition_set)
+    end
+
+    -- Check a couple of members on each insert, so a partition that is never cleared
+    -- doesn't keep every key that expired
+    unindex(redis.call('SRANDMEMBER', partition_set, 2))
+end
+
+local now = tonumber(ARGV[4])
+local max_age = tonumber(ARGV[5])
+-- Entries not accessed within the TTL have expired, drop them from the index
+if max_age > 0 then
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - max_age)
+    if #expired > 0 then
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - max_age)
+        unindex(expired)
+    end
+end
+
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+
+local maxsize = tonumber(ARGV[3])
+if maxsize > 0 then
+    local excess = redis.call('ZCARD', KEYS[2]) - maxsize
+    if excess > 0 then
+        local victims = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+        redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+        redis.call('DEL', unpack(victims))
+        unindex(victims)
+    end
+end
+return 1
+"""
+
+# KEYS: partition set, index
+_REMOVE_PARTITION_LUA = """
+local keys = redis.call('SMEMBERS', KEYS[1])
+local removed = 0
+for i, key in ipairs(keys) do
+    removed = removed + redis.call('DEL', key)
+    redis.call('ZREM', KEYS[2], key)
+end
+redis.call('DEL', KEYS[1])
+return removed
+"""
+
+
+class RedisTTLStore(RedisFlightMixin, MutableMapping):
+    """Redis store where Redis enforces TTL and maxsize.
+
+    Cachian passes its maxsize, ttl and eviction settings through configure(), and
+    uses lookup()/insert() so a hit costs one round trip and a miss two.
+    """
+
+    def __init__(self, client=None, name=None, serializer=None, aclient=None):
+        self.name = name or f'{CACHIAN_REDIS_NAME}:ttl'
+        self._fixed_name = name is not None
+        self.redis = client or get_client()
+        self._client = client
+        self._aclient = aclient
+        self.serializer = serializer or get_serializer()
+        self._init_flights()
+        self._ascripts = weakref.WeakKeyDictionary()
+
+        self.maxsize = -1
+        self.ttl = -1
+        self.track_recency = False
+
+        self._lookup_script = self.redis.register_script(_LOOKUP_LUA)
+        self._insert_script = self.redis.register_script(_INSERT_LUA)
+        self._remove_partition_script = self.redis.register_script(_REMOVE_PARTITION_LUA)
+
+    def set_namespace(self, namespace):
+        if not self._fixed_name:
+            self.name = f'{CACHIAN_REDIS_NAME}:ttl:{namespace}'
+
+    def configure(self, maxsize=-1, ttl=-1, eviction='lru'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Lookups only update the index when there is a maxsize to enforce
+        self.track_recency = maxsize > 0 and eviction == 'lru'
+
+    def _entry_name(self, key):
+        return f'{self.name}:e:{key}'
+
+    def _index_name(self):
+        return f'{self.name}:index'
+
+    def _partition_name(self, partition_value):
+        return f'{self.name}:p:{partition_value}'
+
+    def _insert_args(self, key, value, ttl):
+        partition = key_partition(key)
+        partition_name = '' if partition == DEFAULT_PARTITION_VALUE else self._partition_name(partition)
+        ttl_ms = int(ttl * 1000) if ttl > 0 else 0
+        max_age_ms = int(self.ttl * 1000) if self.ttl > 0 else 0
+
+        return [self._entry_name(key), self._index_name()], [self.serializer.dumps(value), ttl_ms, self.maxsize, int(time() * 1000), max_age_ms, partition_name,
+                                                              self._entry_name(''), self._partition_name(''), DEFAULT_PARTITION_VALUE, KEY_SEPARATOR]
+
+    # Get with recency update, MISS when the key doesn't exist or has expired
+    def lookup(self, key):
+        if self.track_recency:
+            value = self._lookup_script(keys=[self._entry_name(key), self._index_name()], args=[int(time() * 1000), 1])
+        else:
+            value = self.redis.get(self._entry_name(key))
+
+        if value is None:
+            return MISS
+        return self.serializer.loads(value)
+
+    # Set with native TTL and maxsize eviction in one round trip
+    def insert(self, key, value, ttl=None):
+        keys, args = self._insert_args(key, value, self.ttl if ttl is None else ttl)
+        self._insert_script(keys=keys, args=args)
+
+    def __getitem__(self, key):
+        value = self.redis.get(self._entry_name(key))
+        if value is None:
+            raise KeyError(key)
+        return self.serializer.loads(value)
+
+    def __setitem__(self, key, value):
+        self.insert(key, value)
+
+    def __delitem__(self, key):
+        entry_name = self._entry_name(key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(entry_name)
+        pipe.zrem(self._index_name(), entry_name)
+        if pipe.execute()[0] == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.redis.exists(self._entry_name(key)) > 0
+
+    # Entries in the index, without the ones not accessed within the TTL that have expired.
+    # An LRU entry accessed within the TTL but inserted before may still be counted.
+    def __len__(self):
+        if self.ttl > 0:
+            return self.redis.zcount(self._index_name(), f'({int(time() * 1000) - int(self.ttl * 1000)}', '+inf')
+        return self.redis.zcard(self._index_name())
+
+    def __iter__(self):
+        prefix_len = len(f'{self.name}:e:')
+        return (entry_name[prefix_len:].decode() for entry_name in self.redis.scan_iter(match=f'{self.name}:e:*', count=1000))
+
+    def remove_partition(self, partition_value):
+        if partition_value == DEFAULT_PARTITION_VALUE:
+            keys = [key for key in self if key_partition(key) == partition_value]
+            removed = 0
+            for key in keys:
+                try:
+                    del self[key]
+                    removed += 1
+                except KeyError:
+                    pass
+            return removed
+
+        return self._remove_partition_script(keys=[self._partition_name(partition_value), self._index_name()])
+
+    def clear(self):
+        batch = []
+        for name in self.redis.scan_iter(match=f'{self.name}:*', count=1000):
+            batch.append(name)
+            if len(batch) >= 1000:
+                self.redis.delete(*batch)
+                batch = []
+        if batch:
+            self.redis.delete(*batch)
+
+    # The injected async client, else one connecting like the injected sync client, else the shared one
+    @property
+    def aredis(self):
+        if self._aclient is not None:
+            return self._aclient
+        return get_async_client(self._client)
+
+    # Scripts are bound to the client they were registered on, one client per event loop
+    def _ascript(self, script):
+        aredis = self.aredis
+        ascripts = self._ascripts.setdefault(aredis, {})
+        ascript = ascripts.get(script)
+        if ascript is None:
+            ascript = ascripts[script] = aredis.register_script(script)
+        return ascript
+
+    async def alookup(self, key):
+        if self.track_recency:
+            value = await self._ascript(_LOOKUP_LUA)(keys=[self._entry_name(key), self._index_name()], args=[int(time() * 1000), 1])
+        else:
+            value = await self.aredis.get(self._entry_name(key))
+
+        if value is None:
+            return MISS
+        return self.serializer.loads(value)
+
+    async def ainsert(self, key, value, ttl=None):
+        keys, args = self._insert_args(key, value, self.ttl if ttl is None else ttl)
+        await self._ascript(_INSERT_LUA)(keys=keys, args=args)
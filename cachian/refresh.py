@@ -0,0 +1,61 @@
+"""Bounded background pool for refreshing cache entries.
+
+Entries are refreshed by stale_ttl (serve the stale value, recompute in the
+background). All caches in the process share one pool of worker threads. Once
+CACHIAN_REFRESH_QUEUE refreshes are pending, new ones are dropped. The entry
+keeps being served and a later hit schedules the refresh again.
+
+Async functions are refreshed as tasks on the caller's event loop instead.
+
+Environment variables:
+    CACHIAN_REFRESH_WORKERS: Threads in the refresh pool (default: 4)
+    CACHIAN_REFRESH_QUEUE:   Pending refreshes before new ones are dropped (default: 1000)
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+CACHIAN_REFRESH_WORKERS = int(os.getenv('CACHIAN_REFRESH_WORKERS', '4'))
+CACHIAN_REFRESH_QUEUE = int(os.getenv('CACHIAN_REFRESH_QUEUE', '1000'))
+
+_executor = None
+_pending = 0
+_lock = Lock()
+
+
+def _run(task):
+    global _pending
+
+    try:
+        task()
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def submit(task):
+    """Run task() on the refresh pool. Returns False when the queue is full."""
+
+    global _executor, _pending
+
+    with _lock:
+        if _pending >= CACHIAN_REFRESH_QUEUE:
+            return False
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CACHIAN_REFRESH_WORKERS, thread_name_prefix='cachian-refresh')
+        _pending += 1
+
+    try:
+        _executor.submit(_run, task)
+    except RuntimeError:
+        # Interpreter shutdown, the executor no longer takes work
+        with _lock:
+            _pending -= 1
+        return False
+    return True
+
+
+def pending():
+    return _pending
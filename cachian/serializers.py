@@ -0,0 +1,149 @@
+"""Serializers used by remote stores to turn cached values into bytes.
+
+    JsonSerializer      Text JSON, tuples become lists. Default for compatibility.
+    PickleSerializer    Pickle protocol 5, large buffers such as numpy arrays are
+                        written out-of-band and loaded as views without copying.
+    MsgpackSerializer   Requires the msgpack package.
+
+Any serializer can be wrapped with CompressedSerializer to zlib compress
+payloads above a size threshold.
+
+Environment variables:
+    CACHIAN_REDIS_SERIALIZER:         'json' (default), 'pickle' or 'msgpack'
+    CACHIAN_REDIS_COMPRESS_THRESHOLD: Compress payloads of at least this many
+                                      bytes, -1 (default) disables compression
+
+Note: only use PickleSerializer with a trusted Redis server, loading a pickle
+can execute arbitrary code.
+"""
+
+import json
+import os
+import pickle
+import struct
+import zlib
+
+
+CACHIAN_REDIS_SERIALIZER = os.getenv('CACHIAN_REDIS_SERIALIZER', 'json')
+CACHIAN_REDIS_COMPRESS_THRESHOLD = int(os.getenv('CACHIAN_REDIS_COMPRESS_THRESHOLD', '-1'))
+
+_COUNT = struct.Struct('<I')
+_LENGTH = struct.Struct('<Q')
+_RAW = b'\x00'
+_ZLIB = b'\x01'
+
+
+class JsonSerializer():
+
+    def dumps(self, value):
+        return json.dumps(value).encode()
+
+    def loads(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+class PickleSerializer():
+    """Pickle protocol 5 with out-of-band buffers.
+
+    Frame: buffer count, buffer lengths, pickle stream, buffers. Buffers are
+    loaded as memoryviews of the received bytes, so arrays restored from them
+    are read-only.
+    """
+
+    def dumps(self, value):
+        return b''.join(self.dump_parts(value))
+
+    # The frame as a list of buffers, so it can be written out without joining large buffers
+    def dump_parts(self, value):
+        buffers = []
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+
+        raws = [b.raw() for b in buffers]
+        header = _COUNT.pack(len(raws)) + b''.join(_LENGTH.pack(r.nbytes) for r in raws) + _LENGTH.pack(len(data))
+
+        return [header, data, *raws]
+
+    def loads(self, data):
+        view = memoryview(data)
+
+        count, = _COUNT.unpack_from(view, 0)
+        offset = _COUNT.size
+        lengths = []
+        for _ in range(count):
+            lengths.append(_LENGTH.unpack_from(view, offset)[0])
+            offset += _LENGTH.size
+        data_length, = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+
+        stream = view[offset:offset + data_length]
+        offset += data_length
+
+        buffers = []
+        for length in lengths:
+            buffers.append(view[offset:offset + length])
+            offset += length
+
+        return pickle.loads(stream, buffers=buffers)
+
+
+class MsgpackSerializer():
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class CompressedSerializer():
+    """Wraps a serializer, payloads of at least threshold bytes are zlib compressed.
+
+    A one byte prefix marks whether the payload is compressed.
+    """
+
+    def __init__(self, serializer, threshold=1024, level=1):
+        self.serializer = serializer
+        self.threshold = threshold
+        self.level = level
+
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if len(data) >= self.threshold:
+            return _ZLIB + zlib.compress(data, self.level)
+        return _RAW + data
+
+    def loads(self, data):
+        view = memoryview(data)
+        if view[:1] == _ZLIB:
+            return self.serializer.loads(zlib.decompress(view[1:]))
+        return self.serializer.loads(view[1:])
+
+
+SERIALIZERS = {
+    'json': JsonSerializer,
+    'pickle': PickleSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def get_serializer(name=None, compress_threshold=None):
+    """Build a serializer by name, defaults to the CACHIAN_REDIS_* environment variables."""
+
+    name = name or CACHIAN_REDIS_SERIALIZER
+    if compress_threshold is None:
+        compress_threshold = CACHIAN_REDIS_COMPRESS_THRESHOLD
+
+    if name not in SERIALIZERS:
+        raise ValueError(f'Unknown serializer: {name}')
+
+    serializer = SERIALIZERS[name]()
+    if compress_threshold >= 0:
+        serializer = CompressedSerializer(serializer, compress_threshold)
+
+    return serializer
@@ -27,9 +27,12 @@ processes via the manager connection.
 """
 
 from multiprocessing.managers import BaseManager
+from collections import OrderedDict
 from collections.abc import MutableMapping
+from threading import Lock
 import os
 import time
+from .keys import key_partition, MISS, DEFAULT_PARTITION_VALUE
 
 
 CACHIAN_SHM_HOST = os.getenv('CACHIAN_SHM_HOST', '127.0.0.1')
@@ -37,39 +40,173 @@ CACHIAN_SHM_PORT = int(os.getenv('CACHIAN_SHM_PORT', '19847'))
 CACHIAN_SHM_KEY = os.getenv('CACHIAN_SHM_KEY', 'cachian').encode()
 
 
-class _SharedCache:
-    """Dict wrapper with non-dunder public methods for clean proxy access.
-
-    AutoProxy only exposes public (non-underscore) methods, so all dict
-    operations are wrapped as regular methods.
-    """
+class _Table:
 
     def __init__(self):
-        self._data = {}
-
-    def get(self, key):
-        return self._data.get(key)
-
-    def set(self, key, value):
-        self._data[key] = value
-
-    def delete(self, key):
-        del self._data[key]
+        self.data = OrderedDict()  # Key -> (value, expire_at), in LRU/FIFO order
+        self.partitions = {}
+        self.lock = Lock()
+
+    def live(self, key, now):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] and now > entry[1]:
+            self.remove(key)
+            return None
+        return entry
+
+    def put(self, key, value, ttl, maxsize):
+        if key in self.data:
+            self.data.move_to_end(key)
+        elif maxsize > 0:
+            while len(self.data) >= maxsize:
+                self.remove(next(iter(self.data)))
+
+        self.data[key] = (value, time.time() + ttl if ttl > 0 else 0)
+
+        partition = key_partition(key)
+        if partition != DEFAULT_PARTITION_VALUE:
+            self.partitions.setdefault(partition, set()).add(key)
+
+    def remove(self, key):
+        entry = self.data.pop(key)
+        keys = self.partitions.get(key_partition(key))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.partitions[key_partition(key)]
+        return entry
 
-    def contains(self, key):
-        return key in self._data
 
-    def length(self):
-        return len(self._data)
+class _SharedCache:
+    """Tables of entries by store name, with non-dunder public methods for clean proxy access.
 
-    def keys(self):
-        return list(self._data.keys())
+    AutoProxy only exposes public (non-underscore) methods, so all dict
+    operations are wrapped as regular methods. Each method is one round trip and
+    runs compound work (TTL checks, maxsize eviction, partition removal) here in
+    the server instead of in several client calls.
+    """
 
-    def clear(self):
-        self._data.clear()
+    def __init__(self):
+        self._tables = {}
+        self._flights = {}
+        # The manager serves each connection on its own thread
+        self._tables_lock = Lock()
+        self._flights_lock = Lock()
+
+    def _table(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            with self._tables_lock:
+                table = self._tables.setdefault(name, _Table())
+        return table
+
+    # Get with TTL check, touch promotes the entry for LRU eviction
+    def lookup(self, name, key, touch=False):
+        table = self._table(name)
+        with table.lock:
+            entry = table.live(key, time.time())
+            if entry is None:
+                return MISS
+            if touch:
+                table.data.move_to_end(key)
+            return entry[0]
+
+    def get(self, name, key, default=None):
+        value = self.lookup(name, key)
+        return default if value is MISS else value
+
+    def get_many(self, name, keys, touch=False):
+        table = self._table(name)
+        now = time.time()
+        values = []
+        with table.lock:
+            for key in keys:
+                entry = table.live(key, now)
+                if entry is None:
+                    values.append(MISS)
+                    continue
+                if touch:
+                    table.data.move_to_end(key)
+                values.append(entry[0])
+        return values
+
+    # Set with TTL, evicting the oldest entries to stay within maxsize
+    def insert(self, name, key, value, ttl=-1, maxsize=-1):
+        table = self._table(name)
+        with table.lock:
+            table.put(key, value, ttl, maxsize)
+
+    # Entries are (key, value, ttl)
+    def insert_many(self, name, entries, maxsize=-1):
+        table = self._table(name)
+        with table.lock:
+            for key, value, ttl in entries:
+                table.put(key, value, ttl, maxsize)
+
+    def delete(self, name, key):
+        table = self._table(name)
+        with table.lock:
+            table.remove(key)
+
+    def contains(self, name, key):
+        return self.lookup(name, key) is not MISS
+
+    def length(self, name):
+        return len(self._table(name).data)
+
+    def keys(self, name):
+        table = self._table(name)
+        with table.lock:
+            return list(table.data)
+
+    # Clears one table, or every table when no name is given
+    def clear(self, name=None):
+        if name is None:
+            with self._tables_lock:
+                self._tables.clear()
+            return
 
-    def pop(self, key, *args):
-        return self._data.pop(key, *args)
+        table = self._table(name)
+        with table.lock:
+            table.data.clear()
+            table.partitions.clear()
+
+    def pop(self, name, key, *args):
+        table = self._table(name)
+        with table.lock:
+            if key not in table.data:
+                if args:
+                    return args[0]
+                raise KeyError(key)
+            return table.remove(key)[0]
+
+    def remove_partition(self, name, partition_value):
+        table = self._table(name)
+        with table.lock:
+            if partition_value == DEFAULT_PARTITION_VALUE:
+                keys = [key for key in table.data if key_partition(key) == partition_value]
+            else:
+                keys = list(table.partitions.get(partition_value, ()))
+
+            for key in keys:
+                table.remove(key)
+
+        return len(keys)
+
+    def acquire_flight(self, name, key, timeout):
+        now = time.time()
+        with self._flights_lock:
+            expiry = self._flights.get((name, key))
+            if expiry is not None and expiry > now:
+                return False
+            self._flights[(name, key)] = now + timeout
+            return True
+
+    def release_flight(self, name, key):
+        with self._flights_lock:
+            self._flights.pop((name, key), None)
 
 
 _server_cache = _SharedCache()
@@ -93,16 +230,23 @@ class SharedMemoryStore(MutableMapping):
     The first process to instantiate SharedMemoryStore starts a manager server;
     subsequent processes connect to the running server.
 
-    Individual dict operations are serialized by the manager server. Compound
-    operations (e.g., iterate-then-delete) spanning multiple calls are not
-    atomic across processes; for cache use this is acceptable since the worst
-    case is a redundant recomputation.
+    Each cached function has its own table in the server. Cachian passes its
+    maxsize, ttl and eviction settings through configure() and uses lookup() and
+    insert(), so the server enforces them and a cached call is one round trip
+    (two on a miss).
     """
 
     _manager = None
     _cache = None
 
-    def __init__(self):
+    def __init__(self, name=None):
+        self.name = name or 'default'
+        self._fixed_name = name is not None
+
+        self.maxsize = -1
+        self.ttl = -1
+        self.track_recency = False
+
         if SharedMemoryStore._cache is not None:
             return
         self._connect_or_start()
@@ -139,26 +283,68 @@ class SharedMemoryStore(MutableMapping):
     def _proxy(self):
         return SharedMemoryStore._cache
 
+    def set_namespace(self, namespace):
+        if not self._fixed_name:
+            self.name = namespace
+
+    def configure(self, maxsize=-1, ttl=-1, eviction='lru'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.track_recency = eviction == 'lru'
+
+    # Get with TTL check and recency update, MISS keeps its identity through the manager connection
+    def lookup(self, key):
+        return self._proxy.lookup(self.name, key, self.track_recency)
+
+    # Set with TTL and maxsize eviction
+    def insert(self, key, value, ttl=None):
+        self._proxy.insert(self.name, key, value, self.ttl if ttl is None else ttl, self.maxsize)
+
+    def insert_many(self, entries):
+        self._proxy.insert_many(self.name, entries, self.maxsize)
+
     def __getitem__(self, key):
-        return self._proxy.get(key)
+        value = self._proxy.get(self.name, key, MISS)
+        if value is MISS:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self._proxy.get(self.name, key, default)
 
     def __setitem__(self, key, value):
-        self._proxy.set(key, value)
+        self.insert(key, value)
+
+    # Bulk operations are a single round trip to the manager
+    def get_many(self, keys):
+        return self._proxy.get_many(self.name, keys, self.track_recency)
+
+    def set_many(self, items):
+        self.insert_many([(key, value, self.ttl) for key, value in items.items()])
 
     def __delitem__(self, key):
-        self._proxy.delete(key)
+        self._proxy.delete(self.name, key)
 
     def __contains__(self, key):
-        return self._proxy.contains(key)
+        return self._proxy.contains(self.name, key)
 
     def __len__(self):
-        return self._proxy.length()
+        return self._proxy.length(self.name)
 
     def __iter__(self):
-        return iter(self._proxy.keys())
+        return iter(self._proxy.keys(self.name))
 
     def pop(self, key, *args):
-        return self._proxy.pop(key, *args)
+        return self._proxy.pop(self.name, key, *args)
+
+    def remove_partition(self, partition_value):
+        return self._proxy.remove_partition(self.name, partition_value)
 
     def clear(self):
-        self._proxy.clear()
+        self._proxy.clear(self.name)
+
+    def acquire_flight(self, key, timeout):
+        return self._proxy.acquire_flight(self.name, key, timeout)
+
+    def release_flight(self, key):
+        self._proxy.release_flight(self.name, key)
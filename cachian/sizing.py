@@ -0,0 +1,154 @@
+"""Entry size estimates and the per-process memory budget used by maxbytes.
+
+get_size() estimates the memory a cached value holds: containers and object
+attributes are followed, objects shared within the value are counted once,
+numpy arrays count their data buffer and pandas objects their deep memory
+usage. Other types can register a sizer:
+
+    from cachian import register_sizer
+
+    register_sizer(MyFrame, lambda frame: frame.memory_bytes())
+
+The global budget caps the total bytes of all in-process caches that track
+sizes. When it is exceeded, entries are evicted from the largest cache first.
+Checking it sums the caches' sizes, so it costs O(number of caches) per add.
+
+Environment variables:
+    CACHIAN_MAX_BYTES: Per-process budget for all caches in bytes, -1 (default)
+                       disables it. Must be set before caches are created.
+"""
+
+import os
+import sys
+import weakref
+from threading import Lock
+
+
+CACHIAN_MAX_BYTES = int(os.getenv('CACHIAN_MAX_BYTES', '-1'))
+SIZE_MAX_DEPTH = 8  # Deeper nesting is counted by its top level object only
+
+_sizers = {}
+_ATOMIC_TYPES = {int, float, bool, complex, type(None)}
+_BUFFER_TYPES = {str, bytes}
+
+
+def register_sizer(cls, func):
+    """Use func(obj) as the size in bytes of values of type cls, including subclasses."""
+    _sizers[cls] = func
+
+
+def unregister_sizer(cls):
+    _sizers.pop(cls, None)
+
+
+def _registered_sizer(t):
+    if _sizers:
+        for cls in t.__mro__:
+            sizer = _sizers.get(cls)
+            if sizer is not None:
+                return sizer
+    return None
+
+
+def _size(obj, seen, depth):
+    t = type(obj)
+    if t in _ATOMIC_TYPES:
+        return sys.getsizeof(obj)
+
+    # Objects referenced more than once in the value are counted once
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if t in _BUFFER_TYPES:
+        return sys.getsizeof(obj)
+
+    sizer = _registered_sizer(t)
+    if sizer is not None:
+        return sizer(obj)
+
+    size = sys.getsizeof(obj)
+    if depth >= SIZE_MAX_DEPTH:
+        return size
+
+    if t in (list, tuple, set, frozenset):
+        for item in obj:
+            size += _size(item, seen, depth + 1)
+        return size
+
+    if t is dict:
+        for key, value in obj.items():
+            size += _size(key, seen, depth + 1) + _size(value, seen, depth + 1)
+        return size
+
+    # pandas DataFrame and Series, checked by module so pandas isn't imported
+    if t.__module__.startswith('pandas') and hasattr(obj, 'memory_usage'):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+
+    # numpy arrays and other buffers, views don't report their data in getsizeof()
+    nbytes = getattr(obj, 'nbytes', None)
+    if type(nbytes) is int:
+        return max(size, nbytes)
+
+    attributes = getattr(obj, '__dict__', None)
+    if type(attributes) is dict:
+        size += _size(attributes, seen, depth + 1)
+
+    return size
+
+
+def get_size(value):
+    """Estimated bytes held by value."""
+
+    return _size(value, set(), 0)
+
+
+class MemoryBudget():
+    """Byte budget shared by caches.
+
+    The total is summed from the caches when checked rather than kept as a running
+    count, so caches that are garbage collected stop counting without a finalizer.
+    """
+
+    def __init__(self, maxbytes=-1):
+        self.maxbytes = maxbytes
+        self._caches = weakref.WeakValueDictionary()  # Cachian instances aren't hashable, keyed by id
+        self._lock = Lock()
+
+    def register(self, cache):
+        with self._lock:
+            self._caches[id(cache)] = cache
+
+    def caches(self):
+        with self._lock:
+            return list(self._caches.values())
+
+    @property
+    def nbytes(self):
+        return sum(cache.nbytes for cache in self.caches())
+
+    def exceeded(self):
+        return self.maxbytes > 0 and self.nbytes > self.maxbytes
+
+    # Called without holding any cache lock, caches are shrunk one at a time so two
+    # caches enforcing the budget can't deadlock on each other's locks
+    def enforce(self):
+        while self.maxbytes > 0:
+            caches = self.caches()
+            if sum(cache.nbytes for cache in caches) <= self.maxbytes:
+                return
+
+            largest = max(caches, key=lambda cache: cache.nbytes)
+            if largest.nbytes <= 0 or largest.shrink() is None:
+                return
+
+
+global_budget = MemoryBudget(CACHIAN_MAX_BYTES)
+
+
+def set_global_maxbytes(maxbytes):
+    """Change the per-process budget, caches created while it was disabled aren't counted."""
+
+    global_budget.maxbytes = maxbytes
+    global_budget.enforce()
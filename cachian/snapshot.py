@@ -0,0 +1,165 @@
+"""Snapshots of in-process caches in a binary file, for warm restarts.
+
+A snapshot holds the entries of every cached function with an in-process store,
+grouped by the function's qualified name. Restoring one maps the file and reads
+its index only. Each function's entries are unpickled when that function is
+restored, so functions that are never imported again cost nothing.
+
+Layout:
+    header    Magic, time the snapshot was written and the offset of the index
+    sections  Entries of one cached function pickled as a list of
+              (partition_value, key, result, ts) tuples
+    index     Pickled {qualified name: [(offset, length, key kind, entry count)]}
+
+Keys are only valid for caches building the same kind of key ('compact',
+'fast' or 'hash'), sections of another kind are skipped. Entries whose key or
+result can't be pickled are left out.
+
+Note: loading a snapshot unpickles it, only restore files your processes wrote.
+"""
+
+import io
+import mmap
+import os
+import pickle
+import struct
+from threading import Lock
+from time import time
+from .keys import _KWARGS_MARK
+
+
+_MAGIC = b'CACHSNP1'
+_HEADER = struct.Struct('<8sdQ')  # Magic, written at, index offset
+_KWARGS_MARK_ID = 'kwargs_mark'
+
+
+# Fast keys with keyword arguments hold a marker object that is different in every process
+class _Pickler(pickle.Pickler):
+
+    def persistent_id(self, obj):
+        if obj is _KWARGS_MARK[0]:
+            return _KWARGS_MARK_ID
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        if pid == _KWARGS_MARK_ID:
+            return _KWARGS_MARK[0]
+        raise pickle.UnpicklingError(f'Unknown persistent id: {pid}')
+
+
+# persistent_id() is called for every pickled object, only fast keys need it
+def _dumps(obj, key_kind):
+    if key_kind != 'fast':
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    f = io.BytesIO()
+    _Pickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return f.getvalue()
+
+
+# Pickles entries as one list, entries that fail on their own are dropped
+def _dump_entries(entries, key_kind):
+    try:
+        return _dumps(entries, key_kind), len(entries)
+    except Exception:
+        pass
+
+    picklable = []
+    for entry in entries:
+        try:
+            _dumps(entry, key_kind)
+            picklable.append(entry)
+        except Exception:
+            pass
+    return _dumps(picklable, key_kind), len(picklable)
+
+
+def write_snapshot(path, sections):
+    """Write (qualified name, key kind, entries) sections to path. Returns the number of entries written.
+
+    The file is written under a temporary name and renamed, so readers and processes
+    writing the same path never see a partial snapshot.
+    """
+
+    index = {}
+    written = 0
+    tmp = f'{path}.{os.getpid()}.tmp'
+
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, 0.0, 0))
+            offset = _HEADER.size
+
+            for name, key_kind, entries in sections:
+                if not entries:
+                    continue
+                data, count = _dump_entries(entries, key_kind)
+                f.write(data)
+                index.setdefault(name, []).append((offset, len(data), key_kind, count))
+                offset += len(data)
+                written += count
+
+            f.write(_dumps(index, None))
+            f.seek(0)
+            f.write(_HEADER.pack(_MAGIC, time(), offset))
+
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return written
+
+
+class Snapshot():
+    """A snapshot file mapped for restoring, sections are unpickled as they are taken."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.written_at, index_offset = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            self._mm.close()
+            raise ValueError(f'{path} is not a cachian snapshot')
+
+        self.index = _Unpickler(io.BytesIO(self._mm[index_offset:])).load()
+        self._lock = Lock()
+
+    def names(self):
+        with self._lock:
+            return list(self.index)
+
+    def take(self, name, key_kind):
+        """Entries of the sections of name with key_kind, each section can only be taken once."""
+
+        with self._lock:
+            sections = self.index.pop(name, ())
+            if self._mm is None:
+                return []
+
+            entries = []
+            for offset, length, section_kind, count in sections:
+                if section_kind == key_kind:
+                    entries.extend(_Unpickler(io.BytesIO(self._mm[offset:offset + length])).load())
+
+            # Nothing left to restore, unmap the file
+            if not self.index:
+                self._mm.close()
+                self._mm = None
+
+        return entries
+
+    def close(self):
+        with self._lock:
+            self.index = {}
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
@@ -0,0 +1,370 @@
+"""SQLite store on disk, for results that are large or should outlive the process.
+
+Entries live in a SQLite database in WAL mode, so any number of processes on the
+host read concurrently while one writes. Values below CACHIAN_SQLITE_INLINE bytes
+are pickled into the database. Larger values are written to a file of their own
+next to it and memory mapped on reads: numpy arrays and other out-of-band pickle
+buffers are loaded as copy-on-write views of the mapping, so a hit on a 1GB array
+doesn't copy it.
+
+Usage:
+    from cachian import Cachian
+    from cachian.sqlite_store import SqliteStore
+
+    @Cachian(cache_class=SqliteStore, ttl=86400, maxsize=1000)
+    def my_function(x):
+        return expensive_computation(x)
+
+maxsize, TTL and LRU/FIFO eviction are enforced in the database by whichever
+process inserts: each insert deletes a few expired entries, then the least
+recently used (or oldest with FIFO) while the table is full. Recency is written
+at most once a second per entry, so hits rarely write.
+
+Each cached function has its own database named after its qualified name.
+Databases are kept across restarts, unlink() removes one.
+
+Environment variables:
+    CACHIAN_SQLITE_DIR:    Directory for databases (default: ~/.cache/cachian)
+    CACHIAN_SQLITE_INLINE: Values of at least this many bytes get their own file (default: 64KB)
+    CACHIAN_SQLITE_MMAP:   Bytes of each database SQLite reads through mmap (default: 256MB)
+
+Note: needs SQLite 3.24 or later. Values must be picklable. len() counts expired entries until they are
+deleted. Value files written by a process killed before it committed the entry
+are left behind until unlink().
+"""
+
+import mmap
+import os
+import pickle
+import re
+import shutil
+import sqlite3
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from threading import Lock, local
+from time import time
+from .keys import key_partition, MISS
+from .serializers import PickleSerializer
+
+
+CACHIAN_SQLITE_DIR = os.getenv('CACHIAN_SQLITE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cachian'))
+CACHIAN_SQLITE_INLINE = int(os.getenv('CACHIAN_SQLITE_INLINE', str(64 * 1024)))
+CACHIAN_SQLITE_MMAP = int(os.getenv('CACHIAN_SQLITE_MMAP', str(256 * 1024 * 1024)))
+
+_BUSY_TIMEOUT = 30  # Seconds a writer waits for another process's transaction
+_TOUCH_INTERVAL = 1.0  # Seconds between recency updates of an entry
+_PURGE_BATCH = 16  # Expired entries deleted per insert
+_MAX_VARIABLES = 500  # Keys per query in get_many()
+_MIN_SQLITE_VERSION = (3, 24, 0)  # UPSERT
+
+# meta.count is kept by triggers, COUNT(*) would scan the table on every insert
+_SCHEMA = '''
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    partition TEXT NOT NULL,
+    value BLOB,
+    file TEXT,
+    expire_at REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_partition ON entries (partition);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_expire_at ON entries (expire_at) WHERE expire_at > 0;
+CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), count INTEGER NOT NULL, evictions INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN UPDATE meta SET count = count + 1; END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN UPDATE meta SET count = count - 1; END;
+CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, expire_at REAL NOT NULL);
+COMMIT;
+'''
+
+_UPSERT = '''INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE
+SET value = excluded.value, file = excluded.file, expire_at = excluded.expire_at, accessed = excluded.accessed'''
+
+
+class SqliteStore(MutableMapping):
+    """Database file shared by every process on the host.
+
+    Cachian passes its maxsize, ttl and eviction settings through configure() and
+    uses lookup()/insert(), which enforce them in the database.
+    """
+
+    def __init__(self, name=None, path=None, inline_size=None):
+        if sqlite3.sqlite_version_info < _MIN_SQLITE_VERSION:
+            raise RuntimeError(f'SqliteStore needs SQLite {".".join(map(str, _MIN_SQLITE_VERSION))} or later, Python is linked against {sqlite3.sqlite_version}')
+
+        self.name = name or 'default'
+        self._fixed_name = name is not None or path is not None
+        self._path = path
+        self.inline_size = CACHIAN_SQLITE_INLINE if inline_size is None else inline_size
+        self.serializer = PickleSerializer()
+
+        self.maxsize = -1
+        self.ttl = -1
+        self.track_recency = True
+
+        # sqlite3 connections can't be shared by threads or across fork(), one per thread and process
+        self._local = local()
+        self._connections = []
+        self._lock = Lock()
+
+    def set_namespace(self, namespace):
+        if not self._fixed_name:
+            self.name = namespace
+
+    def configure(self, maxsize=-1, ttl=-1, eviction='lru'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.track_recency = eviction == 'lru'
+
+    @property
+    def path(self):
+        if self._path is not None:
+            return self._path
+        safe_name = re.sub(r'[^A-Za-z0-9._-]', '_', self.name)[:100]
+        return os.path.join(CACHIAN_SQLITE_DIR, f'cachian-{safe_name}-{zlib.crc32(self.name.encode()):08x}.sqlite')
+
+    @property
+    def values_dir(self):
+        return self.path + '-values'
+
+    # Opened on first use, after Cachian has set the namespace
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(self.values_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # Durable at checkpoints, enough for a cache
+        conn.execute(f'PRAGMA mmap_size={CACHIAN_SQLITE_MMAP}')
+        conn.executescript(_SCHEMA)
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')  # Take the write lock now, a deferred upgrade can't wait for it
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # (blob, file), large values are written to a new file before the entry is committed
+    def _dump(self, value):
+        parts = self.serializer.dump_parts(value)
+        size = sum(memoryview(part).nbytes for part in parts)
+
+        if size < self.inline_size:
+            if len(parts) == 2:
+                return parts[1], None  # No out-of-band buffers, the stream is a plain pickle
+            return pickle.dumps(value, pickle.HIGHEST_PROTOCOL), None
+
+        file = f'{os.urandom(12).hex()}.value'
+        with open(os.path.join(self.values_dir, file), 'wb') as f:
+            f.writelines(parts)
+        return None, file
+
+    def _load(self, blob, file):
+        if file is None:
+            return pickle.loads(blob)
+
+        try:
+            with open(os.path.join(self.values_dir, file), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except FileNotFoundError:
+            return MISS  # Replaced or removed since the row was read
+
+        # Buffers are views of the mapping, which stays open while they are referenced
+        return self.serializer.loads(mm)
+
+    def _unlink(self, files):
+        for file in files:
+            if file is not None:
+                try:
+                    os.unlink(os.path.join(self.values_dir, file))
+                except FileNotFoundError:
+                    pass
+
+    def _fresh(self, conn, key, row, now):
+        blob, file, expire_at, accessed = row
+        if expire_at and now > expire_at:
+            return MISS
+        if self.track_recency and now - accessed > _TOUCH_INTERVAL:
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return self._load(blob, file)
+
+    # MISS when the key doesn't exist or has expired
+    def lookup(self, key):
+        conn = self._connection()
+        row = conn.execute('SELECT value, file, expire_at, accessed FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return MISS
+        return self._fresh(conn, key, row, time())
+
+    def get_many(self, keys):
+        conn = self._connection()
+        now = time()
+        found = {}
+        for i in range(0, len(keys), _MAX_VARIABLES):
+            chunk = keys[i:i + _MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            for key, *row in conn.execute(f'SELECT key, value, file, expire_at, accessed FROM entries WHERE key IN ({placeholders})', chunk):
+                found[key] = row
+
+        return [self._fresh(conn, key, found[key], now) if key in found else MISS for key in keys]
+
+    # Set with TTL, evicting for maxsize first
+    def insert(self, key, value, ttl=None):
+        self.insert_many([(key, value, ttl)])
+
+    def insert_many(self, entries):
+        self._connection()  # Creates the values directory
+        now = time()
+        rows = []
+        written = []
+        try:
+            for key, value, ttl in entries:
+                ttl = self.ttl if ttl is None else ttl
+                blob, file = self._dump(value)
+                written.append(file)
+                rows.append((key, key_partition(key), blob, file, now + ttl if ttl > 0 else 0.0, now))
+
+            removed = []
+            with self._transaction() as conn:
+                for row in rows:
+                    replaced = conn.execute('SELECT file FROM entries WHERE key = ?', (row[0],)).fetchone()
+                    if replaced is not None:
+                        removed.append(replaced[0])
+                    else:
+                        self._make_room(conn, now, removed)
+                    conn.execute(_UPSERT, row)
+        except BaseException:
+            self._unlink(written)
+            raise
+
+        self._unlink(removed)
+
+    def _make_room(self, conn, now, removed):
+        # A few expired entries per insert, so entries that are never read again are deleted
+        expired = conn.execute('SELECT rowid, file FROM entries WHERE expire_at > 0 AND expire_at < ? LIMIT ?', (now, _PURGE_BATCH)).fetchall()
+        self._delete_rows(conn, expired, removed)
+
+        if self.maxsize <= 0:
+            return
+
+        count, = conn.execute('SELECT count FROM meta').fetchone()
+        excess = count - self.maxsize + 1
+        if excess > 0:
+            # accessed is only updated on hits with LRU, so it's the insertion time with FIFO
+            evicted = conn.execute('SELECT rowid, file FROM entries ORDER BY accessed LIMIT ?', (excess,)).fetchall()
+            self._delete_rows(conn, evicted, removed)
+            conn.execute('UPDATE meta SET evictions = evictions + ?', (len(evicted),))
+
+    # Rows of (rowid, file) selected in the same transaction. Selected then deleted rather
+    # than DELETE ... RETURNING, which needs SQLite 3.35
+    def _delete_rows(self, conn, rows, removed):
+        conn.executemany('DELETE FROM entries WHERE rowid = ?', [(rowid,) for rowid, file in rows])
+        removed.extend(file for rowid, file in rows)
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return default if value is MISS else value
+
+    def __getitem__(self, key):
+        value = self.lookup(key)
+        if value is MISS:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.insert(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, MISS) is MISS:
+            raise KeyError(key)
+
+    def pop(self, key, *args):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT value, file FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+        if row is not None:
+            value = self._load(*row)
+            self._unlink([row[1]])
+            if value is not MISS:
+                return value
+
+        if args:
+            return args[0]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.lookup(key) is not MISS
+
+    def __len__(self):
+        return self._connection().execute('SELECT count FROM meta').fetchone()[0]
+
+    def __iter__(self):
+        return iter([key for key, in self._connection().execute('SELECT key FROM entries')])
+
+    def set_many(self, items):
+        self.insert_many([(key, value, None) for key, value in items.items()])
+
+    def remove_partition(self, partition_value):
+        with self._transaction() as conn:
+            files = conn.execute('SELECT file FROM entries WHERE partition = ?', (partition_value,)).fetchall()
+            conn.execute('DELETE FROM entries WHERE partition = ?', (partition_value,))
+
+        self._unlink(file for file, in files)
+        return len(files)
+
+    def clear(self):
+        with self._transaction() as conn:
+            files = conn.execute('SELECT file FROM entries').fetchall()
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM flights')
+
+        self._unlink(file for file, in files)
+
+    def stats(self):
+        count, evictions = self._connection().execute('SELECT count, evictions FROM meta').fetchone()
+        return {'count': count, 'evictions': evictions}
+
+    # Cross-process single-flight with a row that expires after timeout, so a crashed
+    # worker can't block others
+    def acquire_flight(self, key, timeout):
+        now = time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM flights WHERE key = ? AND expire_at < ?', (key, now))
+            return conn.execute('INSERT OR IGNORE INTO flights VALUES (?, ?)', (key, now + timeout)).rowcount == 1
+
+    def release_flight(self, key):
+        self._connection().execute('DELETE FROM flights WHERE key = ?', (key,))
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = local()
+
+    def unlink(self):
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.path + suffix)
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(self.values_dir, ignore_errors=True)
@@ -1,4 +1,5 @@
 import os
+import sys
 os.environ["CACHIAN_DEBUG"] = "1"
 os.environ["CACHIAN_ENABLE"] = "1"
 
@@ -7,11 +8,18 @@ load_dotenv()
 
 
 from datetime import datetime, timedelta
-from functools import lru_cache
-from time import sleep,perf_counter
+from functools import lru_cache, partial
+from time import sleep,perf_counter,time
+import random
+import threading
+import gc
+import asyncio
 import unittest
-from cachian import Cachian, function_cache_clear_by_partition
+from cachian import Cachian, get_param_hash, get_compact_key, build_compact_key, function_cache_clear_by_partition, function_cache_reset, function_cache_reset_by_class, function_cache_reset_by_classname, get_all_wrappers, global_cache_info, build_param_hash, register_key_function, unregister_key_function, canonicalize, SWEEP_BATCH_SIZE, EXPIRY_INDEX_MIN_SIZE
 from uuid import uuid4
+from cachian.admission import FrequencySketch
+from cachian.memory_store import MemoryStore
+from cachian.keys import BUFFER_KEY_MIN_BYTES
 
 TTL_SECONDS = 5
 
@@ -26,7 +34,38 @@ class Dummy:
         return f'{key}_{value}'
     
 
-from cachian.redis_store import RedisStore
+class AsyncDummy:
+
+    @Cachian(test_mode=True)
+    async def get_id(self,key):
+        return key
+    
+
+
+from cachian.redis_store import RedisStore, CACHIAN_REDIS_HOST, CACHIAN_REDIS_PORT, CACHIAN_REDIS_DB, CACHIAN_REDIS_PASSWORD, CACHIAN_REDIS_SSL
+from cachian.redis_ttl_store import RedisTTLStore
+
+async def run_hit(func, test):
+    test.assertEqual(await func(1, 2), 'hit')
+
+
+class BatchRepository:
+
+    @Cachian(batch=True,ttl=1,test_mode=True)
+    def get_by_ids(self, ids):
+        return {id: id for id in ids}
+
+
+class RegistryRepository:
+
+    @Cachian(test_mode=True)
+    def get(self, id):
+        return id
+
+    @Cachian(test_mode=True)
+    def get_many(self, id):
+        return id
+
 
 class DummyRedis:
     @Cachian(cache_class=RedisStore,test_mode=True)
@@ -43,12 +82,117 @@ class CachianRedisBackendTestCase(unittest.TestCase):
     def test_get_set(self):
 
         dummy = DummyRedis()
-        
+        DummyRedis.__dict__['get_id_redis'].clear_all()
+
         self.assertEqual(dummy.get_id_redis('jkl','1'), 'miss')
         self.assertEqual(dummy.get_id_redis('jkl','1'), 'hit')
         self.assertEqual(dummy.get_id_redis('yui','1'), 'miss')
         self.assertEqual(dummy.get_id_redis('yui','1'), 'hit')    
 
+    def test_async_get_set(self):
+
+        @Cachian(cache_class=RedisStore,test_mode=True)
+        async def add_redis(a, b):
+            return a+b
+
+        add_redis.clear_all()
+
+        async def run():
+            self.assertEqual(await add_redis(1, 2), 'miss')
+            self.assertEqual(await add_redis(1, 2), 'hit')
+
+        asyncio.run(run())
+        # A new event loop gets its own async client
+        asyncio.run(run_hit(add_redis, self))
+
+    def test_namespace_per_function(self):
+
+        @Cachian(cache_class=RedisStore)
+        def add(a, b):
+            return a+b
+
+        @Cachian(cache_class=RedisStore)
+        def sub(a, b):
+            return a-b
+
+        add.clear_all()
+        sub.clear_all()
+        self.assertEqual(add(3, 1), 4)
+        self.assertEqual(sub(3, 1), 2)
+        self.assertNotEqual(add.parent.cache_lib.name, sub.parent.cache_lib.name)
+        self.assertTrue(add.parent.cache_lib.name.endswith('test_namespace_per_function.<locals>.add'))
+
+        sub.clear_all()
+        self.assertEqual(len(add), 1)
+
+    def test_shared_client_and_warm_start(self):
+
+        def add(a, b):
+            return a+b
+
+        first = Cachian(cache_class=RedisStore,test_mode=True)(add)
+        first.clear_all()
+        self.assertEqual(first(1, 2), 'miss')
+
+        # Decorating again, e.g. after a restart, keeps the entries other processes warmed
+        second = Cachian(cache_class=RedisStore,test_mode=True)(add)
+        self.assertIs(first.parent.cache_lib.redis, second.parent.cache_lib.redis)
+        self.assertEqual(second(1, 2), 'hit')
+        second.clear_all()
+
+    def test_flight_lock(self):
+
+        store = RedisStore()
+        store.redis.delete(store._flight_name('flight_key'))
+
+        self.assertTrue(store.acquire_flight('flight_key', 5))
+        self.assertFalse(store.acquire_flight('flight_key', 5))
+        store.release_flight('flight_key')
+        self.assertTrue(store.acquire_flight('flight_key', 5))
+        store.release_flight('flight_key')
+
+    def test_flight_lock_owner(self):
+
+        for cache_class in (RedisStore, RedisTTLStore):
+            first = cache_class()
+            second = cache_class()
+            first.redis.delete(first._flight_name('flight_key'))
+
+            self.assertTrue(first.acquire_flight('flight_key', 5))
+            # The first worker's lock expires and another worker takes it
+            first.redis.delete(first._flight_name('flight_key'))
+            self.assertTrue(second.acquire_flight('flight_key', 5))
+
+            # Releasing the expired lock leaves the other worker's lock in place
+            first.release_flight('flight_key')
+            self.assertFalse(first.acquire_flight('flight_key', 5))
+            second.release_flight('flight_key')
+            self.assertTrue(first.acquire_flight('flight_key', 5))
+            first.release_flight('flight_key')
+
+    def test_async_injected_client(self):
+        import redis
+
+        # Another database on the configured server, apart from the shared client's
+        client = redis.StrictRedis(host=CACHIAN_REDIS_HOST, port=CACHIAN_REDIS_PORT, db=CACHIAN_REDIS_DB + 1, password=CACHIAN_REDIS_PASSWORD, ssl=CACHIAN_REDIS_SSL)
+
+        @Cachian(cache_class=partial(RedisTTLStore, client=client),ttl=60,test_mode=True)
+        async def add(a, b):
+            return a+b
+
+        add.clear_all()
+
+        async def run():
+            self.assertEqual(await add(1, 2), 'miss')
+            self.assertEqual(await add(1, 2), 'hit')
+
+        asyncio.run(run())
+        # A new event loop gets its own async client, on the same database
+        asyncio.run(run_hit(add, self))
+        self.assertEqual(len(add), 1)
+        self.assertTrue(client.exists(add.parent.cache_lib._entry_name(next(iter(add.parent.cache_lib)))))
+        add.clear_all()
+
 
     def test_cache_benchmark(self):
 
@@ -323,4 +467,1568 @@ class CachianTestCase(unittest.TestCase):
     def test_function_name(self):
 
         add = self.add
-        self.assertEqual(add.function_name(), 'add')
\ No newline at end of file
+        self.assertEqual(add.function_name(), 'add')
+
+
+class CachianEvictionTestCase(unittest.TestCase):
+
+    def test_lru_eviction(self):
+
+        @Cachian(maxsize=2,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(2, 2), 'miss')
+        self.assertEqual(add(1, 1), 'hit')  # Promotes (1, 1)
+        self.assertEqual(add(3, 3), 'miss')  # Evicts (2, 2)
+        self.assertEqual(add(1, 1), 'hit')
+        self.assertEqual(add(2, 2), 'miss')
+
+    def test_fifo_eviction(self):
+
+        @Cachian(maxsize=2,eviction='fifo',test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(2, 2), 'miss')
+        self.assertEqual(add(1, 1), 'hit')
+        self.assertEqual(add(3, 3), 'miss')  # Evicts (1, 1) as it was inserted first
+        self.assertEqual(add(1, 1), 'miss')
+
+    def test_unknown_eviction(self):
+
+        with self.assertRaises(ValueError):
+            Cachian(eviction='random')
+
+    def test_eviction_benchmark(self):
+        run_count = 200000
+        maxsize = 100
+        hot_keys = 50
+
+        # 80% of calls go to a small hot set, the rest are one-off cold keys
+        rng = random.Random(42)
+        workload = [rng.randrange(hot_keys) if rng.random() < 0.8 else hot_keys + rng.randrange(100000) for _ in range(run_count)]
+
+        for eviction in ('fifo', 'lru'):
+
+            @Cachian(maxsize=maxsize,eviction=eviction)
+            def square(a):
+                return a*a
+
+            before=perf_counter()
+            for a in workload:
+                square(a)
+            after=perf_counter()
+
+            info = square.cache_info()
+            hit_rate = info['hit'] / run_count
+            print(f'Cachian {eviction}: hit rate {hit_rate:.3f}, duration {after-before:.3f}s')
+
+
+
+class CachianAdmissionTestCase(unittest.TestCase):
+
+    def test_sketch(self):
+        sketch = FrequencySketch(100)
+        for i in range(5):
+            sketch.increment('hot')
+        sketch.increment('cold')
+
+        self.assertEqual(sketch.estimate('hot'), 5)
+        self.assertEqual(sketch.estimate('cold'), 1)
+        self.assertEqual(sketch.estimate('unseen'), 0)
+
+        sketch.age()
+        self.assertEqual(sketch.estimate('hot'), 2)
+        self.assertEqual(sketch.estimate('cold'), 0)
+
+    def test_sketch_ages(self):
+        sketch = FrequencySketch(16)
+        for i in range(20):
+            sketch.increment('hot')
+        self.assertEqual(sketch.estimate('hot'), 15)  # Counters saturate
+
+        for i in range(sketch.sample_size):
+            sketch.increment(i)
+        self.assertLess(sketch.estimate('hot'), 15)
+
+    def test_scan_keeps_working_set(self):
+
+        @Cachian(maxsize=10,admission='tinylfu',test_mode=True)
+        def add(a, b):
+            return a+b
+
+        for i in range(10):
+            for key in range(10):
+                add(key, key)
+
+        # One-off keys are seen once, less than the least recently used hot key
+        for key in range(100, 150):
+            self.assertEqual(add(key, key), 'miss')
+
+        for key in range(10):
+            self.assertEqual(add(key, key), 'hit')
+        self.assertEqual(add.cache_info()['rejections'], 50)
+
+    def test_popular_key_is_admitted(self):
+
+        @Cachian(maxsize=2,admission='tinylfu',test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add(1, 1)
+        add(2, 2)
+        self.assertEqual(add(3, 3), 'miss')
+        self.assertEqual(add(3, 3), 'miss')
+        self.assertEqual(add(3, 3), 'hit')
+
+    def test_needs_maxsize(self):
+        with self.assertRaises(ValueError):
+            Cachian(admission='tinylfu')
+        with self.assertRaises(ValueError):
+            Cachian(maxsize=10,admission='lfu')
+
+    def test_admission_benchmark(self):
+        import numpy as np
+        maxsize = 1000
+        rng = np.random.default_rng(42)
+
+        # Zipf: a long tail of rarely repeated keys. Scan: a hot set with bursts of one-off keys.
+        zipf = [int(key) for key in rng.zipf(1.1, 100000)]
+        scan = []
+        for round in range(40):
+            scan += [int(key) for key in rng.integers(0, 500, 2000)]
+            scan += range(1000000 + round * 2000, 1000000 + (round + 1) * 2000)
+
+        for workload_name, workload in (('zipf', zipf), ('scan', scan)):
+            for admission in (None, 'tinylfu'):
+
+                @Cachian(maxsize=maxsize,admission=admission,key_mode='fast')
+                def find(id):
+                    return id
+
+                before=perf_counter()
+                for key in workload:
+                    find(key)
+                duration = perf_counter() - before
+
+                info = find.cache_info()
+                print(f'{workload_name} admission={admission}: hit rate {info["hit"]/len(workload):.3f}, {duration/len(workload)*1e6:.2f}us per call')
+
+
+class CachianLockingTestCase(unittest.TestCase):
+
+    def test_per_instance_lock(self):
+
+        @Cachian()
+        def add(a, b):
+            return a+b
+
+        @Cachian()
+        def sub(a, b):
+            return a-b
+
+        self.assertIsNot(add.parent.lock, sub.parent.lock)
+
+        # Holding one function's lock doesn't block another cached function
+        with add.parent.lock:
+            self.assertEqual(sub(3, 1), 2)
+
+    def test_lock_stripes(self):
+
+        @Cachian(maxsize=50,lock_stripes=8)
+        def add(a, b):
+            return a+b
+
+        def worker(offset):
+            for i in range(2000):
+                self.assertEqual(add(i % 100, offset), i % 100 + offset)
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(add.parent._locks), 8)
+        self.assertLessEqual(len(add), 50)
+
+    def test_thread_scaling_benchmark(self):
+        calls_per_thread = 50000
+
+        for lock_stripes in (1, 16):
+            for thread_count in (1, 2, 4, 8):
+
+                @Cachian(lock_stripes=lock_stripes)
+                def add(a, b):
+                    return a+b
+
+                def worker():
+                    for i in range(calls_per_thread):
+                        add(i % 1000, 1)
+
+                threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+                before=perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                after=perf_counter()
+
+                throughput = calls_per_thread * thread_count / (after-before)
+                print(f'Cachian lock_stripes={lock_stripes} threads={thread_count}: {throughput:,.0f} calls/s')
+
+
+
+class CachianSingleFlightTestCase(unittest.TestCase):
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+
+        @Cachian(single_flight=True)
+        def slow_add(a, b):
+            calls.append((a, b))
+            sleep(0.2)
+            return a+b
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow_add(1, 2))) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [3]*10)
+        self.assertEqual(slow_add.cache_info(), slow_add.cache_info()|{'hit':9,'miss':1})
+
+    def test_error_is_shared(self):
+        calls = []
+
+        @Cachian(single_flight=True)
+        def failing(a):
+            calls.append(a)
+            sleep(0.2)
+            raise ValueError(a)
+
+        errors = []
+
+        def worker():
+            try:
+                failing(1)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(errors), 5)
+        self.assertEqual(len(failing.parent._flights), 0)
+
+
+
+class CachianStaleWhileRevalidateTestCase(unittest.TestCase):
+
+    def wait_for_refresh(self, func):
+        for _ in range(100):
+            if not func.parent._refreshing:
+                return
+            sleep(0.01)
+
+    def test_stale_is_served_then_refreshed(self):
+        calls = []
+
+        @Cachian(ttl=1,stale_ttl=5)
+        def version(id):
+            calls.append(id)
+            return len(calls)
+
+        self.assertEqual(version(1), 1)
+        sleep(1.1)
+
+        # Served without waiting for the refresh
+        self.assertEqual(version(1), 1)
+        self.wait_for_refresh(version)
+        self.assertEqual(version(1), 2)
+        self.assertEqual(version.cache_info()['refreshes'], 1)
+
+    def test_one_refresh_per_key(self):
+        calls = []
+
+        @Cachian(ttl=1,stale_ttl=5,test_mode=True)
+        def slow(id):
+            calls.append(id)
+            sleep(0.2)
+            return id
+
+        slow(1)
+        sleep(1.1)
+        self.assertEqual([slow(1) for _ in range(10)], ['stale']*10)
+        self.wait_for_refresh(slow)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(slow(1), 'hit')
+
+    def test_refresh_error_keeps_stale_entry(self):
+        fail = []
+
+        @Cachian(ttl=1,stale_ttl=5)
+        def load(id):
+            if fail:
+                raise ValueError(id)
+            return id
+
+        load(1)
+        fail.append(True)
+        sleep(1.1)
+        self.assertEqual(load(1), 1)
+        self.wait_for_refresh(load)
+        self.assertEqual(load(1), 1)
+        self.wait_for_refresh(load)
+        self.assertEqual(load.cache_info()['refresh_errors'], 2)
+
+    def test_expires_after_stale_ttl(self):
+
+        @Cachian(ttl=1,stale_ttl=1,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        sleep(2.1)
+        self.assertEqual(add(1, 2), 'miss')
+
+    def test_needs_ttl(self):
+        with self.assertRaises(ValueError):
+            Cachian(stale_ttl=5)
+
+    def test_async(self):
+        calls = []
+
+        @Cachian(ttl=1,stale_ttl=5)
+        async def version(id):
+            calls.append(id)
+            await asyncio.sleep(0.1)
+            return len(calls)
+
+        async def run():
+            self.assertEqual(await version(1), 1)
+            await asyncio.sleep(1.1)
+            self.assertEqual(await asyncio.gather(*[version(1) for _ in range(5)]), [1]*5)
+            await asyncio.sleep(0.2)
+            self.assertEqual(await version(1), 2)
+
+        asyncio.run(run())
+        self.assertEqual(len(calls), 2)
+
+    def test_batch_recomputes_stale(self):
+
+        @Cachian(ttl=1,stale_ttl=5,batch=True,test_mode=True)
+        def load(ids):
+            return {id: id for id in ids}
+
+        load([1, 2])
+        sleep(1.1)
+        self.assertEqual(load([1, 2, 3]), {1: 'miss', 2: 'miss', 3: 'miss'})
+        self.assertEqual(load([1, 2, 3]), {1: 'hit', 2: 'hit', 3: 'hit'})
+
+    def test_expiry_latency_benchmark(self):
+        run_count = 200
+
+        for stale_ttl in (0, 5):
+
+            @Cachian(ttl=0.05,stale_ttl=stale_ttl)
+            def slow(id):
+                sleep(0.01)
+                return id
+
+            # Calls every 5ms with a 50ms TTL, without stale_ttl about 1 call in 10 lands on an expired entry
+            slow(1)
+            worst = 0
+            before = perf_counter()
+            for i in range(run_count):
+                call = perf_counter()
+                slow(1)
+                worst = max(worst, perf_counter() - call)
+                sleep(0.005)
+            duration = perf_counter() - before
+
+            print(f'Cachian stale_ttl={stale_ttl}: {(duration/run_count - 0.005)*1e6:.0f}us mean, {worst*1e3:.1f}ms worst call')
+
+
+class CachianRefreshAheadTestCase(unittest.TestCase):
+
+    def wait_for_refresh(self, func):
+        for _ in range(100):
+            if not func.parent._refreshing:
+                return
+            sleep(0.01)
+
+    def test_hot_key_refreshed_before_expiry(self):
+        calls = []
+
+        @Cachian(ttl=1,refresh_ahead=0.5,refresh_ahead_hits=3)
+        def version(id):
+            calls.append(id)
+            return len(calls)
+
+        for _ in range(4):
+            self.assertEqual(version(1), 1)
+
+        sleep(0.6)
+        self.assertEqual(version(1), 1)
+        self.wait_for_refresh(version)
+        self.assertEqual(version(1), 2)
+
+        # Past the first entry's TTL, still no miss
+        sleep(0.5)
+        self.assertEqual(version(1), 2)
+        self.assertEqual(version.cache_info(), version.cache_info()|{'miss':1,'refreshes':1})
+
+    def test_cold_key_expires(self):
+        calls = []
+
+        @Cachian(ttl=1,refresh_ahead=0.5,refresh_ahead_hits=3,test_mode=True)
+        def load(id):
+            calls.append(id)
+            return id
+
+        load(1)
+        sleep(0.6)
+        self.assertEqual(load(1), 'hit')
+        self.wait_for_refresh(load)
+        self.assertEqual(len(calls), 1)
+        sleep(0.5)
+        self.assertEqual(load(1), 'miss')
+
+    def test_hits_fade_with_time(self):
+        calls = []
+
+        @Cachian(ttl=1,refresh_ahead=0.5,refresh_ahead_hits=3,test_mode=True)
+        def load(id):
+            calls.append(id)
+            return id
+
+        for _ in range(10):
+            load(1)
+
+        # Hot three TTLs ago, the hits are worth one now
+        sleep(3.1)
+        self.assertEqual(load(1), 'miss')
+        sleep(0.6)
+        self.assertEqual(load(1), 'hit')
+        self.wait_for_refresh(load)
+        self.assertEqual(len(calls), 2)
+
+    def test_with_admission(self):
+        calls = []
+
+        @Cachian(ttl=1,maxsize=10,admission='tinylfu',refresh_ahead=0.5,refresh_ahead_hits=3)
+        def load(id):
+            calls.append(id)
+            return id
+
+        for _ in range(4):
+            load(1)
+        sleep(0.6)
+        load(1)
+        self.wait_for_refresh(load)
+        self.assertEqual(len(calls), 2)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            Cachian(ttl=60,refresh_ahead=1.5)
+        with self.assertRaises(ValueError):
+            Cachian(refresh_ahead=0.2)
+        with self.assertRaises(ValueError):
+            Cachian(ttl=60,refresh_ahead=0.2,refresh_ahead_hits=20)
+
+    def test_async(self):
+        calls = []
+
+        @Cachian(ttl=1,refresh_ahead=0.5,refresh_ahead_hits=3)
+        async def version(id):
+            calls.append(id)
+            return len(calls)
+
+        async def run():
+            for _ in range(4):
+                await version(1)
+            await asyncio.sleep(0.6)
+            self.assertEqual(await version(1), 1)
+            await asyncio.sleep(0.1)
+            self.assertEqual(await version(1), 2)
+
+        asyncio.run(run())
+
+    def test_refresh_ahead_benchmark(self):
+        run_count = 400
+
+        for refresh_ahead in (0, 0.2):
+
+            @Cachian(ttl=0.1,refresh_ahead=refresh_ahead)
+            def slow(id):
+                sleep(0.01)
+                return id
+
+            # A hot key called every 2ms with a 100ms TTL and a 10ms function
+            before = perf_counter()
+            for i in range(run_count):
+                slow(1)
+                sleep(0.002)
+            duration = perf_counter() - before
+
+            info = slow.cache_info()
+            print(f'Cachian refresh_ahead={refresh_ahead}: {info["miss"]} misses, {info.get("refreshes", 0)} refreshes, {(duration/run_count - 0.002)*1e6:.0f}us mean')
+
+
+class CachianAsyncTestCase(unittest.TestCase):
+
+    def test_get_set(self):
+
+        @Cachian(test_mode=True)
+        async def add(a, b):
+            return a+b
+
+        async def run():
+            self.assertEqual(await add(1, 2), 'miss')
+            self.assertEqual(await add(1, 2), 'hit')
+            self.assertEqual(await add(2, 2), 'miss')
+
+        asyncio.run(run())
+
+    def test_caches_awaited_result(self):
+
+        @Cachian()
+        async def add(a, b):
+            await asyncio.sleep(0)
+            return a+b
+
+        async def run():
+            self.assertEqual(await add(1, 2), 3)
+            self.assertEqual(await add(1, 2), 3)
+
+        asyncio.run(run())
+
+    def test_concurrent_awaiters_join(self):
+        calls = []
+
+        @Cachian()
+        async def slow_add(a, b):
+            calls.append((a, b))
+            await asyncio.sleep(0.1)
+            return a+b
+
+        async def run():
+            return await asyncio.gather(*[slow_add(1, 2) for _ in range(10)])
+
+        self.assertEqual(asyncio.run(run()), [3]*10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(slow_add.cache_info(), slow_add.cache_info()|{'hit':9,'miss':1})
+
+    def test_error_is_shared(self):
+        calls = []
+
+        @Cachian()
+        async def failing(a):
+            calls.append(a)
+            await asyncio.sleep(0.1)
+            raise ValueError(a)
+
+        async def run():
+            return await asyncio.gather(*[failing(1) for _ in range(5)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_method(self):
+
+        async def run():
+            dummy = AsyncDummy()
+            self.assertEqual(await dummy.get_id('abc'), 'miss')
+            self.assertEqual(await dummy.get_id('abc'), 'hit')
+
+        asyncio.run(run())
+
+
+
+class CachianFastKeyTestCase(unittest.TestCase):
+
+    def test_get_set(self):
+
+        @Cachian(key_mode='fast',test_mode=True)
+        def pair(a, b=0):
+            return (a, b)
+
+        self.assertEqual(pair(1, 2), 'miss')
+        self.assertEqual(pair(1, 2), 'hit')
+        self.assertEqual(pair(1, b=2), 'miss')
+        self.assertEqual(pair(1, b=2), 'hit')
+        self.assertEqual(pair(1), 'miss')
+        self.assertEqual(pair((1,)), 'miss')
+        self.assertEqual(pair(1), 'hit')
+        self.assertEqual(len(pair), 4)
+
+    def test_partition(self):
+
+        @Cachian(key_mode='fast',partition_attr=0,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(11, 2), 'miss')
+        add.clear('1')
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(11, 2), 'hit')
+
+    def test_remote_store_uses_hashed_keys(self):
+
+        @Cachian(key_mode='fast',cache_class=RedisStore,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertIs(add.parent.key_func, build_param_hash)
+        add.clear_all()
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 2), 'hit')
+
+    def test_key_overhead_benchmark(self):
+        run_count = 500000
+
+        def add(a, b):
+            return a+b
+
+        # hot: repeated args within get_param_hash's lru_cache, wide: every call has new args
+        workloads = {
+            'hot': [(i % 100, i % 100) for i in range(run_count)],
+            'wide': [(i, i) for i in range(run_count)],
+        }
+
+        for workload_name, workload in workloads.items():
+            durations = {}
+            candidates = {
+                'functools lru_cache': lru_cache(maxsize=10000)(add),
+                'Cachian hash keys': Cachian(maxsize=10000)(add),
+                'Cachian fast keys': Cachian(maxsize=10000,key_mode='fast')(add),
+            }
+
+            try:
+                from cachetools import cached, LRUCache
+                candidates['cachetools LRUCache'] = cached(cache=LRUCache(maxsize=10000))(add)
+            except ImportError:
+                print('cachetools package not installed. Run "pip install cachetools" to install and see benchmark results.')
+
+            for name, cached_add in candidates.items():
+                before=perf_counter()
+                for a, b in workload:
+                    cached_add(a, b)
+                after=perf_counter()
+
+                durations[name] = after-before
+                print(f'{workload_name} {name}: {(after-before)/run_count*1e9:.0f}ns per call')
+
+            print(f'{workload_name} Cachian fast vs hash keys: ' + str(durations['Cachian fast keys']/durations['Cachian hash keys']))
+
+
+
+class CachianCompactTestCase(unittest.TestCase):
+
+    def test_get_set(self):
+
+        @Cachian(compact=True,test_mode=True)
+        def find(id):
+            return None if id < 0 else id
+
+        self.assertEqual(find(1), 'miss')
+        self.assertEqual(find(1), 'hit')
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(-1), 'hit')
+
+        # Entries are stored under an int key without a timestamp
+        self.assertEqual(find.parent.cache_lib.cache_lib[build_compact_key(1)], 1)
+        self.assertIs(type(find.parent.cache_lib.cache_lib), dict)
+
+    def test_results(self):
+
+        @Cachian(compact=True)
+        def pair(a, b):
+            return (a, b)
+
+        self.assertEqual(pair(1, 2), (1, 2))
+        self.assertEqual(pair(1, 2), (1, 2))
+        self.assertEqual(pair.cache_info(), pair.cache_info()|{'hit':1,'miss':1})
+
+    def test_ttl(self):
+
+        @Cachian(compact=True,ttl=1,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 2), 'hit')
+        sleep(1.1)
+        self.assertEqual(add(1, 2), 'miss')
+
+    def test_lru_eviction(self):
+
+        @Cachian(compact=True,maxsize=2,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add(1, 1)
+        add(2, 2)
+        add(1, 1)
+        add(3, 3)
+        self.assertEqual(add(1, 1), 'hit')
+        self.assertEqual(add(2, 2), 'miss')
+
+    def test_partition(self):
+
+        @Cachian(compact=True,partition_attr=0,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 3), 'miss')
+        self.assertEqual(add(11, 2), 'miss')
+        self.assertEqual(add.clear('1'), ('cleared', 2))
+        self.assertEqual(add.clear('2'), ('cleared', 0))
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(11, 2), 'hit')
+
+        # Partition values are kept once per cache, keys only hold an id
+        self.assertEqual(set(add.parent._partition_ids), {'1', '11'})
+
+        # Ids of cleared partitions are released and not reused
+        ids = dict(add.parent._partition_ids)
+        self.assertEqual(add.clear('11'), ('cleared', 1))
+        self.assertEqual(set(add.parent._partition_ids), {'1'})
+        self.assertEqual(add(11, 2), 'miss')
+        self.assertGreater(add.parent._partition_ids['11'], max(ids.values()))
+        add.clear_all()
+        self.assertEqual(add.parent._partition_ids, {})
+
+    def test_batch(self):
+
+        @Cachian(compact=True,batch=True,test_mode=True)
+        def find(ids):
+            return {id: id for id in ids}
+
+        self.assertEqual(find([1, 2]), {1: 'miss', 2: 'miss'})
+        self.assertEqual(find([1, 2, 3]), {1: 'hit', 2: 'hit', 3: 'miss'})
+
+    def test_remote_store(self):
+        with self.assertRaises(ValueError):
+            Cachian(compact=True,cache_class=RedisStore)
+
+    def test_memory_per_entry_benchmark(self):
+        import tracemalloc
+        entry_count = 100000
+
+        for ttl in (-1, 60):
+            for name, options in (('hash keys', {}), ('fast keys', {'key_mode': 'fast'}), ('compact', {'compact': True})):
+
+                @Cachian(ttl=ttl, **options)
+                def find(id):
+                    return id
+
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                for i in range(entry_count):
+                    find(i + 1000000)
+                get_param_hash.cache_clear()
+                get_compact_key.cache_clear()
+                after = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+
+                print(f'Cachian {name}, ttl={ttl}: {(after-before)/entry_count:.0f} bytes per entry')
+                find.clear_all()
+
+
+class CachianUnhashableKeyTestCase(unittest.TestCase):
+
+    def test_containers(self):
+
+        for key_mode in ('hash', 'fast'):
+
+            @Cachian(key_mode=key_mode,test_mode=True)
+            def total(values, weights=None):
+                return sum(values)
+
+            self.assertEqual(total([1, 2]), 'miss')
+            self.assertEqual(total([1, 2]), 'hit')
+            self.assertEqual(total((1, 2)), 'miss')
+            self.assertEqual(total([1, 2], weights={'a': 1, 'b': [2]}), 'miss')
+            self.assertEqual(total([1, 2], weights={'b': [2], 'a': 1}), 'hit')
+            self.assertEqual(total({3, 1, 2}), 'miss')
+            self.assertEqual(total({1, 2, 3}), 'hit')
+            self.assertEqual(total(bytearray(b'abc')), 'miss')
+            self.assertEqual(total(bytearray(b'abc')), 'hit')
+            self.assertEqual(total(bytearray(b'abd')), 'miss')
+
+    def test_numpy_arrays(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy not installed')
+
+        for key_mode in ('hash', 'fast'):
+
+            @Cachian(key_mode=key_mode,test_mode=True)
+            def score(values):
+                return values.sum()
+
+            values = np.arange(12, dtype=np.float64).reshape(3, 4)
+            self.assertEqual(score(values), 'miss')
+            self.assertEqual(score(values.copy()), 'hit')
+            self.assertEqual(score(values.reshape(4, 3)), 'miss')
+            self.assertEqual(score(values.T), 'miss')
+            self.assertEqual(score(values.T.copy()), 'hit')
+            self.assertEqual(score(values.astype(np.float32)), 'miss')
+
+            # Object arrays hold pointers, they are keyed by their pickled values
+            labels = np.array(['a', 'b', 'c'], dtype=object)
+            self.assertEqual(score(labels[:2]), 'miss')
+            self.assertEqual(score(labels[:2].copy()), 'hit')
+            self.assertEqual(score(np.array(['a', 'c'], dtype=object)), 'miss')
+
+            # datetime64 arrays have no buffer format, they are keyed by their pickled values too
+            @Cachian(key_mode=key_mode,test_mode=True)
+            def latest(dates):
+                return dates.max()
+
+            dates = np.array(['2024-01-01', '2024-06-01'], dtype='datetime64[D]')
+            self.assertEqual(latest(dates), 'miss')
+            self.assertEqual(latest(dates.copy()), 'hit')
+            self.assertEqual(latest(dates[:1]), 'miss')
+            self.assertEqual(latest(dates - np.timedelta64(1, 'D')), 'miss')
+
+    def test_large_bytes(self):
+
+        for key_mode in ('hash', 'fast'):
+
+            @Cachian(key_mode=key_mode,test_mode=True)
+            def checksum(data, salt=b''):
+                return len(data)
+
+            data = bytes(BUFFER_KEY_MIN_BYTES)
+            self.assertEqual(checksum(data), 'miss')
+            self.assertEqual(checksum(bytes(data)), 'hit')
+            self.assertEqual(checksum(data + b'1'), 'miss')
+            self.assertEqual(checksum(b'', salt=data), 'miss')
+            self.assertEqual(checksum(b'', salt=bytes(data)), 'hit')
+
+        # Hashed from the buffer, the same key as in a container
+        self.assertEqual(get_param_hash(data), get_param_hash(canonicalize(data)))
+
+    def test_registered_key_function(self):
+
+        class Patient:
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+
+        register_key_function(Patient, lambda p: p.id)
+        try:
+            for key_mode in ('hash', 'fast'):
+
+                @Cachian(key_mode=key_mode,test_mode=True)
+                def get_name(patient):
+                    return patient.name
+
+                self.assertEqual(get_name(Patient(1, 'a')), 'miss')
+                self.assertEqual(get_name(Patient(1, 'b')), 'hit')
+                self.assertEqual(get_name(Patient(2, 'a')), 'miss')
+        finally:
+            unregister_key_function(Patient)
+
+
+
+class CachianSweepTestCase(unittest.TestCase):
+
+    def test_sweep(self):
+
+        @Cachian(ttl=1)
+        def add(a, b):
+            return a+b
+
+        for i in range(100):
+            add(i, i)
+
+        self.assertEqual(add.parent.sweep(), 0)
+        sleep(1.1)
+        add(-1, -1)  # Re-added after the others expired, must be kept
+        self.assertEqual(len(add), 101 - SWEEP_BATCH_SIZE)
+        self.assertEqual(add.parent.sweep(), 100 - SWEEP_BATCH_SIZE)
+        self.assertEqual(len(add), 1)
+        self.assertEqual(add.cache_info()['swept'], 100)
+
+    def test_sweep_skips_readded_entries(self):
+
+        @Cachian(ttl=1,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add(1, 1)
+        sleep(1.1)
+        self.assertEqual(add(1, 1), 'miss')  # Expired on lookup and added again
+        self.assertEqual(add.parent.sweep(), 0)
+        self.assertEqual(add(1, 1), 'hit')
+
+    def test_index_is_compacted(self):
+
+        @Cachian(ttl=86400,maxsize=100)
+        def add(a, b):
+            return a+b
+
+        for i in range(20000):
+            add(i, i)
+
+        # Entries of evicted keys are dropped, not kept until they expire in a day
+        self.assertLessEqual(len(add.parent._expiry), EXPIRY_INDEX_MIN_SIZE + 1)
+        self.assertEqual(len(add), 100)
+
+        # Re-added keys keep their latest entry only
+        for i in range(2000):
+            add.parent.add(f'key{i % 10}', (i, time()))
+        self.assertLessEqual(len(add.parent._expiry), EXPIRY_INDEX_MIN_SIZE + 1)
+
+    def test_index_mixed_key_types(self):
+
+        @Cachian(batch=True,ttl=10,key_mode='fast',test_mode=True)
+        def get_by_ids(ids):
+            return {id: id for id in ids}
+
+        # Batch entries expire together, their keys must never be compared
+        self.assertEqual(get_by_ids([1, 'a', 2.5]), {1: 'miss', 'a': 'miss', 2.5: 'miss'})
+        self.assertEqual(get_by_ids([1, 'a', 2.5, None]), {1: 'hit', 'a': 'hit', 2.5: 'hit', None: 'miss'})
+        self.assertEqual(len(get_by_ids.parent._expiry), 4)
+
+    def test_background_sweeper(self):
+
+        @Cachian(ttl=1,sweep_interval=0.2)
+        def add(a, b):
+            return a+b
+
+        for i in range(100):
+            add(i, i)
+
+        sleep(1.5)
+        self.assertEqual(len(add), 0)
+        self.assertEqual(add.cache_info()['swept'], 100)
+        add.parent.stop_sweeper()
+
+
+
+class CachianPartitionIndexTestCase(unittest.TestCase):
+
+    def test_exact_match(self):
+
+        @Cachian(partition_attr=0,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(11, 1), 'miss')
+        self.assertEqual(add(21, 1), 'miss')
+        self.assertEqual(add.clear('1'), ('cleared', 1))
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(11, 1), 'hit')
+        self.assertEqual(add(21, 1), 'hit')
+
+    def test_index_follows_eviction(self):
+
+        @Cachian(partition_attr=0,maxsize=2,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add(1, 1)
+        add(1, 2)
+        add(2, 1)  # Evicts (1, 1)
+        self.assertEqual(add.parent.cache_lib.partitions['1'], {('1', build_param_hash(1, 2))})
+        self.assertEqual(add.clear('1'), ('cleared', 1))
+        self.assertNotIn('1', add.parent.cache_lib.partitions)
+
+    def test_redis_partition(self):
+
+        @Cachian(cache_class=RedisStore,partition_attr=0,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add.clear_all()
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(11, 1), 'miss')
+        self.assertEqual(add.clear('1'), ('cleared', 2))
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(11, 1), 'hit')
+
+        # Deleted keys leave the partition set
+        store = add.parent.cache_lib
+        store.pop(add.parent.full_key(build_param_hash(1, 1), '1'))
+        del store[add.parent.full_key(build_param_hash(11, 1), '11')]
+        self.assertEqual(store.redis.scard(store._partition_name('1')), 0)
+        self.assertEqual(store.redis.scard(store._partition_name('11')), 0)
+
+    def test_index_shared_by_threads(self):
+        store = MemoryStore()
+
+        # Threads of different lock stripes add and remove keys of the same partition
+        def worker(t):
+            for i in range(20000):
+                store[('1', (t, i))] = i
+                if i < 19999:
+                    del store[('1', (t, i))]
+
+        # Switch threads often so index updates interleave
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker, args=(t,)) for t in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(store.partitions['1'], set(store))
+
+    def test_remove_partition_benchmark(self):
+
+        for cache_size in (1000, 100000):
+
+            @Cachian(partition_attr=0)
+            def add(a, b):
+                return a+b
+
+            for i in range(cache_size):
+                add(i % 1000, i)
+
+            before=perf_counter()
+            for i in range(1000):
+                add.clear(str(i))
+            after=perf_counter()
+
+            print(f'Cachian remove_partition with {cache_size} entries: {(after-before)/1000*1e6:.1f}us per partition')
+
+
+
+class CachianNoneResultTestCase(unittest.TestCase):
+
+    def test_none_is_cached(self):
+        calls = []
+
+        @Cachian(test_mode=True)
+        def find(id):
+            calls.append(id)
+            return None
+
+        self.assertEqual(find(1), 'miss')
+        self.assertEqual(find(1), 'hit')
+        self.assertEqual(len(calls), 1)
+
+    def test_none_is_returned(self):
+
+        @Cachian(ttl=60)
+        def find(id):
+            return None
+
+        self.assertIsNone(find(1))
+        self.assertIsNone(find(1))
+        self.assertEqual(find.cache_info(), find.cache_info()|{'hit':1,'miss':1})
+
+    def test_negative_ttl(self):
+
+        @Cachian(ttl=60,negative_ttl=1,test_mode=True)
+        def find(id):
+            return None if id < 0 else id
+
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(1), 'miss')
+        self.assertEqual(find(-1), 'hit')
+        sleep(1.1)
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(1), 'hit')
+
+    def test_negative_ttl_without_ttl(self):
+
+        @Cachian(negative_ttl=1,test_mode=True)
+        def find(id):
+            return None if id < 0 else id
+
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(1), 'miss')
+        sleep(1.1)
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(1), 'hit')
+
+    def test_negative_results_not_cached(self):
+
+        @Cachian(negative_ttl=0,test_mode=True)
+        def find(id):
+            return None if id < 0 else id
+
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(-1), 'miss')
+        self.assertEqual(find(1), 'miss')
+        self.assertEqual(find(1), 'hit')
+
+    def test_redis_none_is_cached(self):
+
+        @Cachian(cache_class=RedisStore,test_mode=True)
+        def find(id):
+            return None
+
+        find.clear_all()
+        self.assertEqual(find(1), 'miss')
+        self.assertEqual(find(1), 'hit')
+
+
+
+class CachianRedisTTLBackendTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis not installed')
+
+        self.client = fakeredis.FakeStrictRedis()
+        self.cache_class = partial(RedisTTLStore, client=self.client)
+        return super().setUp()
+
+    def test_get_set(self):
+
+        @Cachian(cache_class=self.cache_class,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 2), 'hit')
+        self.assertEqual(add(2, 2), 'miss')
+        self.assertEqual(len(add), 2)
+        add.clear_all()
+        self.assertEqual(len(add), 0)
+        self.assertEqual(add(1, 2), 'miss')
+
+    def test_native_ttl(self):
+
+        @Cachian(cache_class=self.cache_class,ttl=60,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add(1, 2)
+        entry_name = add.parent.cache_lib._entry_name(add.parent.full_key(build_param_hash(1, 2)))
+        self.assertGreater(self.client.pttl(entry_name), 59000)
+
+    def test_negative_ttl(self):
+
+        @Cachian(cache_class=self.cache_class,ttl=60,negative_ttl=1,test_mode=True)
+        def find(id):
+            return None
+
+        self.assertEqual(find(1), 'miss')
+        self.assertEqual(find(1), 'hit')
+        sleep(1.1)
+        self.assertEqual(find(1), 'miss')
+
+    def test_lru_eviction(self):
+
+        @Cachian(cache_class=self.cache_class,maxsize=2,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 1), 'miss')
+        sleep(0.01)
+        self.assertEqual(add(2, 2), 'miss')
+        sleep(0.01)
+        self.assertEqual(add(1, 1), 'hit')  # Promotes (1, 1)
+        sleep(0.01)
+        self.assertEqual(add(3, 3), 'miss')  # Evicts (2, 2)
+        self.assertEqual(len(add), 2)
+        self.assertEqual(add(1, 1), 'hit')
+        self.assertEqual(add(2, 2), 'miss')
+
+    def test_partition(self):
+
+        @Cachian(cache_class=self.cache_class,partition_attr=0,maxsize=10,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(11, 1), 'miss')
+        self.assertEqual(add.clear('1'), ('cleared', 2))
+        self.assertEqual(add(1, 1), 'miss')
+        self.assertEqual(add(11, 1), 'hit')
+        self.assertEqual(self.client.zcard(add.parent.cache_lib._index_name()), 2)
+
+    def test_partition_sets_follow_entries(self):
+
+        @Cachian(cache_class=self.cache_class,partition_attr=0,maxsize=5,ttl=1)
+        def add(a, b):
+            return a+b
+
+        for i in range(200):
+            add(1, i)
+
+        # Evicted entries leave the set, which expires with its entries
+        store = add.parent.cache_lib
+        partition_name = store._partition_name('1')
+        self.assertEqual(self.client.scard(partition_name), 5)
+        self.assertGreater(self.client.pttl(partition_name), 0)
+        self.assertEqual(len(add), 5)
+
+        sleep(1.1)
+        self.assertEqual(len(add), 0)
+        self.assertEqual(self.client.exists(partition_name), 0)
+
+    def test_partition_sets_without_maxsize(self):
+
+        @Cachian(cache_class=self.cache_class,partition_attr=0,ttl=60,negative_ttl=1)
+        def find(partition, id):
+            return None if id < 0 else id
+
+        find(1, 1)
+        for i in range(100):
+            find(1, -i - 1)
+        sleep(1.1)
+        for i in range(200):
+            find(1, i + 2)
+
+        # Expired members are dropped as others are inserted
+        store = find.parent.cache_lib
+        self.assertLess(self.client.scard(store._partition_name('1')), 250)
+        self.assertEqual(find.clear('1'), None)
+        self.assertEqual(len(find), 0)
+
+    def test_single_round_trip(self):
+
+        @Cachian(cache_class=self.cache_class,maxsize=100,ttl=60)
+        def add(a, b):
+            return a+b
+
+        commands = []
+        execute_command = self.client.execute_command
+
+        def counting_execute_command(*args, **kwargs):
+            commands.append(args[0])
+            return execute_command(*args, **kwargs)
+
+        add(0, 0)  # Loads the scripts
+        self.client.execute_command = counting_execute_command
+
+        add(1, 2)  # Miss: lookup + insert
+        self.assertEqual(len(commands), 2)
+        commands.clear()
+        add(1, 2)  # Hit: lookup
+        self.assertEqual(len(commands), 1)
+
+    def test_async_injected_client(self):
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        client = fakeredis.FakeStrictRedis(server=server)
+
+        @Cachian(cache_class=partial(RedisTTLStore, client=client, aclient=fakeredis.FakeAsyncRedis(server=server)),ttl=60,maxsize=100,test_mode=True)
+        async def add(a, b):
+            return a+b
+
+        async def run():
+            self.assertEqual(await add(1, 2), 'miss')
+            self.assertEqual(await add(1, 2), 'hit')
+
+        asyncio.run(run())
+        # The async calls used the injected server
+        self.assertEqual(len(add), 1)
+        self.assertEqual(client.dbsize(), 2)
+
+        # fakeredis clients can't be copied, their async client must be passed in
+        @Cachian(cache_class=partial(RedisTTLStore, client=client),test_mode=True)
+        async def sub(a, b):
+            return a-b
+
+        with self.assertRaises(ValueError):
+            asyncio.run(sub(1, 2))
+
+    def test_round_trip_benchmark(self):
+        run_count = 2000
+
+        for cache_class in (RedisStore, RedisTTLStore):
+
+            @Cachian(cache_class=cache_class,maxsize=run_count//8,ttl=60)
+            def add(a, b):
+                return a+b
+
+            # Key space larger than maxsize so evictions happen
+            add.clear_all()
+            before=perf_counter()
+            for i in range(run_count):
+                add(i % (run_count//4), 0)
+            after=perf_counter()
+
+            print(f'{cache_class.__name__}: {(after-before)/run_count*1e6:.0f}us per call')
+
+
+class CachianBatchTestCase(unittest.TestCase):
+
+    def test_batch_calls_once_with_missing_ids(self):
+        calls = []
+
+        @Cachian(batch=True)
+        def get_by_ids(ids):
+            calls.append(list(ids))
+            return {id: id * 10 for id in ids if id > 0}
+
+        self.assertEqual(get_by_ids([1, 2, 3]), {1: 10, 2: 20, 3: 30})
+        self.assertEqual(get_by_ids([2, 3, 4, 4, -1]), {2: 20, 3: 30, 4: 40, -1: None})
+        self.assertEqual(calls, [[1, 2, 3], [4, -1]])
+        self.assertEqual(get_by_ids([-1, 1]), {-1: None, 1: 10})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(get_by_ids.cache_info()['hit'], 4)
+        self.assertEqual(get_by_ids.cache_info()['miss'], 5)
+
+    def test_batch_sequence_results(self):
+
+        @Cachian(batch=True,test_mode=True)
+        def square(ids, offset=0):
+            return [id * id + offset for id in ids]
+
+        self.assertEqual(square([1, 2]), {1: 'miss', 2: 'miss'})
+        self.assertEqual(square([2, 3]), {2: 'hit', 3: 'miss'})
+        # Other arguments are part of each id's key
+        self.assertEqual(square([2], offset=1), {2: 'miss'})
+
+    def test_batch_result_count_mismatch(self):
+
+        @Cachian(batch=True)
+        def broken(ids):
+            return [1]
+
+        with self.assertRaises(ValueError):
+            broken([1, 2])
+
+    def test_batch_shares_entries_with_single_calls(self):
+
+        @Cachian(batch=True,partition_attr=0,maxsize=3,test_mode=True)
+        def get_by_ids(ids):
+            return {id: str(id) for id in ids}
+
+        self.assertEqual(get_by_ids([1, 2, 3, 4]), {1: 'miss', 2: 'miss', 3: 'miss', 4: 'miss'})
+        self.assertEqual(len(get_by_ids), 3)
+        # Each id is its own partition
+        self.assertEqual(get_by_ids.clear('3'), ('cleared', 1))
+        self.assertEqual(get_by_ids([2, 3, 4]), {2: 'hit', 3: 'miss', 4: 'hit'})
+
+    def test_batch_method_and_ttl(self):
+
+        repository = BatchRepository()
+        wrapper = BatchRepository.__dict__['get_by_ids']
+        wrapper.clear_all()
+
+        self.assertEqual(repository.get_by_ids([1, 2]), {1: 'miss', 2: 'miss'})
+        self.assertEqual(repository.get_by_ids([1]), {1: 'hit'})
+
+        # Age the entries past the TTL
+        store = wrapper.parent.cache_lib
+        for key in list(store):
+            result, ts = store[key]
+            store[key] = (result, ts - 2)
+        self.assertEqual(repository.get_by_ids([1]), {1: 'miss'})
+
+    def test_async_batch(self):
+
+        @Cachian(batch=True,test_mode=True)
+        async def get_by_ids(ids):
+            await asyncio.sleep(0)
+            return {id: id for id in ids}
+
+        async def run():
+            self.assertEqual(await get_by_ids([1, 2]), {1: 'miss', 2: 'miss'})
+            self.assertEqual(await get_by_ids([2, 3]), {2: 'hit', 3: 'miss'})
+
+        asyncio.run(run())
+
+    def test_redis_batch_round_trips(self):
+
+        @Cachian(batch=True,cache_class=RedisStore,partition_attr=0)
+        def get_by_ids(ids):
+            return {id: id for id in ids}
+
+        get_by_ids.clear_all()
+        client = get_by_ids.parent.cache_lib.redis
+        commands = []
+        execute_command = client.execute_command
+
+        def counting_execute_command(*args, **kwargs):
+            commands.append(args[0])
+            return execute_command(*args, **kwargs)
+
+        client.execute_command = counting_execute_command
+        try:
+            self.assertEqual(get_by_ids(list(range(100))), {id: id for id in range(100)})
+            self.assertEqual(commands, ['HMGET'])  # The write is one pipeline
+            commands.clear()
+            self.assertEqual(get_by_ids(list(range(100))), {id: id for id in range(100)})
+            self.assertEqual(commands, ['HMGET'])
+        finally:
+            del client.execute_command
+
+        self.assertEqual(get_by_ids.parent.remove_partition('5'), 1)
+        get_by_ids.clear_all()
+
+    def test_async_redis_batch_round_trips(self):
+
+        @Cachian(batch=True,cache_class=RedisStore,partition_attr=0)
+        async def get_by_ids(ids):
+            return {id: id for id in ids}
+
+        async def run():
+            get_by_ids.clear_all()
+            client = get_by_ids.parent.cache_lib.aredis
+            commands = []
+            execute_command = client.execute_command
+
+            async def counting_execute_command(*args, **kwargs):
+                commands.append(args[0])
+                return await execute_command(*args, **kwargs)
+
+            client.execute_command = counting_execute_command
+            try:
+                self.assertEqual(await get_by_ids(list(range(100))), {id: id for id in range(100)})
+                self.assertEqual(commands, ['HMGET'])  # The write is one pipeline
+                commands.clear()
+                self.assertEqual(await get_by_ids(list(range(100))), {id: id for id in range(100)})
+                self.assertEqual(commands, ['HMGET'])
+            finally:
+                del client.execute_command
+
+            self.assertEqual(get_by_ids.parent.remove_partition('5'), 1)
+            get_by_ids.clear_all()
+
+        asyncio.run(run())
+
+    def test_redis_batch_evicts_in_bulk(self):
+
+        @Cachian(batch=True,cache_class=RedisStore,maxsize=50)
+        def get_by_ids(ids):
+            return {id: id for id in ids}
+
+        get_by_ids.clear_all()
+        get_by_ids(list(range(50)))
+
+        client = get_by_ids.parent.cache_lib.redis
+        commands = []
+        execute_command = client.execute_command
+
+        def counting_execute_command(*args, **kwargs):
+            commands.append(args[0])
+            return execute_command(*args, **kwargs)
+
+        client.execute_command = counting_execute_command
+        try:
+            get_by_ids(list(range(50, 80)))
+        finally:
+            del client.execute_command
+
+        self.assertNotIn('HKEYS', commands)
+        self.assertEqual(len(get_by_ids), 50)
+        self.assertEqual(get_by_ids.cache_info()['evictions'], 30)
+        get_by_ids.clear_all()
+
+    def test_batch_benchmark(self):
+        ids = list(range(500))
+
+        for name, cache_class in (('MemoryStore', None), ('RedisStore', RedisStore)):
+
+            @Cachian(cache_class=cache_class)
+            def get_by_id(id):
+                return id
+
+            @Cachian(batch=True,cache_class=cache_class)
+            def get_by_ids(ids):
+                return {id: id for id in ids}
+
+            get_by_id.clear_all()
+            get_by_ids.clear_all()
+
+            before = perf_counter()
+            for _ in range(5):
+                for id in ids:
+                    get_by_id(id)
+            single_duration = perf_counter() - before
+
+            before = perf_counter()
+            for _ in range(5):
+                get_by_ids(ids)
+            batch_duration = perf_counter() - before
+
+            print(f'{name}: 500 ids per call, single {single_duration/5*1000:.1f}ms, batch {batch_duration/5*1000:.1f}ms')
+            get_by_id.clear_all()
+            get_by_ids.clear_all()
+
+
+class CachianRegistryTestCase(unittest.TestCase):
+
+    def test_exact_name(self):
+        repository = RegistryRepository()
+
+        self.assertEqual(repository.get(1), 'miss')
+        self.assertEqual(repository.get_many(1), 'miss')
+
+        # 'RegistryRepository.get' is a prefix of 'RegistryRepository.get_many' but doesn't match it
+        self.assertEqual(function_cache_reset('RegistryRepository.get'), 'cleared')
+        self.assertEqual(repository.get(1), 'miss')
+        self.assertEqual(repository.get_many(1), 'hit')
+
+        self.assertEqual(function_cache_reset(f'{__name__}.RegistryRepository.get_many'), 'cleared')
+        self.assertEqual(repository.get_many(1), 'miss')
+        self.assertIsNone(function_cache_reset('RegistryRepository'))
+
+    def test_by_class(self):
+        repository = RegistryRepository()
+        repository.get(1)
+        repository.get_many(1)
+
+        func_names = function_cache_reset_by_class(RegistryRepository)
+        self.assertEqual(len(func_names), 2)
+        self.assertEqual(repository.get(1), 'miss')
+        self.assertEqual(repository.get_many(1), 'miss')
+
+        self.assertEqual(len(function_cache_reset_by_classname('RegistryRepository')), 2)
+        self.assertEqual(function_cache_reset_by_classname('Registry'), [])
+
+    def test_wrappers_are_weak(self):
+
+        @Cachian()
+        def add(a, b):
+            return a+b
+
+        qualname = add.func.__qualname__
+        self.assertTrue(any(w is add for w in get_all_wrappers()))
+
+        del add
+        gc.collect()
+        self.assertFalse(any(w.func.__qualname__ == qualname for w in get_all_wrappers()))
+
+    def test_registry_benchmark(self):
+        objects = [[i] for i in range(1000000)]
+
+        before=perf_counter()
+        for i in range(10):
+            gc.get_objects()
+        gc_duration = perf_counter() - before
+
+        before=perf_counter()
+        for i in range(10):
+            global_cache_info()
+        registry_duration = perf_counter() - before
+
+        print(f'Cachian wrapper lookup with {len(gc.get_objects())} live objects: gc scan {gc_duration/10*1000:.1f}ms, registry {registry_duration/10*1000:.2f}ms')
+        del objects
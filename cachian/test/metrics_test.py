@@ -0,0 +1,220 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+
+import unittest
+import asyncio
+import threading
+from time import sleep, perf_counter
+from cachian import Cachian, global_cache_info, global_prometheus_metrics
+from cachian.memory_store import MemoryStore
+from cachian.metrics import Histogram, CacheStats
+
+
+class FailingStore(MemoryStore):
+
+    def __setitem__(self, key, value):
+        raise ConnectionError('store unavailable')
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_exact_small_values(self):
+        histogram = Histogram()
+        for ns in range(32):
+            histogram.record(ns)
+
+        self.assertEqual(histogram.count, 32)
+        self.assertEqual(histogram.quantile(0.5), 15)
+        self.assertEqual(histogram.max(), 31)
+
+    def test_relative_precision(self):
+        for ns in (100, 1234, 56789, 1000000, 123456789, 10**11):
+            histogram = Histogram()
+            histogram.record(ns)
+            self.assertLessEqual(abs(histogram.quantile(0.5) - ns) / ns, 1 / 16)
+
+    def test_quantiles(self):
+        histogram = Histogram()
+        for ns in range(1, 10001):
+            histogram.record(ns * 1000)
+
+        self.assertAlmostEqual(histogram.quantile(0.5) / 5000000, 1, delta=0.07)
+        self.assertAlmostEqual(histogram.quantile(0.99) / 9900000, 1, delta=0.07)
+        self.assertEqual(histogram.cumulative([0, 10**12]), [0, 10000])
+
+
+class CacheStatsTestCase(unittest.TestCase):
+
+    def test_threads_lose_no_counts(self):
+        stats = CacheStats()
+
+        def count():
+            for i in range(20000):
+                shard = getattr(stats.local, 'shard', None) or stats.shard()
+                shard.hits += 1
+
+        threads = [threading.Thread(target=count) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(stats.snapshot().hits, 160000)
+
+        # Finished threads are folded into the retired total
+        stats.add('misses')
+        self.assertEqual(len(stats._shards), 1)
+        self.assertEqual(stats.snapshot().hits, 160000)
+
+    def test_wrapper_counts_under_threads(self):
+
+        @Cachian(lock_stripes=4)
+        def add(a, b):
+            return a+b
+
+        add(1, 1)
+
+        def call():
+            for i in range(5000):
+                add(1, 1)
+
+        threads = [threading.Thread(target=call) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(add.cache_info(), add.cache_info()|{'hit': 20000, 'lifetime_hit': 20000, 'miss': 1})
+
+
+class CacheMetricsTestCase(unittest.TestCase):
+
+    def test_latency(self):
+
+        @Cachian(metrics=True)
+        def add(a, b):
+            sleep(0.01)
+            return a+b
+
+        add(1, 2)
+        add(1, 2)
+        add(1, 2)
+
+        info = add.cache_info()
+        self.assertEqual(info['hit_latency']['count'], 2)
+        self.assertEqual(info['miss_latency']['count'], 1)
+        self.assertGreaterEqual(info['miss_latency']['p50'], 0.009)
+        self.assertLess(info['hit_latency']['max'], 0.009)
+
+    def test_latency_off_by_default(self):
+
+        @Cachian()
+        def add(a, b):
+            return a+b
+
+        add(1, 2)
+        self.assertNotIn('hit_latency', add.cache_info())
+
+    def test_async_latency(self):
+
+        @Cachian(metrics=True)
+        async def add(a, b):
+            await asyncio.sleep(0.01)
+            return a+b
+
+        async def run():
+            await add(1, 2)
+            await add(1, 2)
+
+        asyncio.run(run())
+        info = add.cache_info()
+        self.assertEqual(info, info|{'hit': 1, 'miss': 1})
+        self.assertGreaterEqual(info['miss_latency']['mean'], 0.009)
+
+    def test_evictions_and_expirations(self):
+
+        @Cachian(maxsize=2, ttl=1)
+        def add(a, b):
+            return a+b
+
+        for i in range(5):
+            add(i, i)
+        self.assertEqual(add.cache_info()['evictions'], 3)
+
+        sleep(1.1)
+        add(3, 3)
+        add(4, 4)
+        self.assertEqual(add.cache_info()['expirations'], 2)
+
+    def test_errors(self):
+
+        @Cachian(cache_class=FailingStore)
+        def add(a, b):
+            return a+b
+
+        with self.assertRaises(ConnectionError):
+            add(1, 2)
+        self.assertEqual(add.cache_info()['errors'], 1)
+
+    def test_reset_keeps_lifetime(self):
+
+        @Cachian(metrics=True)
+        def add(a, b):
+            return a+b
+
+        add(1, 2)
+        add(1, 2)
+        add.reset()
+
+        info = add.cache_info()
+        self.assertEqual(info, info|{'hit': 0, 'miss': 0, 'lifetime_hit': 1, 'lifetime_miss': 1})
+        self.assertEqual(info['hit_latency']['count'], 1)
+
+    def test_global_cache_info(self):
+
+        @Cachian()
+        def add(a, b):
+            return a+b
+
+        add(1, 2)
+        info = global_cache_info()[str(add.func)][0]
+        self.assertEqual(info, info|{'miss': 1, 'evictions': 0, 'expirations': 0, 'errors': 0})
+
+    def test_prometheus(self):
+
+        @Cachian(metrics=True)
+        def prometheus_add(a, b):
+            return a+b
+
+        prometheus_add(1, 2)
+        prometheus_add(1, 2)
+
+        text = global_prometheus_metrics()
+        label = f'function="{__name__}.CacheMetricsTestCase.test_prometheus.<locals>.prometheus_add"'
+
+        self.assertIn('# TYPE cachian_hits_total counter', text)
+        self.assertIn(f'cachian_hits_total{{{label}}} 1', text)
+        self.assertIn(f'cachian_misses_total{{{label}}} 1', text)
+        self.assertIn(f'cachian_entries{{{label}}} 1', text)
+        self.assertIn(f'cachian_hit_duration_seconds_bucket{{{label},le="+Inf"}} 1', text)
+        self.assertIn(f'cachian_miss_duration_seconds_count{{{label}}} 1', text)
+
+    def test_instrumentation_benchmark(self):
+        run_count = 500000
+
+        for metrics in (False, True):
+
+            @Cachian(metrics=metrics, key_mode='fast')
+            def add(a, b):
+                return a+b
+
+            add(2, 2)
+            before=perf_counter()
+            for i in range(run_count):
+                add(2, 2)
+            duration = perf_counter() - before
+
+            print(f'Cachian hit with metrics={metrics}: {duration/run_count*1e9:.0f}ns per call')
+
+        info = add.cache_info()['hit_latency']
+        print(f'Hit latency p50 {info["p50"]*1e9:.0f}ns, p99 {info["p99"]*1e9:.0f}ns, max {info["max"]*1e6:.0f}us')
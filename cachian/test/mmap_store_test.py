@@ -0,0 +1,213 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+os.environ["CACHIAN_SHM_PORT"] = "19849"  # Avoid conflict with other tests
+
+import unittest
+import multiprocessing
+import shutil
+import tempfile
+import time
+from functools import partial
+from cachian import Cachian, MISS
+from cachian.mmap_store import MmapStore
+from cachian.shared_memory_store import SharedMemoryStore
+
+
+def _worker_write(path, key, value):
+    MmapStore(path=path)[key] = value
+
+
+def _worker_hold_flight(path, key, held, release):
+    store = MmapStore(path=path)
+    store.acquire_flight(key, 5)
+    held.set()
+    release.wait(10)
+    store.release_flight(key)
+
+
+def _square(x):
+    return x * x
+
+
+def _benchmark_worker(cache_class, run_count, keys, durations):
+    cached = Cachian(cache_class=cache_class)(_square)
+    for i in range(keys):
+        cached(i)
+
+    before = time.perf_counter()
+    for i in range(run_count):
+        cached(i % keys)
+    durations.put(time.perf_counter() - before)
+
+
+class MmapStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'table')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_basic_get_set(self):
+        store = MmapStore(path=self.path)
+        store['$$~a'] = (1, 2)
+        store['1~b'] = {'x': [1, 2]}
+        self.assertEqual(store['$$~a'], (1, 2))
+        self.assertEqual(store.get('1~b'), {'x': [1, 2]})
+        self.assertIs(store.lookup('missing'), MISS)
+        with self.assertRaises(KeyError):
+            store['missing']
+
+        store['$$~a'] = 'replaced'
+        self.assertEqual(store['$$~a'], 'replaced')
+        self.assertEqual(len(store), 2)
+        self.assertEqual(sorted(store), ['$$~a', '1~b'])
+
+        del store['$$~a']
+        self.assertNotIn('$$~a', store)
+        self.assertEqual(store.pop('1~b'), {'x': [1, 2]})
+        self.assertEqual(len(store), 0)
+
+    def test_deletes_keep_probe_runs_intact(self):
+        # 60 keys in 128 slots, long probe runs without evictions
+        store = MmapStore(path=self.path, slots=128)
+        model = {}
+        for i in range(2000):
+            key = f'{i % 3}~{(i * 7) % 20}'
+            if i % 3 == 0:
+                self.assertEqual(store.pop(key, None), model.pop(key, None))
+            else:
+                store[key] = i
+                model[key] = i
+            self.assertEqual(store.get(key), model.get(key))
+
+        self.assertEqual(sorted(store), sorted(model))
+        for key, value in model.items():
+            self.assertEqual(store[key], value)
+
+    def test_ttl_and_maxsize(self):
+        store = MmapStore(path=self.path)
+        store.configure(maxsize=10, ttl=60)
+
+        store.insert('$$~short', 1, ttl=0.05)
+        for i in range(20):
+            store[f'$$~{i}'] = i
+        self.assertEqual(len(store), 10)
+        self.assertGreaterEqual(store.stats()['evictions'], 11)
+
+        store.insert('$$~short', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIs(store.lookup('$$~short'), MISS)
+
+    def test_arena_reuse(self):
+        store = MmapStore(path=self.path, slots=64, arena_size=4096)
+        for i in range(200):
+            store[f'$$~{i}'] = 'x' * 500
+        self.assertLessEqual(store.stats()['arena_used'], 4096)
+        self.assertEqual(store['$$~199'], 'x' * 500)
+
+        # Values larger than the arena aren't stored
+        store['$$~big'] = 'x' * 10000
+        self.assertNotIn('$$~big', store)
+
+    def test_remove_partition_and_clear(self):
+        store = MmapStore(path=self.path)
+        store['1~a'] = 1
+        store['1~b'] = 2
+        store['11~a'] = 3
+        store['$$~a'] = 4
+        self.assertEqual(store.remove_partition('1'), 2)
+        self.assertEqual(sorted(store), ['$$~a', '11~a'])
+        self.assertEqual(store.remove_partition('$$'), 1)
+
+        store.clear()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.stats()['arena_used'], 0)
+
+    def test_cachian(self):
+
+        @Cachian(cache_class=partial(MmapStore, path=self.path),ttl=60,maxsize=100,partition_attr=0,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 2), 'hit')
+        self.assertEqual(add(2, 2), 'miss')
+        self.assertEqual(len(add), 2)
+        self.assertEqual(add.clear('1'), ('cleared', 1))
+        self.assertEqual(add(1, 2), 'miss')
+        add.clear_all()
+        self.assertEqual(len(add), 0)
+
+    def test_namespace_per_function(self):
+
+        @Cachian(cache_class=MmapStore)
+        def add(a, b):
+            return a+b
+
+        try:
+            self.assertIn('test_namespace_per_function', add.parent.cache_lib.path)
+            add.clear_all()
+            self.assertEqual(add(1, 2), 3)
+            self.assertEqual(add(1, 2), 3)
+            self.assertEqual(add.cache_info()['hit'], 1)
+        finally:
+            add.parent.cache_lib.unlink()
+
+    def test_cross_process(self):
+        store = MmapStore(path=self.path)
+        store['$$~parent'] = 'from parent'
+
+        p = multiprocessing.Process(target=_worker_write, args=(self.path, '$$~child', ('from', 'child')))
+        p.start()
+        p.join(timeout=10)
+
+        self.assertEqual(store['$$~child'], ('from', 'child'))
+        self.assertEqual(len(store), 2)
+
+    def test_flight_lock_across_processes(self):
+        store = MmapStore(path=self.path)
+        held = multiprocessing.Event()
+        release = multiprocessing.Event()
+
+        p = multiprocessing.Process(target=_worker_hold_flight, args=(self.path, 'key', held, release))
+        p.start()
+        held.wait(10)
+        self.assertFalse(store.acquire_flight('key', 5))
+        self.assertTrue(store.acquire_flight('other', 5))
+        store.release_flight('other')
+
+        release.set()
+        p.join(timeout=10)
+        self.assertTrue(store.acquire_flight('key', 5))
+        store.release_flight('key')
+
+    def test_multiprocess_benchmark(self):
+        processes = 4
+        run_count = 20000
+        keys = 100
+
+        SharedMemoryStore._manager = None
+        SharedMemoryStore._cache = None
+        SharedMemoryStore()  # Starts the manager before the workers fork
+
+        for name, cache_class in (('SharedMemoryStore', SharedMemoryStore), ('MmapStore', partial(MmapStore, path=self.path))):
+            durations = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=_benchmark_worker, args=(cache_class, run_count, keys, durations)) for _ in range(processes)]
+
+            before = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            wall = time.perf_counter() - before
+
+            per_call = sum(durations.get() for _ in workers) / (processes * run_count)
+            print(f'{name}: {processes} processes, {per_call*1e6:.1f}us per hit, {processes * run_count / wall:.0f} calls/s overall')
+
+        SharedMemoryStore._cache.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+
+import unittest
+import datetime
+import json
+import time
+from dataclasses import dataclass
+from functools import partial
+from cachian import Cachian
+from cachian.serializers import JsonSerializer, PickleSerializer, CompressedSerializer, get_serializer
+from cachian.redis_ttl_store import RedisTTLStore
+
+
+@dataclass
+class Point():
+    x: int
+    y: int
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    def test_json_default(self):
+        serializer = get_serializer()
+        self.assertIsInstance(serializer, JsonSerializer)
+        self.assertEqual(serializer.loads(serializer.dumps({'a': [1, 2]})), {'a': [1, 2]})
+        # JSON doesn't preserve tuples
+        self.assertEqual(serializer.loads(serializer.dumps((1, 2))), [1, 2])
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            get_serializer('yaml')
+
+    def test_pickle_preserves_types(self):
+        serializer = PickleSerializer()
+        values = [
+            (1, 2),
+            {1, 2, 3},
+            datetime.datetime(2024, 1, 2, 3, 4, 5),
+            Point(1, 2),
+            {'nested': (b'bytes', None, 1.5)},
+        ]
+        for value in values:
+            self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+
+    def test_pickle_numpy_out_of_band(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy not installed')
+
+        serializer = PickleSerializer()
+        array = np.arange(100000, dtype=np.float64)
+        data = serializer.dumps(array)
+        # The array buffer is written as is, not pickled in-band
+        self.assertLess(len(data) - array.nbytes, 1024)
+
+        loaded = serializer.loads(data)
+        self.assertTrue(np.array_equal(loaded, array))
+        self.assertEqual(loaded.dtype, array.dtype)
+
+    def test_compression_threshold(self):
+        serializer = get_serializer('pickle', compress_threshold=100)
+        self.assertIsInstance(serializer, CompressedSerializer)
+
+        small = 'x' * 10
+        large = 'x' * 10000
+        self.assertEqual(serializer.dumps(small)[:1], b'\x00')
+        self.assertEqual(serializer.dumps(large)[:1], b'\x01')
+        self.assertLess(len(serializer.dumps(large)), 1000)
+        self.assertEqual(serializer.loads(serializer.dumps(small)), small)
+        self.assertEqual(serializer.loads(serializer.dumps(large)), large)
+
+        serializer = get_serializer('json', compress_threshold=100)
+        self.assertEqual(serializer.loads(serializer.dumps([large])), [large])
+        self.assertEqual(serializer.loads(serializer.dumps([small])), [small])
+
+    def test_msgpack(self):
+        try:
+            import msgpack  # noqa: F401
+        except ImportError:
+            self.skipTest('msgpack not installed')
+
+        serializer = get_serializer('msgpack')
+        self.assertEqual(serializer.loads(serializer.dumps({'a': b'bytes', 'b': [1, 2.5]})), {'a': b'bytes', 'b': [1, 2.5]})
+
+    def test_redis_round_trip(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis not installed')
+
+        cache_class = partial(RedisTTLStore, client=fakeredis.FakeStrictRedis(), serializer=PickleSerializer())
+
+        @Cachian(cache_class=cache_class,ttl=60)
+        def when(days):
+            return (datetime.date(2024, 1, 1) + datetime.timedelta(days=days), {days})
+
+        first = when(1)
+        second = when(1)
+        self.assertEqual(first, second)
+        self.assertIsInstance(second, tuple)
+        self.assertEqual(when.cache_info()['hit'], 1)
+
+    def test_serializer_benchmark(self):
+        value = {'id': 12345, 'name': 'cachian', 'scores': list(range(200)), 'tags': ['a', 'b', 'c'] * 10}
+        serializers = {
+            'json': get_serializer('json'),
+            'pickle': get_serializer('pickle'),
+            'pickle+zlib': get_serializer('pickle', compress_threshold=512),
+        }
+        n = 20000
+
+        for name, serializer in serializers.items():
+            start = time.perf_counter()
+            for _ in range(n):
+                data = serializer.dumps(value)
+            dumps_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(n):
+                serializer.loads(data)
+            loads_time = time.perf_counter() - start
+
+            print(f'{name}: dumps {dumps_time / n * 1e6:.2f}us, loads {loads_time / n * 1e6:.2f}us, {len(data)} bytes (json text {len(json.dumps(value))})')
+
+        try:
+            import numpy as np
+        except ImportError:
+            return
+
+        array = np.random.rand(1000000)
+        for name in ['json', 'pickle']:
+            serializer = serializers[name]
+            payload = array.tolist() if name == 'json' else array
+            start = time.perf_counter()
+            data = serializer.dumps(payload)
+            serializer.loads(data)
+            print(f'{name} 1M floats round trip: {(time.perf_counter() - start) * 1000:.1f}ms, {len(data)} bytes')
+
+
+if __name__ == '__main__':
+    unittest.main()
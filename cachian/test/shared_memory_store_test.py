@@ -4,7 +4,9 @@ os.environ["CACHIAN_SHM_PORT"] = "19848"  # Avoid conflict with other tests
 
 import unittest
 import multiprocessing
-from cachian import Cachian
+import threading
+import time
+from cachian import Cachian, get_param_hash, DEFAULT_PARTITION_VALUE, KEY_SEPARATOR, MISS
 from cachian.shared_memory_store import SharedMemoryStore
 
 
@@ -27,9 +29,12 @@ class SharedMemoryStoreTestCase(unittest.TestCase):
         store['key1'] = 'value1'
         self.assertEqual(store['key1'], 'value1')
 
-    def test_missing_key_returns_none(self):
+    def test_missing_key_raises(self):
         store = SharedMemoryStore()
-        self.assertIsNone(store['nonexistent'])
+        with self.assertRaises(KeyError):
+            store['nonexistent']
+        self.assertIsNone(store.get('nonexistent'))
+        self.assertIs(store.get('nonexistent', MISS), MISS)
 
     def test_contains(self):
         store = SharedMemoryStore()
@@ -88,6 +93,129 @@ class SharedMemoryStoreTestCase(unittest.TestCase):
         self.assertEqual(add(2, 3), 'miss')
         self.assertEqual(add(2, 3), 'hit')
 
+    def test_remove_partition(self):
+        store = SharedMemoryStore()
+        store.clear()
+        store['1~a'] = 1
+        store['1~b'] = 2
+        store['11~a'] = 3
+        store['$$~a'] = 4
+        del store['1~b']
+        self.assertEqual(store.remove_partition('1'), 1)
+        self.assertEqual(sorted(store), ['$$~a', '11~a'])
+        self.assertEqual(store.remove_partition('$$'), 1)
+        self.assertEqual(sorted(store), ['11~a'])
+
+    def test_get_many_set_many(self):
+        store = SharedMemoryStore()
+        store.clear()
+        store.set_many({'1~a': 1, '$$~b': (2, 3)})
+        self.assertEqual(store.get_many(['1~a', 'missing', '$$~b']), [1, MISS, (2, 3)])
+        self.assertEqual(store.remove_partition('1'), 1)
+
+    def test_batch_decorator(self):
+        @Cachian(cache_class=SharedMemoryStore, batch=True, test_mode=True)
+        def get_by_ids(ids):
+            return {id: id for id in ids}
+
+        get_by_ids.clear_all()
+        self.assertEqual(get_by_ids([1, 2]), {1: 'miss', 2: 'miss'})
+        self.assertEqual(get_by_ids([2, 3]), {2: 'hit', 3: 'miss'})
+
+    def test_server_side_maxsize_and_ttl(self):
+        store = SharedMemoryStore()
+        store.clear()
+        store.configure(maxsize=3, ttl=60, eviction='lru')
+        for key in ['a', 'b', 'c']:
+            store.insert(key, key)
+        self.assertEqual(store.lookup('a'), 'a')  # Promotes a
+        store.insert('d', 'd')
+        self.assertEqual(sorted(store), ['a', 'c', 'd'])
+
+        store.insert('short', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIs(store.lookup('short'), MISS)
+        self.assertNotIn('short', store)
+
+    def test_tables_per_function(self):
+        @Cachian(cache_class=SharedMemoryStore)
+        def add(a, b):
+            return a + b
+
+        @Cachian(cache_class=SharedMemoryStore)
+        def sub(a, b):
+            return a - b
+
+        add.clear_all()
+        sub.clear_all()
+        self.assertEqual(add(3, 1), 4)
+        self.assertEqual(sub(3, 1), 2)
+        sub.clear_all()
+        self.assertEqual(len(add), 1)
+
+    def test_one_round_trip_per_call(self):
+        @Cachian(cache_class=SharedMemoryStore, maxsize=2, ttl=60, partition_attr=0, test_mode=True)
+        def add(a, b):
+            return a + b
+
+        add.clear_all()
+        calls = []
+        proxy = SharedMemoryStore._cache
+
+        class CountingProxy:
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(proxy, name)
+
+        SharedMemoryStore._cache = CountingProxy()
+        try:
+            self.assertEqual(add(1, 2), 'miss')
+            self.assertEqual(calls, ['lookup', 'insert'])
+            calls.clear()
+            self.assertEqual(add(1, 2), 'hit')
+            self.assertEqual(calls, ['lookup'])
+            calls.clear()
+            add(2, 2)
+            add(3, 2)  # Evicted in the server, no len() or keys() calls
+            self.assertEqual(calls, ['lookup', 'insert', 'lookup', 'insert'])
+            calls.clear()
+            self.assertEqual(add.clear('3'), ('cleared', 1))
+            self.assertEqual(calls, ['remove_partition'])
+        finally:
+            SharedMemoryStore._cache = proxy
+
+        self.assertEqual(len(add), 1)
+
+    def test_flight_lock(self):
+        store = SharedMemoryStore()
+        self.assertTrue(store.acquire_flight('flight', 5))
+        self.assertFalse(store.acquire_flight('flight', 5))
+        store.release_flight('flight')
+        self.assertTrue(store.acquire_flight('flight', 5))
+        store.release_flight('flight')
+
+    def test_single_flight_waits_for_other_process(self):
+        @Cachian(cache_class=SharedMemoryStore, single_flight=True, test_mode=True)
+        def add(a, b):
+            return a + b
+
+        add.clear_all()
+        full_key = f'{DEFAULT_PARTITION_VALUE}{KEY_SEPARATOR}{get_param_hash(1, 2)}'
+        store = add.parent.cache_lib
+
+        # Simulate another worker holding the flight and finishing shortly after
+        store.acquire_flight(full_key, 5)
+
+        def other_worker():
+            time.sleep(0.2)
+            store[full_key] = (3, time.time())
+            store.release_flight(full_key)
+
+        t = threading.Thread(target=other_worker)
+        t.start()
+        self.assertEqual(add(1, 2), 'hit')
+        t.join()
+
 
 def _worker_write(key, value):
     """Helper function run in a child process."""
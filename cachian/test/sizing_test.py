@@ -0,0 +1,187 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+
+import unittest
+import sys
+import numpy as np
+from time import perf_counter
+from cachian import Cachian, get_size, register_sizer, unregister_sizer, set_global_maxbytes, global_budget
+from cachian.redis_store import RedisStore
+
+
+class Blob():
+
+    def __init__(self, nbytes):
+        self.nbytes_reported = nbytes
+
+
+class SizerTestCase(unittest.TestCase):
+
+    def test_containers(self):
+        self.assertEqual(get_size(b'x' * 1000), sys.getsizeof(b'x' * 1000))
+        self.assertGreater(get_size([b'x' * 1000, b'y' * 1000]), 2000)
+        self.assertGreater(get_size({'a': 'x' * 1000}), 1000)
+
+        # Shared objects are counted once
+        shared = b'x' * 1000
+        self.assertLess(get_size([shared, shared]), 1200)
+
+    def test_numpy(self):
+        array = np.zeros(100000)
+        self.assertGreaterEqual(get_size(array), 800000)
+        # Views don't own their data, the data is still what the cache keeps alive
+        self.assertGreaterEqual(get_size(array[:50000]), 400000)
+
+    def test_object_attributes(self):
+        blob = Blob(0)
+        blob.data = b'x' * 1000
+        self.assertGreater(get_size(blob), 1000)
+
+    def test_registered_sizer(self):
+        register_sizer(Blob, lambda blob: blob.nbytes_reported)
+        try:
+            self.assertEqual(get_size(Blob(12345)), 12345)
+            self.assertGreater(get_size([Blob(12345)]), 12345)
+        finally:
+            unregister_sizer(Blob)
+
+
+class MaxBytesTestCase(unittest.TestCase):
+
+    def test_evicts_to_fit(self):
+
+        @Cachian(maxbytes=10000, sizer=len, test_mode=True)
+        def load(id, size):
+            return b'x' * size
+
+        self.assertEqual(load(1, 4000), 'miss')
+        self.assertEqual(load(2, 4000), 'miss')
+        self.assertEqual(load(1, 4000), 'hit')
+        self.assertEqual(load.cache_info()['bytes'], 8000)
+
+        # Least recently used entry 2 is evicted to make room
+        self.assertEqual(load(3, 4000), 'miss')
+        self.assertEqual(load.cache_info()['bytes'], 8000)
+        self.assertEqual(load(1, 4000), 'hit')
+        self.assertEqual(load(2, 4000), 'miss')
+
+    def test_one_large_entry_evicts_many(self):
+
+        @Cachian(maxbytes=10000, sizer=len, test_mode=True)
+        def load(id, size):
+            return b'x' * size
+
+        for i in range(10):
+            load(i, 1000)
+        self.assertEqual(len(load), 10)
+
+        load(10, 9000)
+        self.assertEqual(len(load), 2)
+        self.assertEqual(load.cache_info()['evictions'], 9)
+
+    def test_too_large_is_not_cached(self):
+
+        @Cachian(maxbytes=1000, sizer=len, test_mode=True)
+        def load(id, size):
+            return b'x' * size
+
+        load(1, 100)
+        self.assertEqual(load(2, 5000), 'miss')
+        self.assertEqual(load(2, 5000), 'miss')
+        self.assertEqual(load(1, 100), 'hit')
+
+    def test_removals_release_bytes(self):
+
+        @Cachian(maxbytes=100000, sizer=len, partition_attr=0, ttl=60)
+        def load(id, size):
+            return b'x' * size
+
+        load(1, 100)
+        load(2, 200)
+        load(3, 300)
+        self.assertEqual(load.parent.nbytes, 600)
+
+        load.clear('2')
+        self.assertEqual(load.parent.nbytes, 400)
+
+        load.clear_all()
+        self.assertEqual(load.parent.nbytes, 0)
+
+    def test_batch(self):
+
+        @Cachian(batch=True, maxbytes=3000, sizer=len)
+        def load(ids):
+            return {id: b'x' * 1000 for id in ids}
+
+        load([1, 2, 3, 4, 5])
+        self.assertEqual(len(load), 3)
+        self.assertEqual(load.parent.nbytes, 3000)
+
+    def test_store_without_sizes(self):
+        with self.assertRaises(ValueError):
+            Cachian(maxbytes=1000, cache_class=RedisStore)
+
+    def test_maxbytes_benchmark(self):
+        run_count = 200000
+
+        for maxbytes in (-1, 10**8):
+
+            @Cachian(maxbytes=maxbytes)
+            def load(id):
+                return [id] * 10
+
+            before=perf_counter()
+            for i in range(run_count):
+                load(i % 20000)
+            duration = perf_counter() - before
+
+            print(f'Cachian maxbytes={maxbytes}: {duration/run_count*1e6:.2f}us per call, 90% hits')
+
+
+class GlobalBudgetTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        set_global_maxbytes(-1)
+
+    def test_shared_budget(self):
+        set_global_maxbytes(10000)
+
+        @Cachian(sizer=len)
+        def small(id):
+            return b'x' * 1000
+
+        @Cachian(sizer=len)
+        def large(id):
+            return b'x' * 4000
+
+        for i in range(8):
+            small(i)
+
+        # The largest cache gives up entries first
+        large(1)
+        self.assertLessEqual(global_budget.nbytes, 10000)
+        self.assertEqual(len(small), 6)
+        self.assertEqual(len(large), 1)
+
+        large(2)
+        self.assertLessEqual(global_budget.nbytes, 10000)
+        self.assertEqual(len(small), 6)
+        self.assertEqual(len(large), 1)
+
+        large.clear_all()
+        small.clear_all()
+
+    def test_lowering_the_budget_evicts(self):
+        set_global_maxbytes(100000)
+
+        @Cachian(sizer=len)
+        def load(id):
+            return b'x' * 1000
+
+        for i in range(50):
+            load(i)
+
+        set_global_maxbytes(10000)
+        self.assertLessEqual(global_budget.nbytes, 10000)
+        self.assertEqual(len(load), 10)
+        load.clear_all()
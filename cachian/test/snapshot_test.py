@@ -0,0 +1,174 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+
+import unittest
+import gc
+import shutil
+import tempfile
+import cachian
+from time import sleep, perf_counter
+from cachian import Cachian, global_snapshot, global_restore, start_snapshots, stop_snapshots
+
+
+# Every loader made here has the same qualified name, like a function decorated again after a restart
+def make_loader(calls=None, **kwargs):
+
+    @Cachian(test_mode=True, **kwargs)
+    def load(id, scale=1):
+        if calls is not None:
+            calls.append(id)
+        return id * scale
+
+    return load
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.snapshot')
+
+    def tearDown(self):
+        stop_snapshots()
+        if cachian._snapshot is not None:
+            cachian._snapshot.close()
+            cachian._snapshot = None
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_restore(self):
+        load = make_loader(ttl=60, partition_attr=0)
+        for i in range(10):
+            load(i)
+        load(1, scale=2)
+
+        self.assertEqual(load.snapshot(self.path), 11)
+        load.clear_all()
+
+        self.assertEqual(load.restore(self.path), 11)
+        self.assertEqual(load(5), 'hit')
+        self.assertEqual(load(1, scale=2), 'hit')
+        self.assertEqual(load.clear('3'), ('cleared', 1))
+
+    def test_expired_entries_are_dropped(self):
+
+        @Cachian(ttl=1,negative_ttl=60,test_mode=True)
+        def find(id):
+            return None if id < 0 else id
+
+        find(1)
+        find(-1)
+        find.snapshot(self.path)
+        find.clear_all()
+
+        sleep(1.1)
+        self.assertEqual(find.restore(self.path), 1)
+        self.assertEqual(find(-1), 'hit')
+        self.assertEqual(find(1), 'miss')
+
+    def test_fast_keys_with_keyword_arguments(self):
+        load = make_loader(key_mode='fast')
+        load(1, scale=2)
+        load.snapshot(self.path)
+        load.clear_all()
+
+        # The keyword marker in fast keys is a different object after unpickling
+        self.assertEqual(load.restore(self.path), 1)
+        self.assertEqual(load(1, scale=2), 'hit')
+
+    def test_restored_into_functions_decorated_later(self):
+        load = make_loader(ttl=60)
+        for i in range(10):
+            load(i)
+        # Other live caches of the process are included
+        self.assertGreaterEqual(global_snapshot(self.path), 10)
+
+        del load
+        gc.collect()
+
+        global_restore(self.path)
+        calls = []
+        load = make_loader(calls, ttl=60)
+        self.assertEqual(load(5), 'hit')
+        self.assertEqual(calls, [])
+
+    def test_compact_keys(self):
+        load = make_loader(compact=True, partition_attr=0)
+        for i in range(10):
+            load(i)
+        load.snapshot(self.path)
+
+        restored = make_loader(compact=True, partition_attr=0)
+        self.assertEqual(restored.restore(self.path), 10)
+        self.assertEqual(restored(5), 'hit')
+        self.assertEqual(restored.clear('5'), ('cleared', 1))
+
+        # Keys of another kind don't match, nothing is restored
+        fast = make_loader()
+        self.assertEqual(fast.restore(self.path), 0)
+
+    def test_unpicklable_entries_are_skipped(self):
+
+        @Cachian(test_mode=True)
+        def build(id):
+            return (lambda: id) if id % 2 else id
+
+        for i in range(10):
+            build(i)
+
+        self.assertEqual(build.snapshot(self.path), 5)
+        build.clear_all()
+        build.restore(self.path)
+        self.assertEqual(build(2), 'hit')
+        self.assertEqual(build(3), 'miss')
+
+    def test_maxsize_keeps_most_recent(self):
+        load = make_loader()
+        for i in range(10):
+            load(i)
+        load.snapshot(self.path)
+
+        small = make_loader(maxsize=3)
+        small.restore(self.path)
+        self.assertEqual(len(small), 3)
+        self.assertEqual(small(9), 'hit')
+        self.assertEqual(small(0), 'miss')
+
+    def test_timer(self):
+        load = make_loader()
+        load(1)
+
+        start_snapshots(self.path, interval=0.1, at_exit=False)
+        sleep(0.3)
+        stop_snapshots()
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_snapshot_benchmark(self):
+        entries = 100000
+
+        @Cachian(ttl=3600)
+        def load(id):
+            return {'id': id, 'name': f'patient {id}'}
+
+        for i in range(entries):
+            load(i)
+
+        before = perf_counter()
+        load.snapshot(self.path)
+        write = perf_counter() - before
+        size = os.path.getsize(self.path)
+
+        load.clear_all()
+        before = perf_counter()
+        load.restore(self.path)
+        restore = perf_counter() - before
+
+        before = perf_counter()
+        for i in range(entries):
+            load(i)
+        hits = perf_counter() - before
+
+        print(f'Snapshot of {entries} entries: {write*1e3:.0f}ms write, {size/entries:.0f} bytes per entry, {restore*1e3:.0f}ms restore, {load.cache_info()["hit"]} warm hits in {hits*1e3:.0f}ms')
+
+
+if __name__ == '__main__':
+    unittest.main()
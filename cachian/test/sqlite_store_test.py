@@ -0,0 +1,223 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+
+import unittest
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import time
+from functools import partial
+from cachian import Cachian, MISS
+from cachian.sqlite_store import SqliteStore
+from cachian.redis_store import RedisStore
+from cachian.serializers import get_serializer
+
+
+def _worker_write(path, key, value):
+    SqliteStore(path=path)[key] = value
+
+
+def _worker_hold_flight(path, key, held, release):
+    store = SqliteStore(path=path)
+    store.acquire_flight(key, 5)
+    held.set()
+    release.wait(10)
+    store.release_flight(key)
+
+
+class SqliteStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_basic_get_set(self):
+        store = SqliteStore(path=self.path)
+        store['$$~a'] = (1, 2)
+        store['1~b'] = {'x': [1, 2]}
+        self.assertEqual(store['$$~a'], (1, 2))
+        self.assertEqual(store.get('1~b'), {'x': [1, 2]})
+        self.assertIs(store.lookup('missing'), MISS)
+        with self.assertRaises(KeyError):
+            store['missing']
+
+        store['$$~a'] = 'replaced'
+        self.assertEqual(store['$$~a'], 'replaced')
+        self.assertEqual(len(store), 2)
+        self.assertEqual(sorted(store), ['$$~a', '1~b'])
+
+        del store['$$~a']
+        self.assertNotIn('$$~a', store)
+        self.assertEqual(store.pop('1~b'), {'x': [1, 2]})
+        self.assertEqual(len(store), 0)
+
+    def test_large_values_are_mapped(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy not installed')
+
+        store = SqliteStore(path=self.path, inline_size=1024)
+        array = np.arange(100000, dtype=np.float64)
+        store['$$~array'] = (array, 1.0)
+        self.assertEqual(len(os.listdir(store.values_dir)), 1)
+
+        loaded, ts = store['$$~array']
+        np.testing.assert_array_equal(loaded, array)
+        # A view of the file mapping, writes stay private to this copy
+        self.assertFalse(loaded.flags.owndata)
+        loaded[0] = -1
+        self.assertEqual(store['$$~array'][0][0], 0)
+
+        # Replacing or removing the entry removes its file
+        store['$$~array'] = np.zeros(1000)
+        self.assertEqual(len(os.listdir(store.values_dir)), 1)
+        store['$$~array'] = 'small'
+        self.assertEqual(os.listdir(store.values_dir), [])
+
+    def test_ttl_and_maxsize(self):
+        store = SqliteStore(path=self.path)
+        store.configure(maxsize=10, ttl=60)
+
+        for i in range(20):
+            store[f'$$~{i}'] = i
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store.stats()['evictions'], 10)
+        self.assertEqual(sorted(store), sorted(f'$$~{i}' for i in range(10, 20)))
+
+        store.insert('$$~short', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIs(store.lookup('$$~short'), MISS)
+
+        # Expired entries are deleted by later inserts before anything is evicted
+        store['$$~next'] = 1
+        self.assertNotIn('$$~short', list(store))
+        self.assertIn('$$~19', store)
+
+    def test_lru_eviction(self):
+        store = SqliteStore(path=self.path)
+        store.configure(maxsize=3, ttl=-1)
+
+        store.insert_many([('$$~a', 1, None), ('$$~b', 2, None), ('$$~c', 3, None)])
+        time.sleep(1.1)
+        store['$$~a']  # Recency is updated at most once a second
+        store['$$~d'] = 4
+        self.assertEqual(sorted(store), ['$$~a', '$$~c', '$$~d'])
+
+    def test_remove_partition_and_clear(self):
+        store = SqliteStore(path=self.path, inline_size=0)
+        store['1~a'] = 1
+        store['1~b'] = 2
+        store['11~a'] = 3
+        store['$$~a'] = 4
+        self.assertEqual(store.remove_partition('1'), 2)
+        self.assertEqual(sorted(store), ['$$~a', '11~a'])
+        self.assertEqual(len(os.listdir(store.values_dir)), 2)
+
+        store.clear()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(os.listdir(store.values_dir), [])
+
+    def test_old_sqlite(self):
+        version_info = sqlite3.sqlite_version_info
+        sqlite3.sqlite_version_info = (3, 22, 0)
+        try:
+            with self.assertRaises(RuntimeError):
+                SqliteStore(path=self.path)
+        finally:
+            sqlite3.sqlite_version_info = version_info
+
+    def test_cachian(self):
+
+        @Cachian(cache_class=partial(SqliteStore, path=self.path),ttl=60,maxsize=100,partition_attr=0,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 2), 'hit')
+        self.assertEqual(add(2, 2), 'miss')
+        self.assertEqual(len(add), 2)
+        self.assertEqual(add.clear('1'), ('cleared', 1))
+        self.assertEqual(add(1, 2), 'miss')
+        add.clear_all()
+        self.assertEqual(len(add), 0)
+
+    def test_batch(self):
+
+        @Cachian(cache_class=partial(SqliteStore, path=self.path),ttl=60,batch=True,test_mode=True)
+        def load(ids):
+            return {id: id * 2 for id in ids}
+
+        self.assertEqual(load([1, 2]), {1: 'miss', 2: 'miss'})
+        self.assertEqual(load([1, 2, 3]), {1: 'hit', 2: 'hit', 3: 'miss'})
+
+    def test_survives_restart(self):
+        store = SqliteStore(path=self.path)
+        store['$$~a'] = 'kept'
+        store.close()
+
+        self.assertEqual(SqliteStore(path=self.path)['$$~a'], 'kept')
+
+    def test_cross_process(self):
+        store = SqliteStore(path=self.path)
+        store['$$~parent'] = 'from parent'
+
+        p = multiprocessing.Process(target=_worker_write, args=(self.path, '$$~child', ('from', 'child')))
+        p.start()
+        p.join(timeout=10)
+
+        self.assertEqual(store['$$~child'], ('from', 'child'))
+        self.assertEqual(len(store), 2)
+
+    def test_flight_lock_across_processes(self):
+        store = SqliteStore(path=self.path)
+        held = multiprocessing.Event()
+        release = multiprocessing.Event()
+
+        p = multiprocessing.Process(target=_worker_hold_flight, args=(self.path, 'key', held, release))
+        p.start()
+        held.wait(10)
+        self.assertFalse(store.acquire_flight('key', 5))
+        self.assertTrue(store.acquire_flight('other', 5))
+        store.release_flight('other')
+
+        release.set()
+        p.join(timeout=10)
+        self.assertTrue(store.acquire_flight('key', 5))
+        store.release_flight('key')
+
+    def test_large_payload_benchmark(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy not installed')
+
+        run_count = 20
+
+        redis_store = RedisStore(serializer=get_serializer('pickle'), name='cachian:benchmark:large')
+        sqlite_store = SqliteStore(path=self.path)
+
+        for size in (10**4, 10**5, 10**6):
+            value = np.random.random(size // 8)
+
+            for name, store in (('RedisStore', redis_store), ('SqliteStore', sqlite_store)):
+                before = time.perf_counter()
+                store['$$~large'] = value
+                write = time.perf_counter() - before
+
+                before = time.perf_counter()
+                for i in range(run_count):
+                    store['$$~large']
+                read = (time.perf_counter() - before) / run_count
+
+                print(f'{name} {size / 1e6:g}MB: {write*1e3:.2f}ms write, {read*1e3:.3f}ms read')
+
+        redis_store.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
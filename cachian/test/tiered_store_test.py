@@ -0,0 +1,175 @@
+import os
+os.environ["CACHIAN_ENABLE"] = "1"
+
+import unittest
+import asyncio
+import time
+from functools import partial
+from time import perf_counter
+from cachian import Cachian, MemoryStore
+from cachian.redis_store import RedisStore
+from cachian.redis_ttl_store import RedisTTLStore
+from cachian.tiered_store import TieredStore, LocalInvalidationChannel
+
+
+# Stands in for a remote store, counts reads that reach the L2
+class CountingStore(MemoryStore):
+
+    in_process = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.reads = 0
+        self.get = self._get
+
+    def _get(self, key, default=None):
+        self.reads += 1
+        return self.cache_lib.get(key, default)
+
+
+class TieredStoreTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.channel = LocalInvalidationChannel()
+        self.cache_class = partial(TieredStore, l2_class=CountingStore, channel=self.channel)
+        return super().setUp()
+
+    def test_hits_served_from_l1(self):
+
+        @Cachian(cache_class=self.cache_class,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        self.assertEqual(add(1, 2), 'miss')
+        reads = add.parent.cache_lib.l2.reads
+        self.assertEqual(add(1, 2), 'hit')
+        self.assertEqual(add(1, 2), 'hit')
+        self.assertEqual(add.parent.cache_lib.l2.reads, reads)
+        self.assertEqual(add.parent.cache_lib.l1_hits, 2)
+
+    def test_l1_ttl_and_maxsize(self):
+
+        @Cachian(cache_class=partial(self.cache_class, l1_maxsize=2, l1_ttl=0.05),test_mode=True)
+        def add(a, b):
+            return a+b
+
+        for i in range(3):
+            add(i, 0)
+        store = add.parent.cache_lib
+        self.assertEqual(len(store.l1), 2)
+        self.assertEqual(len(store), 3)
+
+        # Expired L1 entries are read again from the L2
+        time.sleep(0.1)
+        reads = store.l2.reads
+        self.assertEqual(add(2, 0), 'hit')
+        self.assertEqual(store.l2.reads, reads + 1)
+
+    def test_invalidation_across_workers(self):
+
+        def add(a, b):
+            return a+b
+
+        # Two Cachian instances over one L2 act as two workers with their own L1
+        l2 = CountingStore()
+        cache_class = partial(TieredStore, l2_class=lambda: l2, channel=self.channel, l1_ttl=60)
+        worker1 = Cachian(cache_class=cache_class,partition_attr=0,test_mode=True)(add)
+        worker2 = Cachian(cache_class=cache_class,partition_attr=0,test_mode=True)(add)
+
+        self.assertEqual(worker1(1, 1), 'miss')
+        self.assertEqual(worker1(2, 1), 'miss')
+        self.assertEqual(worker2(1, 1), 'hit')
+        self.assertEqual(worker2(2, 1), 'hit')
+        self.assertEqual(len(worker2.parent.cache_lib.l1), 2)
+
+        self.assertEqual(worker1.clear('1'), ('cleared', 1))
+        self.assertEqual(list(worker2.parent.cache_lib.l1), [f'2~{worker2.parent.key_func(2, 1)}'])
+        self.assertEqual(worker2(1, 1), 'miss')
+
+        worker1.clear_all()
+        self.assertEqual(len(worker2.parent.cache_lib.l1), 0)
+        self.assertEqual(worker2(2, 1), 'miss')
+
+    def test_batch(self):
+
+        @Cachian(cache_class=partial(self.cache_class, l2_class=RedisStore),batch=True,test_mode=True)
+        def get_by_ids(ids):
+            return {id: id for id in ids}
+
+        get_by_ids.clear_all()
+        self.assertEqual(get_by_ids([1, 2]), {1: 'miss', 2: 'miss'})
+        store = get_by_ids.parent.cache_lib
+        store.l1.clear()
+        self.assertEqual(get_by_ids([1, 2, 3]), {1: 'hit', 2: 'hit', 3: 'miss'})
+        self.assertEqual(get_by_ids([1, 2, 3]), {1: 'hit', 2: 'hit', 3: 'hit'})
+        self.assertEqual(store.l1_hits, 3)
+        get_by_ids.clear_all()
+
+    def test_redis_pubsub_invalidation(self):
+
+        def add(a, b):
+            return a+b
+
+        worker1 = Cachian(cache_class=partial(TieredStore, l2_class=RedisStore, l1_ttl=60),test_mode=True)(add)
+        worker2 = Cachian(cache_class=partial(TieredStore, l2_class=RedisStore, l1_ttl=60),test_mode=True)(add)
+        worker1.clear_all()
+
+        self.assertEqual(worker1(1, 2), 'miss')
+        self.assertEqual(worker2(1, 2), 'hit')
+        self.assertEqual(len(worker2.parent.cache_lib.l1), 1)
+
+        worker1.clear_all()
+        deadline = time.time() + 5
+        while worker2.parent.cache_lib.l1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(worker2.parent.cache_lib.l1), 0)
+        self.assertEqual(worker2(1, 2), 'miss')
+        worker2.clear_all()
+
+    def test_compound_l2(self):
+        l2_class = RedisTTLStore
+
+        @Cachian(cache_class=partial(TieredStore, l2_class=l2_class, channel=self.channel),ttl=60,maxsize=10,test_mode=True)
+        def add(a, b):
+            return a+b
+
+        add.clear_all()
+        self.assertTrue(hasattr(add.parent.cache_lib, 'lookup'))
+        self.assertEqual(add.parent.cache_lib.l2.maxsize, 10)
+        self.assertEqual(add(1, 2), 'miss')
+        self.assertEqual(add(1, 2), 'hit')
+        self.assertEqual(add.parent.cache_lib.l1_hits, 1)
+
+        async def run():
+            self.assertEqual(await add_async(1, 2), 'miss')
+            self.assertEqual(await add_async(1, 2), 'hit')
+
+        @Cachian(cache_class=partial(TieredStore, l2_class=l2_class, channel=self.channel),ttl=60,test_mode=True)
+        async def add_async(a, b):
+            return a+b
+
+        add_async.clear_all()
+        asyncio.run(run())
+        self.assertEqual(add_async.parent.cache_lib.l1_hits, 1)
+
+    def test_tiered_benchmark(self):
+        run_count = 20000
+
+        def add(a, b):
+            return a+b
+
+        for name, cache_class in (('RedisStore', RedisStore), ('TieredStore', partial(TieredStore, l2_class=RedisStore))):
+            cached = Cachian(cache_class=cache_class)(add)
+            cached.clear_all()
+
+            before = perf_counter()
+            for i in range(run_count):
+                cached(i % 100, 0)
+            after = perf_counter()
+
+            print(f'{name}: {(after-before)/run_count*1e6:.1f}us per call, 100 hot keys')
+            cached.clear_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
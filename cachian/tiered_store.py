@@ -0,0 +1,352 @@
+"""Two-tier near cache, a small in-process L1 in front of a remote L2 store.
+
+Hot keys are served from the L1 without a network or IPC round trip or
+deserialization. L1 entries live for a short l1_ttl so changes made by other
+workers show up quickly, and clear(), remove_partition() and clear_all() are
+broadcast on an invalidation channel so every worker drops its L1 copies
+straight away.
+
+Usage:
+    from functools import partial
+    from cachian import Cachian
+    from cachian.redis_store import RedisStore
+    from cachian.tiered_store import TieredStore
+
+    @Cachian(cache_class=partial(TieredStore, l2_class=RedisStore, l1_maxsize=1000, l1_ttl=2), ttl=60)
+    def my_function(x):
+        return expensive_computation(x)
+
+Redis backed L2 stores (those with a `redis` client attribute) use Redis
+pub/sub for invalidation. Other L2 stores default to LocalInvalidationChannel,
+which only reaches stores in the same process, so L1 copies in other processes
+expire after l1_ttl.
+
+Environment variables:
+    CACHIAN_L1_MAXSIZE: Entries kept in each L1 (default: 1024)
+    CACHIAN_L1_TTL:     Seconds an entry is served from L1 (default: 1)
+"""
+
+from collections.abc import MutableMapping
+from threading import Lock
+from time import time
+import os
+import weakref
+from .keys import key_partition, MISS
+
+
+CACHIAN_L1_MAXSIZE = int(os.getenv('CACHIAN_L1_MAXSIZE', '1024'))
+CACHIAN_L1_TTL = float(os.getenv('CACHIAN_L1_TTL', '1'))
+CACHIAN_INVALIDATION_PREFIX = f"{os.getenv('CACHIAN_REDIS_NAME', 'cachian')}:invalidate"
+
+_CLEAR_MESSAGE = '*'
+_PARTITION_MESSAGE = 'p:'
+
+
+class LocalInvalidationChannel():
+    """In-process channel, messages are delivered synchronously to every subscriber."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = Lock()
+
+    # Callbacks are held weakly so a subscription doesn't keep a store alive
+    def subscribe(self, name, callback):
+        with self._lock:
+            self._subscribers.setdefault(name, []).append(weakref.WeakMethod(callback))
+
+    def unsubscribe(self, name, callback):
+        with self._lock:
+            refs = self._subscribers.get(name, [])
+            refs[:] = [ref for ref in refs if ref() is not None and ref() != callback]
+
+    def publish(self, name, message):
+        with self._lock:
+            callbacks = [ref() for ref in self._subscribers.get(name, ())]
+        for callback in callbacks:
+            if callback is not None:
+                callback(message)
+
+
+class RedisInvalidationChannel(LocalInvalidationChannel):
+    """Redis pub/sub channel, reaches every process connected to the same Redis.
+
+    One pattern subscription and listener thread per client serves all stores.
+    """
+
+    def __init__(self, client):
+        super().__init__()
+        self.redis = client
+        self._thread = None
+
+    def subscribe(self, name, callback):
+        super().subscribe(name, callback)
+
+        with self._lock:
+            if self._thread is None:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(**{f'{CACHIAN_INVALIDATION_PREFIX}:*': self._on_message})
+                self._thread = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def publish(self, name, message):
+        self.redis.publish(name, message)
+
+    def _on_message(self, message):
+        name = message['channel']
+        data = message['data']
+        LocalInvalidationChannel.publish(self, name.decode() if isinstance(name, bytes) else name, data.decode() if isinstance(data, bytes) else data)
+
+    def close(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+
+
+_local_channel = LocalInvalidationChannel()
+_redis_channels = weakref.WeakKeyDictionary()
+_redis_channels_lock = Lock()
+
+
+def get_invalidation_channel(l2):
+    """Redis pub/sub for stores with a `redis` client, otherwise the in-process channel."""
+
+    client = getattr(l2, 'redis', None)
+    if client is None:
+        return _local_channel
+
+    with _redis_channels_lock:
+        channel = _redis_channels.get(client)
+        if channel is None:
+            channel = _redis_channels[client] = RedisInvalidationChannel(client)
+    return channel
+
+
+class TieredStore(MutableMapping):
+    """Bounded in-process L1 with a short TTL in front of any L2 store.
+
+    Settings, single-flight locks and the compound lookup()/insert() operations of
+    the L2 are passed through, reads fill the L1 and writes go to both tiers.
+    """
+
+    def __init__(self, l2_class=None, l1_maxsize=None, l1_ttl=None, channel=None):
+        if l2_class is None:
+            from .redis_store import RedisStore
+            l2_class = RedisStore
+
+        self.l2 = l2_class()
+        self.l1 = {}
+        self.l1_maxsize = CACHIAN_L1_MAXSIZE if l1_maxsize is None else l1_maxsize
+        self.l1_ttl = CACHIAN_L1_TTL if l1_ttl is None else l1_ttl
+        self.l1_hits = 0
+        self._l1_lock = Lock()
+
+        self.channel = channel or get_invalidation_channel(self.l2)
+        self.channel_name = f'{CACHIAN_INVALIDATION_PREFIX}:'
+        self.channel.subscribe(self.channel_name, self._on_invalidate)
+
+        # Only offer the optional hooks the L2 has, Cachian checks for them with getattr()
+        for name in ('lookup', 'insert', 'alookup', 'ainsert', 'aget', 'aset', 'adelete', 'aget_many', 'aset_many'):
+            if hasattr(self.l2, name):
+                setattr(self, name, getattr(self, f'_{name}'))
+        for name in ('acquire_flight', 'release_flight', 'evict', 'evict_many', 'alen', 'aevict', 'aevict_many'):
+            if hasattr(self.l2, name):
+                setattr(self, name, getattr(self.l2, name))
+
+    def set_namespace(self, namespace):
+        set_namespace = getattr(self.l2, 'set_namespace', None)
+        if set_namespace is not None:
+            set_namespace(namespace)
+
+        self.channel.unsubscribe(self.channel_name, self._on_invalidate)
+        self.channel_name = f'{CACHIAN_INVALIDATION_PREFIX}:{namespace}'
+        self.channel.subscribe(self.channel_name, self._on_invalidate)
+
+    def configure(self, maxsize=-1, ttl=-1, eviction='lru'):
+        configure = getattr(self.l2, 'configure', None)
+        if configure is not None:
+            configure(maxsize=maxsize, ttl=ttl, eviction=eviction)
+
+    def _l1_get(self, key):
+        entry = self.l1.get(key)
+        if entry is not None and entry[1] > time():
+            self.l1_hits += 1
+            return entry[0]
+        return MISS
+
+    def _l1_set(self, key, value):
+        with self._l1_lock:
+            # Re-inserting moves the key to the end, the oldest entry is dropped first
+            self.l1.pop(key, None)
+            self.l1[key] = (value, time() + self.l1_ttl)
+            if len(self.l1) > self.l1_maxsize:
+                del self.l1[next(iter(self.l1))]
+
+    def _l1_delete(self, key):
+        with self._l1_lock:
+            self.l1.pop(key, None)
+
+    def _l1_remove_partition(self, partition_value):
+        with self._l1_lock:
+            for key in [key for key in self.l1 if key_partition(key) == partition_value]:
+                del self.l1[key]
+
+    def _on_invalidate(self, message):
+        if message == _CLEAR_MESSAGE:
+            with self._l1_lock:
+                self.l1.clear()
+        elif message.startswith(_PARTITION_MESSAGE):
+            self._l1_remove_partition(message[len(_PARTITION_MESSAGE):])
+
+    def get(self, key, default=None):
+        value = self._l1_get(key)
+        if value is not MISS:
+            return value
+
+        value = self.l2.get(key, MISS)
+        if value is MISS:
+            return default
+
+        self._l1_set(key, value)
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, MISS)
+        if value is MISS:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.l2[key] = value
+        self._l1_set(key, value)
+
+    def __delitem__(self, key):
+        self._l1_delete(key)
+        del self.l2[key]
+
+    def pop(self, key, *args):
+        self._l1_delete(key)
+        return self.l2.pop(key, *args)
+
+    # L1 hits are served locally, the rest are read from the L2 in bulk when it supports it
+    def get_many(self, keys):
+        values = [self._l1_get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is MISS]
+        if not missing:
+            return values
+
+        l2_get_many = getattr(self.l2, 'get_many', None)
+        if l2_get_many is not None:
+            l2_values = l2_get_many([keys[i] for i in missing])
+        else:
+            l2_values = [self.l2.get(keys[i], MISS) for i in missing]
+
+        for i, value in zip(missing, l2_values):
+            if value is not MISS:
+                self._l1_set(keys[i], value)
+                values[i] = value
+
+        return values
+
+    def set_many(self, items):
+        l2_set_many = getattr(self.l2, 'set_many', None)
+        if l2_set_many is not None:
+            l2_set_many(items)
+        else:
+            for key, value in items.items():
+                self.l2[key] = value
+
+        for key, value in items.items():
+            self._l1_set(key, value)
+
+    def __contains__(self, key):
+        return self._l1_get(key) is not MISS or key in self.l2
+
+    def __len__(self):
+        return len(self.l2)
+
+    def __iter__(self):
+        return iter(self.l2)
+
+    def remove_partition(self, partition_value):
+        l2_remove_partition = getattr(self.l2, 'remove_partition', None)
+        if l2_remove_partition is not None:
+            removed = l2_remove_partition(partition_value)
+        else:
+            removed = 0
+            for key in [key for key in self.l2 if key_partition(key) == partition_value]:
+                if self.l2.pop(key, MISS) is not MISS:
+                    removed += 1
+
+        self._l1_remove_partition(partition_value)
+        self.channel.publish(self.channel_name, f'{_PARTITION_MESSAGE}{partition_value}')
+        return removed
+
+    def clear(self):
+        self.l2.clear()
+        with self._l1_lock:
+            self.l1.clear()
+        self.channel.publish(self.channel_name, _CLEAR_MESSAGE)
+
+    # L2 compound operations, bound in __init__ when the L2 provides them
+    def _lookup(self, key):
+        value = self._l1_get(key)
+        if value is not MISS:
+            return value
+
+        value = self.l2.lookup(key)
+        if value is not MISS:
+            self._l1_set(key, value)
+        return value
+
+    def _insert(self, key, value, ttl=None):
+        self.l2.insert(key, value, ttl)
+        self._l1_set(key, value)
+
+    async def _alookup(self, key):
+        value = self._l1_get(key)
+        if value is not MISS:
+            return value
+
+        value = await self.l2.alookup(key)
+        if value is not MISS:
+            self._l1_set(key, value)
+        return value
+
+    async def _ainsert(self, key, value, ttl=None):
+        await self.l2.ainsert(key, value, ttl)
+        self._l1_set(key, value)
+
+    async def _aget(self, key):
+        value = self._l1_get(key)
+        if value is not MISS:
+            return value
+
+        value = await self.l2.aget(key)
+        if value is not MISS:
+            self._l1_set(key, value)
+        return value
+
+    async def _aset(self, key, value):
+        await self.l2.aset(key, value)
+        self._l1_set(key, value)
+
+    async def _aget_many(self, keys):
+        values = [self._l1_get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is MISS]
+        if not missing:
+            return values
+
+        for i, value in zip(missing, await self.l2.aget_many([keys[i] for i in missing])):
+            if value is not MISS:
+                self._l1_set(keys[i], value)
+                values[i] = value
+
+        return values
+
+    async def _aset_many(self, items):
+        await self.l2.aset_many(items)
+        for key, value in items.items():
+            self._l1_set(key, value)
+
+    async def _adelete(self, key):
+        self._l1_delete(key)
+        await self.l2.adelete(key)